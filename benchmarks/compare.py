@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Compare two benchmark runs stored by ``run.py``.
+
+A run is every result written by one ``run.py`` invocation; pick one by its
+commit, label or timestamp (the latest run wins when several match). With
+no arguments the two most recent runs are compared.
+
+Usage:
+  python benchmarks/compare.py                  # previous run vs latest run
+  python benchmarks/compare.py 6262e0c ae10398  # by commit (or label, or timestamp)
+"""
+import argparse
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_runs(path: str) -> list:
+    """Results grouped by run, oldest first, as ``[(timestamp, [result, ...]), ...]``."""
+    runs = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                runs.setdefault(result["timestamp"], []).append(result)
+    return sorted(runs.items())
+
+
+def find_run(runs: list, key: str) -> list:
+    for timestamp, results in reversed(runs):
+        if key in (timestamp, results[0].get("commit"), results[0].get("label")):
+            return results
+    sys.exit(f"No run matches '{key}'.")
+
+
+def describe(results: list) -> str:
+    first = results[0]
+    return " ".join(str(part) for part in (first["timestamp"], first.get("commit"), first.get("label")) if part)
+
+
+def change(old, new, digits: int = 1) -> str:
+    if old is None or new is None:
+        return "-"
+    if not old:
+        return f"{new:.{digits}f}"
+    return f"{new:.{digits}f} ({100 * (new - old) / old:+.0f}%)"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two tometo_tomato benchmark runs")
+    parser.add_argument("base", nargs="?", help="Commit, label or timestamp of the base run (default: the previous run)")
+    parser.add_argument("new", nargs="?", help="Commit, label or timestamp of the new run (default: the latest run)")
+    parser.add_argument("--results", default=os.path.join(ROOT, "benchmarks", "results.jsonl"))
+    args = parser.parse_args()
+
+    runs = load_runs(args.results)
+    if args.base:
+        base = find_run(runs, args.base)
+        new = find_run(runs, args.new) if args.new else runs[-1][1]
+    else:
+        if len(runs) < 2:
+            sys.exit("Need at least two runs to compare.")
+        base, new = runs[-2][1], runs[-1][1]
+
+    print(f"base: {describe(base)}")
+    print(f"new:  {describe(new)}")
+    if base[0].get("noise") != new[0].get("noise"):
+        print("warning: the runs used different noise settings")
+    base_by_key = {(r["config"], r["input_rows"]): r for r in base}
+    print(f"{'config':<18} {'rows':>10} {'seconds':>16} {'rows/s':>20} {'RSS MB':>16} {'precision':>9} {'recall':>7}")
+    for result in new:
+        old = base_by_key.get((result["config"], result["input_rows"]))
+        if old is None:
+            continue
+        print(
+            f"{result['config']:<18} {result['input_rows']:>10,} "
+            f"{change(old['seconds'], result['seconds'], 2):>16} "
+            f"{change(old['rows_per_s'], result['rows_per_s'], 0):>20} "
+            f"{change(old['peak_rss_mb'], result['peak_rss_mb']):>16} "
+            f"{(result['precision'] or 0) - (old['precision'] or 0):>+9.3f} "
+            f"{(result['recall'] or 0) - (old['recall'] or 0):>+7.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
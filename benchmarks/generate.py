@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Synthetic benchmark data for tometo_tomato.
+
+Builds a comuni-like reference (the shape of ``data/raw/situas_comuni.csv``:
+municipality name, region, province code and a unique municipality code)
+and an input whose rows are reference names with controllable noise. Each
+input row keeps the code of the reference row it was made from in
+``expected_code`` (empty for rows with no counterpart), which is the ground
+truth for precision and recall.
+
+Usage:
+  python benchmarks/generate.py --reference-size 8000 --input-size 100000 \
+      --typo-rate 0.3 --duplicate-rate 0.2 --accent-rate 0.1 --out-dir benchmarks/data/run1
+"""
+import argparse
+import csv
+import os
+import random
+
+REGIONS = [
+    "Piemonte", "Valle d'Aosta/Vallée d'Aoste", "Lombardia", "Trentino-Alto Adige/Südtirol", "Veneto",
+    "Friuli-Venezia Giulia", "Liguria", "Emilia-Romagna", "Toscana", "Umbria", "Marche", "Lazio", "Abruzzo",
+    "Molise", "Campania", "Puglia", "Basilicata", "Calabria", "Sicilia", "Sardegna",
+]
+
+ONSETS = ["b", "c", "d", "f", "g", "l", "m", "n", "p", "r", "s", "t", "v", "z", "br", "ch", "gh", "gl", "gn",
+          "pr", "sc", "sp", "st", "tr", "", ""]
+VOWELS = "aeiou"
+CODAS = ["", "", "", "n", "l", "r", "s"]
+# Common leading words of Italian municipality names ("San Giovanni", "Castel ...")
+PREFIXES = ["San", "Santa", "Castel", "Monte", "Borgo", "Villa", "Torre", "Porto"]
+SUFFIXES = ["Terme", "Marittima", "di Sopra", "di Sotto", "al Mare", "Scalo"]
+ACCENTED = {"a": "à", "e": "è", "i": "ì", "o": "ò", "u": "ù"}
+UNACCENTED = {v: k for k, v in ACCENTED.items()}
+
+
+def make_word(rng: random.Random) -> str:
+    """One capitalized pseudo-Italian word of 2 to 4 syllables."""
+    syllables = [rng.choice(ONSETS) + rng.choice(VOWELS) + rng.choice(CODAS) for _ in range(rng.randint(2, 4))]
+    word = "".join(syllables)
+    if word[-1] not in VOWELS:
+        word += rng.choice(VOWELS)
+    return word.capitalize()
+
+
+def make_name(rng: random.Random) -> str:
+    """A municipality name: one word, sometimes with a common prefix or suffix, sometimes accented."""
+    name = make_word(rng)
+    roll = rng.random()
+    if roll < 0.15:
+        name = f"{rng.choice(PREFIXES)} {name}"
+    elif roll < 0.22:
+        name = f"{name} {rng.choice(SUFFIXES)}"
+    if rng.random() < 0.05 and name[-1] in ACCENTED:
+        name = name[:-1] + ACCENTED[name[-1]]
+    return name
+
+
+def make_reference(size: int, rng: random.Random) -> list:
+    """``size`` reference rows with unique codes; a few names repeat in different regions, as in ISTAT data."""
+    rows = []
+    for i in range(size):
+        if rows and rng.random() < 0.01:
+            name = rng.choice(rows)["comune"]
+        else:
+            name = make_name(rng)
+        region = rng.randrange(len(REGIONS))
+        rows.append({
+            "codice_comune": f"{region + 1:02d}{i:06d}",
+            "comune": name,
+            "regione": REGIONS[region],
+            "sigla": "".join(rng.choice("ABCDEFGHILMNOPRSTUVZ") for _ in range(2)),
+        })
+    return rows
+
+
+def add_typo(value: str, rng: random.Random) -> str:
+    """Apply one random edit: deletion, insertion, substitution or transposition of adjacent letters."""
+    if len(value) < 2:
+        return value
+    i = rng.randrange(len(value) - 1)
+    edit = rng.randrange(4)
+    letter = rng.choice("abcdefghilmnoprstuvz")
+    if edit == 0:
+        return value[:i] + value[i + 1:]
+    if edit == 1:
+        return value[:i] + letter + value[i:]
+    if edit == 2:
+        return value[:i] + letter + value[i + 1:]
+    return value[:i] + value[i + 1] + value[i] + value[i + 2:]
+
+
+def add_accent_noise(value: str, rng: random.Random) -> str:
+    """Drop the accents of an accented value, or accent one vowel of a plain one."""
+    if any(c in UNACCENTED for c in value):
+        return "".join(UNACCENTED.get(c, c) for c in value)
+    vowels = [i for i, c in enumerate(value) if c in ACCENTED]
+    if not vowels:
+        return value
+    i = rng.choice(vowels)
+    return value[:i] + ACCENTED[value[i]] + value[i + 1:]
+
+
+def add_case_noise(value: str, rng: random.Random) -> str:
+    return value.upper() if rng.random() < 0.5 else value.lower()
+
+
+def write_input(path: str, reference: list, args: argparse.Namespace, rng: random.Random) -> None:
+    """Stream ``args.input_size`` noisy input rows to ``path``."""
+    recent = []
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["comune", "regione", "expected_code"])
+        for _ in range(args.input_size):
+            if recent and rng.random() < args.duplicate_rate:
+                # An exact repeat of an earlier input row
+                writer.writerow(rng.choice(recent))
+                continue
+            if rng.random() < args.unmatched_rate:
+                row = [make_name(rng), rng.choice(REGIONS), ""]
+            else:
+                source = rng.choice(reference)
+                name = source["comune"]
+                if rng.random() < args.typo_rate:
+                    name = add_typo(name, rng)
+                if rng.random() < args.accent_rate:
+                    name = add_accent_noise(name, rng)
+                if rng.random() < args.case_rate:
+                    name = add_case_noise(name, rng)
+                if rng.random() < args.whitespace_rate:
+                    name = f" {name.replace(' ', '  ')} "
+                row = [name, source["regione"], source["codice_comune"]]
+            writer.writerow(row)
+            # A bounded pool keeps duplicate picking O(1) on 10M-row inputs
+            if len(recent) < 10_000:
+                recent.append(row)
+            else:
+                recent[rng.randrange(len(recent))] = row
+
+
+def generate(args: argparse.Namespace) -> tuple:
+    """Write ``reference.csv`` and ``input.csv`` under ``args.out_dir``; returns their paths."""
+    rng = random.Random(args.seed)
+    os.makedirs(args.out_dir, exist_ok=True)
+    reference = make_reference(args.reference_size, rng)
+    reference_path = os.path.join(args.out_dir, "reference.csv")
+    with open(reference_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=["codice_comune", "comune", "regione", "sigla"])
+        writer.writeheader()
+        writer.writerows(reference)
+    input_path = os.path.join(args.out_dir, "input.csv")
+    write_input(input_path, reference, args, rng)
+    return reference_path, input_path
+
+
+def add_generator_arguments(parser: argparse.ArgumentParser) -> None:
+    """Options shared by this script and ``run.py``."""
+    parser.add_argument("--reference-size", type=int, default=8000, help="Reference rows (default: 8000, about the number of comuni)")
+    parser.add_argument("--typo-rate", type=float, default=0.3, help="Fraction of input rows with one typo (default: 0.3)")
+    parser.add_argument("--duplicate-rate", type=float, default=0.2, help="Fraction of input rows repeating an earlier row (default: 0.2)")
+    parser.add_argument("--accent-rate", type=float, default=0.05, help="Fraction of input rows with accents added or dropped (default: 0.05)")
+    parser.add_argument("--case-rate", type=float, default=0.1, help="Fraction of input rows in upper or lower case (default: 0.1)")
+    parser.add_argument("--whitespace-rate", type=float, default=0.05, help="Fraction of input rows with extra spaces (default: 0.05)")
+    parser.add_argument("--unmatched-rate", type=float, default=0.05, help="Fraction of input rows with no reference counterpart (default: 0.05)")
+    parser.add_argument("--seed", type=int, default=42)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic reference and a noisy input with ground truth")
+    parser.add_argument("--input-size", type=int, default=10_000, help="Input rows (default: 10000)")
+    parser.add_argument("--out-dir", default="benchmarks/data/generated")
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+    reference_path, input_path = generate(args)
+    print(f"Wrote {reference_path} ({args.reference_size:,} rows) and {input_path} ({args.input_size:,} rows)")
+
+
+if __name__ == "__main__":
+    main()
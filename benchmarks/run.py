@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""Benchmark suite for tometo_tomato.
+
+Generates synthetic data with ``generate.py`` (cached per size and noise
+settings), runs the CLI once per configuration and input size, and appends
+one JSON line per run to the results file. Each run records:
+
+- ``seconds``: wall time of the CLI process
+- ``rows_per_s``: input rows per second
+- ``pairs_per_s``: candidate pairs per second (see ``pairs_scored()``)
+- ``peak_rss_mb``: peak resident memory of the CLI process
+- ``precision`` and ``recall`` of the clean output against the ground truth
+- the ``--profile`` stage timings and row counts
+
+Usage:
+  python benchmarks/run.py                              # every configuration, 1k and 10k input rows
+  python benchmarks/run.py --sizes 1000000 --configs baseline,block-ngram
+  python benchmarks/run.py --list
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from generate import add_generator_arguments, generate  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Every scorer, blocking mode and normalization flag, one dimension at a time
+# against the baseline; the extra arguments go after the common ones.
+CONFIGS = {
+    "baseline": [],
+    "token-set-ratio": ["--scorer", "token_set_ratio"],
+    "token-sort-ratio": ["--scorer", "token_sort_ratio"],
+    "jaro-winkler": ["--scorer", "jaro_winkler"],
+    "wratio-cdist": ["--scorer", "WRatio", "--engine", "cdist"],
+    # partial_ratio and indel need the rapidfuzz extension in SQL; cdist always has them
+    "partial-ratio-cdist": ["--scorer", "partial_ratio", "--engine", "cdist"],
+    "indel-cdist": ["--scorer", "indel", "--engine", "cdist"],
+    "engine-cdist": ["--engine", "cdist"],
+    "block-prefix": ["--block", "prefix:2"],
+    "block-prefix-direct": ["--block-prefix", "2"],
+    "block-prefix-capped": ["--block", "prefix:2", "--block-max-pairs", "20000"],
+    "block-ngram": ["--block-ngram", "3"],
+    "block-phonetic": ["--block-phonetic", "italian"],
+    "block-window": ["--block-window", "10"],
+    "block-window-reverse": ["--block-window", "10", "--block-window-reverse"],
+    "block-union": ["--block", "prefix:2", "--block", "phonetic:italian"],
+    "latinize": ["--latinize"],
+    "keep-alphanumeric": ["--keep-alphanumeric"],
+    "raw-case": ["--raw-case"],
+    "raw-whitespace": ["--raw-whitespace"],
+    "two-pairs": ["-j", "regione,regione"],
+}
+
+COMMON_ARGS = ["-j", "comune,comune", "-a", "codice_comune", "-t", "85"]
+
+
+def peak_rss_mb(rusage) -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(rusage.ru_maxrss / scale, 1)
+
+
+def run_cli(cli_args: list) -> tuple:
+    """Run the CLI in a child process; returns ``(wall seconds, peak RSS in MB)``."""
+    env = dict(os.environ, PYTHONPATH=os.path.join(ROOT, "src") + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    command = [sys.executable, "-c", "import sys; from tometo_tomato import main; main(sys.argv[1:])"]
+    start = time.perf_counter()
+    process = subprocess.Popen(command + cli_args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    # os.wait4 gives the resource usage of this child alone
+    _, status, rusage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    if status != 0:
+        lines = stderr.decode(errors="replace").strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else f"tometo_tomato exited with status {status >> 8}")
+    return seconds, peak_rss_mb(rusage)
+
+
+def accuracy(input_path: str, clean_path: str, input_cols: list) -> dict:
+    """Precision and recall of the clean output against ``expected_code`` of the input.
+
+    A row is predicted when the clean output holds its join values with a
+    reference code; the prediction is correct when that code is the
+    expected one. Precision is correct / predicted, recall is correct over
+    the rows that have an expected code.
+    """
+    predicted = {}
+    with open(clean_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            if row["codice_comune"]:
+                predicted[tuple(row[c] for c in input_cols)] = row["codice_comune"]
+    predicted_rows = correct = expected_rows = 0
+    with open(input_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            code = predicted.get(tuple(row[c] for c in input_cols))
+            expected_rows += bool(row["expected_code"])
+            predicted_rows += code is not None
+            correct += code is not None and code == row["expected_code"]
+    return {
+        "predicted_rows": predicted_rows,
+        "correct_rows": correct,
+        "precision": round(correct / predicted_rows, 4) if predicted_rows else None,
+        "recall": round(correct / expected_rows, 4) if expected_rows else None,
+    }
+
+
+def pairs_scored(profile: dict) -> int:
+    """Pairs the run had to consider, as counted by ``--profile`` for every blocking mode."""
+    return profile["rows"]["candidate_pairs"]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def dataset(args: argparse.Namespace, size: int) -> tuple:
+    """Paths of the generated reference and input for ``size`` rows, generating them if missing."""
+    noise = (
+        f"r{args.reference_size}-t{args.typo_rate}-d{args.duplicate_rate}-a{args.accent_rate}"
+        f"-c{args.case_rate}-w{args.whitespace_rate}-u{args.unmatched_rate}-s{args.seed}"
+    )
+    out_dir = os.path.join(args.data_dir, f"{noise}-n{size}")
+    reference_path, input_path = os.path.join(out_dir, "reference.csv"), os.path.join(out_dir, "input.csv")
+    if not (os.path.exists(reference_path) and os.path.exists(input_path)):
+        generate(argparse.Namespace(**{**vars(args), "input_size": size, "out_dir": out_dir}))
+    return reference_path, input_path
+
+
+def run_benchmark(name: str, size: int, args: argparse.Namespace, work_dir: str) -> dict:
+    reference_path, input_path = dataset(args, size)
+    extra = CONFIGS[name]
+    input_cols = ["comune"] + (["regione"] if "regione,regione" in extra else [])
+    clean_path = os.path.join(work_dir, f"{name}-{size}.csv")
+    profile_path = os.path.join(work_dir, f"{name}-{size}.json")
+    seconds, rss = run_cli(
+        [input_path, reference_path, *COMMON_ARGS, *extra, "-o", clean_path, "--profile", profile_path, "-f"]
+    )
+    with open(profile_path, encoding="utf-8") as f:
+        profile = json.load(f)
+    pairs = pairs_scored(profile)
+    return {
+        "config": name,
+        "args": extra,
+        "input_rows": size,
+        "reference_rows": args.reference_size,
+        "seconds": round(seconds, 3),
+        "rows_per_s": round(size / seconds, 1),
+        "pairs": pairs,
+        "pairs_per_s": round(pairs / seconds, 1),
+        "peak_rss_mb": rss,
+        **accuracy(input_path, clean_path, input_cols),
+        "stages": {stage["stage"]: stage["seconds"] for stage in profile["stages"]},
+        "rows": profile["rows"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the tometo_tomato benchmark suite")
+    parser.add_argument("--sizes", default="1000,10000", help="Comma-separated input sizes in rows (default: 1000,10000)")
+    parser.add_argument("--configs", help=f"Comma-separated configurations (default: all of {', '.join(CONFIGS)})")
+    parser.add_argument("--label", help="Free-form label stored with the results, e.g. a branch name")
+    parser.add_argument("--results", default=os.path.join(ROOT, "benchmarks", "results.jsonl"),
+                        help="JSON lines file the results are appended to (default: benchmarks/results.jsonl)")
+    parser.add_argument("--data-dir", default=os.path.join(ROOT, "benchmarks", "data"),
+                        help="Cache of generated datasets (default: benchmarks/data)")
+    parser.add_argument("--list", action="store_true", help="List the configurations and exit")
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    if args.list:
+        for name, extra in CONFIGS.items():
+            print(f"{name:<20} {' '.join(COMMON_ARGS + extra)}")
+        return
+    names = args.configs.split(",") if args.configs else list(CONFIGS)
+    unknown = [name for name in names if name not in CONFIGS]
+    if unknown:
+        parser.error(f"unknown configuration(s): {', '.join(unknown)}; see --list")
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    run = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "label": args.label,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "noise": {
+            key: getattr(args, key)
+            for key in ("typo_rate", "duplicate_rate", "accent_rate", "case_rate", "whitespace_rate", "unmatched_rate", "seed")
+        },
+    }
+    work_dir = tempfile.mkdtemp(prefix="tometo_tomato_bench_")
+    print(f"{'config':<20} {'rows':>10} {'seconds':>9} {'rows/s':>10} {'pairs/s':>12} {'RSS MB':>8} {'precision':>9} {'recall':>7}")
+    try:
+        with open(args.results, "a", encoding="utf-8") as results:
+            for size in sizes:
+                for name in names:
+                    try:
+                        result = {**run, **run_benchmark(name, size, args, work_dir)}
+                    except RuntimeError as e:
+                        # e.g. a scorer that needs the rapidfuzz extension; not recorded
+                        print(f"{name:<20} {size:>10,} failed: {e}")
+                        continue
+                    results.write(json.dumps(result) + "\n")
+                    results.flush()
+                    print(
+                        f"{name:<20} {size:>10,} {result['seconds']:>9.2f} {result['rows_per_s']:>10,.0f} "
+                        f"{result['pairs_per_s']:>12,.0f} {result['peak_rss_mb']:>8.1f} "
+                        f"{result['precision'] or 0:>9.3f} {result['recall'] or 0:>7.3f}"
+                    )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"Results appended to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1 @@
-from .tometo_tomato import read_header, build_join_pairs, main, parse_args, prepare_select_clauses, try_load_rapidfuzz, choose_score_expr
+from .tometo_tomato import read_header, concat_csv_parts, build_join_pairs, rank_column_pairs, select_column_pairs, main, parse_args, prepare_select_clauses, try_load_rapidfuzz, choose_score_expr, length_bound_conditions, stage_cutoff, staged_score_expr, fuzzy_join, FuzzyJoinError
@@ -0,0 +1,231 @@
+"""Phonetic encoders used to build blocking keys.
+
+All encoders take an already cleaned value (see ``--raw-case``,
+``--latinize`` and friends), drop accents and non-letters, and return a code
+that is equal for values that sound alike. An empty string is returned when
+the value has no letters.
+
+- ``soundex``: classic American Soundex (first letter + 3 digits).
+- ``metaphone``: Lawrence Philips' original Metaphone, for English-like names.
+- ``italian``: rules tuned for Italian spelling (``sci``/``sce``, ``gli``,
+  ``gn``, hard/soft ``c`` and ``g``, silent ``h``, double consonants), so
+  that e.g. "Calascibetta"/"Calascibeta" and "Sciacca"/"Siacca" share a code.
+"""
+import unicodedata
+from functools import lru_cache
+
+VOWELS = "aeiou"
+
+
+def _letters(value: str) -> str:
+    """Lower-case ``value``, strip accents and keep only ASCII letters and spaces."""
+    decomposed = unicodedata.normalize("NFKD", value)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+    return "".join(c if "a" <= c <= "z" else " " for c in stripped)
+
+
+def _collapse(code: str) -> str:
+    """Collapse runs of the same symbol (double consonants sound like single ones)."""
+    out = []
+    for c in code:
+        if not out or out[-1] != c:
+            out.append(c)
+    return "".join(out)
+
+
+@lru_cache(maxsize=1 << 16)
+def soundex(value: str) -> str:
+    letters = _letters(value).replace(" ", "")
+    if not letters:
+        return ""
+    groups = {
+        **dict.fromkeys("bfpv", "1"),
+        **dict.fromkeys("cgjkqsxz", "2"),
+        **dict.fromkeys("dt", "3"),
+        "l": "4",
+        **dict.fromkeys("mn", "5"),
+        "r": "6",
+    }
+    code = [letters[0].upper()]
+    last = groups.get(letters[0], "")
+    for c in letters[1:]:
+        digit = groups.get(c, "")
+        if digit and digit != last:
+            code.append(digit)
+        if c not in "hw":
+            # Vowels separate equal codes, h and w do not
+            last = digit
+        if len(code) == 4:
+            break
+    return "".join(code).ljust(4, "0")
+
+
+def _metaphone_word(word: str) -> str:
+    for prefix in ("ae", "gn", "kn", "pn", "wr"):
+        if word.startswith(prefix):
+            word = word[1:]
+            break
+    if word.startswith("x"):
+        word = "s" + word[1:]
+    elif word.startswith("wh"):
+        word = "w" + word[2:]
+
+    n = len(word)
+    out = []
+    i = 0
+    while i < n:
+        c = word[i]
+        prev = word[i - 1] if i > 0 else ""
+        nxt = word[i + 1] if i + 1 < n else ""
+        nxt2 = word[i + 2] if i + 2 < n else ""
+        if c == prev and c != "c":
+            i += 1
+            continue
+        if c in VOWELS:
+            if i == 0:
+                out.append(c.upper())
+        elif c == "b":
+            if not (prev == "m" and i == n - 1):
+                out.append("B")
+        elif c == "c":
+            if nxt == "i" and nxt2 == "a":
+                out.append("X")
+            elif nxt == "h":
+                out.append("K" if prev == "s" else "X")
+                i += 1
+            elif nxt in "iey" and nxt:
+                if prev != "s":
+                    out.append("S")
+            else:
+                out.append("K")
+        elif c == "d":
+            if nxt == "g" and nxt2 in "eiy" and nxt2:
+                out.append("J")
+                i += 1
+            else:
+                out.append("T")
+        elif c == "g":
+            if nxt == "h" and not (i + 2 >= n or nxt2 in VOWELS):
+                pass
+            elif nxt == "n" and (i + 2 == n or word[i + 1:] == "ned"):
+                pass
+            elif nxt in "iey" and nxt and prev != "g":
+                out.append("J")
+            else:
+                out.append("K")
+        elif c == "h":
+            if prev in "csptg" and prev:
+                pass
+            elif prev in VOWELS and prev and nxt not in VOWELS:
+                pass
+            else:
+                out.append("H")
+        elif c == "k":
+            if prev != "c":
+                out.append("K")
+        elif c == "p":
+            if nxt == "h":
+                out.append("F")
+                i += 1
+            else:
+                out.append("P")
+        elif c == "q":
+            out.append("K")
+        elif c == "s":
+            if nxt == "h":
+                out.append("X")
+                i += 1
+            elif nxt == "i" and nxt2 in "oa" and nxt2:
+                out.append("X")
+            else:
+                out.append("S")
+        elif c == "t":
+            if nxt == "i" and nxt2 in "oa" and nxt2:
+                out.append("X")
+            elif nxt == "h":
+                out.append("0")
+                i += 1
+            elif not (nxt == "c" and nxt2 == "h"):
+                out.append("T")
+        elif c == "v":
+            out.append("F")
+        elif c in "wy":
+            if nxt in VOWELS and nxt:
+                out.append(c.upper())
+        elif c == "x":
+            out.append("KS")
+        elif c == "z":
+            out.append("S")
+        else:
+            out.append(c.upper())
+        i += 1
+    return "".join(out)
+
+
+@lru_cache(maxsize=1 << 16)
+def metaphone(value: str) -> str:
+    return "".join(_metaphone_word(word) for word in _letters(value).split())
+
+
+def _italian_word(word: str) -> str:
+    n = len(word)
+    out = []
+    i = 0
+    while i < n:
+        c = word[i]
+        nxt = word[i + 1] if i + 1 < n else ""
+        nxt2 = word[i + 2] if i + 2 < n else ""
+        if c == nxt and c not in VOWELS:
+            # Double consonants: the second one carries the sound ("ggi" -> "gi")
+            pass
+        elif c in VOWELS or c in "jy":
+            # Only the presence of a leading vowel is kept
+            if not out:
+                out.append("A")
+        elif c == "h":
+            pass
+        elif c == "s" and nxt == "c":
+            if nxt2 and nxt2 in "ei":
+                # "sci"/"sce" sound like a plain s for blocking purposes
+                out.append("S")
+            else:
+                out.append("SK")
+            i += 1
+        elif c == "c":
+            out.append("C" if nxt and nxt in "ei" else "K")
+        elif c == "g":
+            if nxt == "l" and nxt2 == "i":
+                out.append("L")
+                i += 1
+            elif nxt == "n":
+                out.append("N")
+                i += 1
+            elif nxt and nxt in "ei":
+                out.append("J")
+            else:
+                out.append("G")
+        elif c in "kq":
+            out.append("K")
+        elif c == "p" and nxt == "h":
+            out.append("F")
+            i += 1
+        elif c == "w":
+            out.append("V")
+        elif c == "x":
+            out.append("KS")
+        else:
+            out.append(c.upper())
+        i += 1
+    return _collapse("".join(out))
+
+
+@lru_cache(maxsize=1 << 16)
+def italian(value: str) -> str:
+    return "".join(_italian_word(word) for word in _letters(value).split())
+
+
+PHONETIC_ENCODERS = {
+    "soundex": soundex,
+    "metaphone": metaphone,
+    "italian": italian,
+}
@@ -11,8 +11,10 @@ Usage example:
 import os
 import sys
 
-# Add src directory to Python path to allow importing _version.py
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__))))
+# Add src directory to Python path to allow importing _version.py. Appended, not
+# prepended: this module must not shadow the tometo_tomato package in processes
+# that import it by name (--workers spawns them).
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__))))
 
 try:
     from _version import version as __version__
@@ -22,13 +24,27 @@ except ImportError:
 
 import argparse
 import logging
+import shutil
+import tempfile
+import time
 try:
     import duckdb
 except Exception as e:
     logging.error("Error: duckdb Python package is required but not installed. Install via 'pip install duckdb'")
     raise
+from collections import namedtuple
 from typing import List
 
+try:
+    from .phonetic import PHONETIC_ENCODERS
+except ImportError:
+    # Running as a script (python src/tometo_tomato/tometo_tomato.py)
+    from phonetic import PHONETIC_ENCODERS
+
+
+class FuzzyJoinError(Exception):
+    """Invalid options or inputs; the command line reports the message and exits with status 1."""
+
 
 def check_file_overwrite(file_path: str, force: bool = False) -> bool:
     """Check if a file exists and prompt user for overwrite confirmation if needed.
@@ -59,32 +75,106 @@ def check_file_overwrite(file_path: str, force: bool = False) -> bool:
         return False
 
 
-def parse_args():
-    parser = argparse.ArgumentParser(
-        description="Fuzzy join utility using DuckDB",
-        epilog=(
-            "Example:\n"
-            "  tometo_tomato input.csv ref.csv -j \"col1,col_ref1\" -j \"col2,col_ref2\" -a \"field_to_add1\" -a \"field_to_add2\" -o \"output_clean.csv\"\n"
-            "  tometo_tomato input.csv ref.csv -j \"name,ref_name\" --keep-alphanumeric -o clean_output.csv\n"
-        ),
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-    )
+def parse_args(argv: List[str] = None, mode: str = "join"):
+    """Parse the command line of a ``mode``: ``join`` (the default), ``serve`` or ``batch``."""
+    serve = mode == "serve"
+    batch = mode == "batch"
+    if serve:
+        parser = argparse.ArgumentParser(
+            prog="tometo_tomato serve",
+            description=(
+                "Keep the prepared reference in memory and answer match requests: JSON lines on stdin "
+                "(one record, or a list of records matched as one batch, per line) or HTTP with --http."
+            ),
+            epilog=(
+                "Example:\n"
+                "  tometo_tomato serve ref.csv -j \"comune,comune\" -a codice_comune --http 127.0.0.1:8080\n"
+            ),
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+    elif batch:
+        parser = argparse.ArgumentParser(
+            prog="tometo_tomato batch",
+            description=(
+                "Match several input files against one reference, prepared once. Output paths come from "
+                "templates where {stem} is the input file name without extensions and {name} the full name."
+            ),
+            epilog=(
+                "Example:\n"
+                "  tometo_tomato batch ref.csv 'regions/*.csv' -j \"comune,comune\" -o \"matched/{stem}.csv\" -u \"matched/{stem}_ambiguous.csv\"\n"
+            ),
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+    else:
+        parser = argparse.ArgumentParser(
+            description="Fuzzy join utility using DuckDB",
+            epilog=(
+                "Example:\n"
+                "  tometo_tomato input.csv ref.csv -j \"col1,col_ref1\" -j \"col2,col_ref2\" -a \"field_to_add1\" -a \"field_to_add2\" -o \"output_clean.csv\"\n"
+                "  tometo_tomato input.csv ref.csv -j \"name,ref_name\" --keep-alphanumeric -o clean_output.csv\n"
+                "  tometo_tomato serve ref.csv -j \"name,ref_name\"  (lookup server, see tometo_tomato serve --help)\n"
+                "  tometo_tomato batch ref.csv 'in/*.csv' -o \"out/{stem}.csv\"  (many inputs, see tometo_tomato batch --help)\n"
+            ),
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
     parser.add_argument(
         "--version",
         action="version",
         version=f"%(prog)s {__version__}"
     )
-    parser.add_argument("input_file")
+    if not serve and not batch:
+        parser.add_argument("input_file")
     parser.add_argument("reference_file")
+    if batch:
+        parser.add_argument("input_files", nargs="+", metavar="INPUT", help="Input files or quoted glob patterns")
     parser.add_argument("--threshold", "-t", type=float, default=85.0)
-    parser.add_argument("--infer-pairs", "-i", action="store_true", help="Infer join pairs from similar column names")
-    parser.add_argument("--infer-threshold", "-I", type=float, default=0.7, help="Threshold (0-1) for header name similarity when inferring pairs")
-    parser.add_argument("--output-clean", "-o", default="clean_matches.csv")
-    parser.add_argument("--output-ambiguous", "-u", default=None)
+    if not serve:
+        parser.add_argument("--infer-pairs", "-i", action="store_true", help="Infer join pairs from similar column names")
+        parser.add_argument(
+            "--infer-threshold", "-I", type=float, default=None,
+            help="Threshold (0-1) for inferred pairs: header name similarity (default: 0.7), "
+                 f"or with --infer-values the value confidence (default: {INFER_VALUES_THRESHOLD})",
+        )
+        parser.add_argument(
+            "--infer-values",
+            action="store_true",
+            help=(
+                "Infer join pairs from sampled column values instead of header names: each column gets a MinHash "
+                "sketch of the character 3-grams of its values, and pairs are ranked by estimated overlap"
+            ),
+        )
+        parser.add_argument(
+            "--infer-sample",
+            type=int,
+            default=INFER_SAMPLE_ROWS,
+            metavar="N",
+            help=f"Rows read from the start of each file by --infer-values (default: {INFER_SAMPLE_ROWS:,})",
+        )
+    if batch:
+        parser.add_argument(
+            "--output-clean", "-o", default="{stem}_clean.csv", metavar="TEMPLATE",
+            help="Clean output path of each input (default: {stem}_clean.csv)",
+        )
+        parser.add_argument(
+            "--output-ambiguous", "-u", default=None, metavar="TEMPLATE",
+            help="Ambiguous output path of each input, e.g. {stem}_ambiguous.csv",
+        )
+    elif not serve:
+        parser.add_argument("--output-clean", "-o", default="clean_matches.csv")
+        parser.add_argument("--output-ambiguous", "-u", default=None)
     parser.add_argument("--join-pair", "-j", action="append", help="Pair in the form input_col,ref_col. Can be repeated.")
     parser.add_argument("--add-field", "-a", action="append", help="Fields from reference to add to output (space separated or repeated)")
     parser.add_argument("--show-score", "-s", action="store_true", help="Include avg_score in outputs")
-    parser.add_argument("--scorer", choices=['ratio', 'token_set_ratio'], default='ratio', help="Fuzzy matching algorithm to use.")
+    parser.add_argument(
+        "--scorer",
+        choices=list(SCORERS),
+        default='ratio',
+        help=(
+            "Fuzzy matching algorithm to use. token_sort_ratio compares the tokens sorted once per distinct value "
+            "and fixes word-order differences; jaro_winkler runs in DuckDB alone; token_set_ratio, partial_ratio "
+            "and indel need the rapidfuzz extension or --engine cdist; WRatio needs --engine cdist."
+        ),
+    )
     parser.add_argument("--raw-whitespace", action="store_true", help="Disable whitespace normalization (no trimming or space reduction)")
     parser.add_argument("--raw-case", action="store_true", help="Enable case sensitive comparison (do not convert to lower-case)")
     parser.add_argument("--latinize", action="store_true", help="Normalize/latinize accented and special characters before matching")
@@ -98,46 +188,571 @@ def parse_args():
             "from the first N characters of each cleaned join column, concatenated with '|' (N = block-prefix)."
         ),
     )
+    parser.add_argument(
+        "--block-ngram",
+        type=int,
+        default=0,
+        metavar="N",
+        help=(
+            "Enable q-gram blocking: only score pairs whose cleaned join values share enough character "
+            "N-grams (count filter derived from --threshold), using an inverted index on the reference."
+        ),
+    )
+    parser.add_argument(
+        "--block-ngram-max-df",
+        type=float,
+        default=0.1,
+        metavar="FRACTION",
+        help="Ignore N-grams found in more than this fraction of reference rows when blocking (default: 0.1)",
+    )
+    parser.add_argument(
+        "--block-phonetic",
+        choices=sorted(PHONETIC_ENCODERS),
+        default=None,
+        help=(
+            "Enable phonetic blocking: only score pairs whose cleaned join values share the same phonetic "
+            "code ('italian' is tuned for Italian spelling, e.g. Calascibetta/Calascibeta, Sciacca/Siacca)."
+        ),
+    )
+    parser.add_argument(
+        "--block-window",
+        type=int,
+        default=0,
+        metavar="W",
+        help=(
+            "Enable sorted-neighbourhood blocking: sort input and reference keys together and compare "
+            "each input key only with the W nearest reference keys in that order."
+        ),
+    )
+    parser.add_argument(
+        "--block-window-reverse",
+        action="store_true",
+        help="With --block-window, add a second pass over reversed strings to catch errors at the start of values",
+    )
+    parser.add_argument(
+        "--block",
+        action="append",
+        metavar="KIND:VALUE[:COLUMN]",
+        help=(
+            "Add a blocking pass. Repeatable; the candidates of all passes (including --block-prefix, "
+            "--block-ngram, --block-phonetic and --block-window) are unioned and deduplicated before scoring. "
+            "KIND is prefix, ngram, phonetic, window or window-reverse; VALUE is the length, N-gram size, "
+            "phonetic algorithm or window size; COLUMN limits the pass to one join column. "
+            "Example: --block prefix:3:comune --block phonetic:italian"
+        ),
+    )
+    parser.add_argument(
+        "--block-max-pairs",
+        type=int,
+        default=0,
+        metavar="N",
+        help=(
+            "Cap on the candidate pairs (input keys x reference rows) of one prefix block. Larger blocks "
+            "are split with longer prefixes until they fit; blocks that still do not fit are reported. "
+            "Applies to --block-prefix and --block prefix passes (default: no cap)."
+        ),
+    )
+    parser.add_argument(
+        "--engine",
+        choices=['sql', 'cdist'],
+        default='sql',
+        help=(
+            "Scoring engine: 'sql' scores every candidate pair inside DuckDB (default); "
+            "'cdist' scores the distinct cleaned keys in-process with rapidfuzz.process.cdist "
+            "(multithreaded, only pairs reaching the threshold are kept)."
+        ),
+    )
+    parser.add_argument(
+        "--ref-cache",
+        metavar="DIR",
+        default=None,
+        help=(
+            "Directory for a persistent cache of the normalized reference (Parquet). The cache key combines "
+            "the reference file content hash, the reference join columns and the normalization/blocking flags; "
+            "a hit skips CSV parsing and normalization of the reference. The sniffed CSV dialects of the input "
+            "and reference files are cached there too."
+        ),
+    )
+    parser.add_argument(
+        "--ref-cache-size",
+        metavar="MB",
+        type=float,
+        default=1024.0,
+        help="Maximum total size of --ref-cache in MB; least recently used entries are evicted (default: 1024)",
+    )
+    if not serve:
+        parser.add_argument(
+            "--output-format",
+            choices=OUTPUT_FORMATS,
+            default=None,
+            help=(
+                "Format of the clean and ambiguous outputs (default: from the --output-clean extension, "
+                ".parquet or .arrow, otherwise csv). 'arrow' writes Arrow IPC files and needs pyarrow."
+            ),
+        )
+    parser.add_argument(
+        "--threads",
+        default=None,
+        metavar="N|auto",
+        help=(
+            "DuckDB worker threads. 'auto' uses the CPUs allowed by the cgroup/container limits, "
+            "scaled down for small jobs from the estimated number of candidate pairs (default: DuckDB's own)."
+        ),
+    )
+    parser.add_argument(
+        "--memory-limit",
+        default=None,
+        metavar="SIZE|auto",
+        help=(
+            "DuckDB memory limit, e.g. 4GB; above it DuckDB spills to --temp-directory. "
+            "'auto' uses 80%% of the cgroup/container memory limit (default: DuckDB's own)."
+        ),
+    )
+    parser.add_argument(
+        "--temp-directory",
+        default=None,
+        metavar="DIR",
+        help="Directory where DuckDB spills intermediate data, and where --workers writes its partitions",
+    )
+    if serve:
+        parser.add_argument(
+            "--http",
+            metavar="[HOST:]PORT",
+            default=None,
+            help=(
+                "Serve HTTP instead of stdin: POST /match with a JSON record or list of records, "
+                "GET /stats for the latency percentiles (default host: 127.0.0.1)"
+            ),
+        )
+        # The batch-only options keep their defaults so the matching pipeline reads them unchanged
+        parser.set_defaults(
+            input_file=None, infer_pairs=False, infer_threshold=None, infer_values=False,
+            infer_sample=INFER_SAMPLE_ROWS, output_clean=None, output_ambiguous=None,
+            output_format=None, workers=1, chunk_size=0, resume=False, force=False,
+        )
+    else:
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            metavar="N",
+            help=(
+                "Score in N worker processes: the scoring inputs are hash-partitioned (on the block key with "
+                "--block-prefix) into Parquet files and each partition is scored in its own DuckDB connection."
+            ),
+        )
+    if batch:
+        parser.set_defaults(input_file=None, chunk_size=0, resume=False)
+    elif not serve:
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=0,
+            metavar="ROWS",
+            help=(
+                "Match the input in chunks of ROWS input rows, writing each chunk to "
+                "<output-clean>.parts/ before assembling the outputs. Peak memory then depends on the chunk size."
+            ),
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="With --chunk-size, continue an interrupted run from its checkpoint, skipping the finished chunks",
+        )
+        parser.add_argument(
+            "--state",
+            metavar="DIR",
+            default=None,
+            help=(
+                "Keep the match of every distinct input key in DIR and, on the next run, only match the new or "
+                "changed keys. The state is rebuilt when the reference file, the join pairs or a matching "
+                "option changes."
+            ),
+        )
+        parser.add_argument(
+            "--profile",
+            metavar="FILE",
+            default=None,
+            help=(
+                "Write a JSON report with the wall time, peak memory and runs of each stage, the row counts "
+                "(input rows, distinct keys, candidate pairs per blocking pass, pairs above the threshold) "
+                "and DuckDB's query profile of the scoring query"
+            ),
+        )
+        parser.add_argument(
+            "--estimate",
+            action="store_true",
+            help=(
+                "Plan the run without scoring: print a JSON report with the exact number of pairs to score, "
+                "the largest blocks, and the scoring time and memory projected from a timed sample, then exit"
+            ),
+        )
+        parser.add_argument(
+            "--max-pairs", type=int, default=None, metavar="N",
+            help="With --estimate, exit with status 1 when more than N pairs would be scored",
+        )
+        parser.add_argument(
+            "--max-seconds", type=float, default=None, metavar="S",
+            help="With --estimate, exit with status 1 when the projected run time exceeds S seconds",
+        )
+        parser.add_argument(
+            "--max-memory", default=None, metavar="SIZE",
+            help="With --estimate, exit with status 1 when the projected peak memory exceeds SIZE, e.g. 8GB",
+        )
     parser.add_argument("--verbose", "-v", action="count", default=0, help="Increase verbosity (e.g., -v, -vv)")
     parser.add_argument("--quiet", "-q", action="store_true", help="Suppress all output except errors")
-    parser.add_argument("--force", "-f", action="store_true", help="Overwrite existing output files without prompting")
-    return parser.parse_args()
+    if not serve:
+        parser.add_argument("--force", "-f", action="store_true", help="Overwrite existing output files without prompting")
+    return parser.parse_args(argv)
 
-def read_header(path: str) -> List[str]:
-    # Use DuckDB SQL engine as primary source of truth for header detection
-    con = duckdb.connect(database=":memory:")
-    safe_path = path.replace("'", "''")
+ARROW_EXTENSIONS = (".arrow", ".feather", ".ipc")
+OUTPUT_FORMATS = ("csv", "parquet", "arrow")
+
+
+def file_format(path: str) -> str:
+    """Detect the format of ``path`` from its name: 'parquet', 'arrow' or 'csv'.
+
+    CSV covers compressed files too (``.csv.gz``, ``.csv.zst``), which DuckDB
+    decompresses on the fly.
+    """
+    lower = path.lower()
+    if lower.endswith(".parquet"):
+        return "parquet"
+    if lower.endswith(ARROW_EXTENSIONS):
+        return "arrow"
+    return "csv"
 
-    # Use the same query from test_csv_reading.py that works correctly
-    q = f"SELECT * FROM read_csv_auto('{safe_path}', header=true, all_varchar=true)"
-    res = con.execute(q)
 
-    desc = getattr(res, 'description', None)
-    if desc:
-        return [c[0] for c in desc]
-    # If DuckDB doesn't populate description, try with LIMIT 0 which always forces description population
+def _import_pyarrow():
+    """Import pyarrow, needed only for Arrow IPC files."""
     try:
-        q_limit = f"SELECT * FROM read_csv_auto('{safe_path}', header=true, all_varchar=true) LIMIT 0"
-        res_limit = con.execute(q_limit)
-        desc_limit = getattr(res_limit, 'description', None)
-        if desc_limit:
-            return [c[0] for c in desc_limit]
-        else:
-            raise Exception("Could not determine column names from CSV file")
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError("Arrow IPC files require the optional pyarrow package: pip install pyarrow")
+    return pyarrow
+
+
+# Sniffed CSV dialects of this process, keyed by file identity
+_csv_dialects = {}
+
+
+def sniff_csv_dialect(path: str, cache_dir: str = None) -> dict:
+    """Sniff the dialect and header of a CSV file once per run.
+
+    DuckDB's sniffer reads a sample of the file, not all of it. The result
+    is kept for the rest of the process and, when ``cache_dir`` is given,
+    stored there as JSON keyed by the file path, size and modification time,
+    so later runs on the same file skip sniffing too. These files count
+    toward ``--ref-cache-size`` and are evicted with the reference entries.
+    """
+    import hashlib
+    import json
+
+    stat = os.stat(path)
+    identity = f"{os.path.realpath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    if identity in _csv_dialects:
+        return _csv_dialects[identity]
+
+    cache_file = None
+    if cache_dir:
+        digest = hashlib.sha256(identity.encode("utf-8")).hexdigest()
+        cache_file = os.path.join(cache_dir, f"csv_{digest[:32]}.json")
+        if os.path.exists(cache_file):
+            with open(cache_file, encoding="utf-8") as f:
+                _csv_dialects[identity] = json.load(f)
+            # Refresh the access time used by the LRU eviction
+            os.utime(cache_file)
+            return _csv_dialects[identity]
+
+    safe_path = path.replace("'", "''")
+    con = duckdb.connect(database=":memory:")
+    try:
+        delim, quote, escape, new_line, comment, skip, columns = con.execute(f"""
+            SELECT Delimiter, Quote, Escape, NewLineDelimiter, Comment, SkipRows, Columns
+            FROM sniff_csv('{safe_path}', header=true)
+        """).fetchone()
     except Exception as e:
         logging.error(f"DuckDB could not determine header columns for file: {path}. Error: {e}")
         raise
 
+    def option(value):
+        return "" if value == "(empty)" else value
+
+    dialect = {
+        "delim": option(delim),
+        "quote": option(quote),
+        "escape": option(escape),
+        "new_line": option(new_line),
+        "comment": option(comment),
+        "skip": skip,
+        "columns": [c["name"] for c in columns],
+    }
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(f"{cache_file}.{os.getpid()}.tmp", "w", encoding="utf-8") as f:
+            json.dump(dialect, f)
+        os.replace(f"{cache_file}.{os.getpid()}.tmp", cache_file)
+    _csv_dialects[identity] = dialect
+    return dialect
+
+
+def csv_reader_sql(path: str, dialect: dict) -> str:
+    """``read_csv`` call with the sniffed dialect and every column as VARCHAR (no sniffing)."""
+    def quoted(value) -> str:
+        return "'" + str(value).replace("'", "''") + "'"
+
+    columns = ", ".join(f"{quoted(c)}: 'VARCHAR'" for c in dialect["columns"])
+    return (
+        f"read_csv({quoted(path)}, auto_detect=false, header=true, "
+        f"delim={quoted(dialect['delim'])}, quote={quoted(dialect['quote'])}, "
+        f"escape={quoted(dialect['escape'])}, new_line={quoted(dialect['new_line'])}, "
+        f"comment={quoted(dialect['comment'])}, skip={int(dialect['skip'])}, columns={{{columns}}})"
+    )
+
+
+def source_sql(con: duckdb.DuckDBPyConnection, path: str, cache_dir: str = None) -> str:
+    """Return a table expression reading ``path`` on ``con``, whatever its format.
+
+    CSV files are read with their sniffed dialect (``sniff_csv_dialect()``).
+    Arrow IPC files are registered as a pyarrow dataset, so DuckDB can push
+    projections down to them like it does for Parquet and CSV.
+    """
+    safe_path = path.replace("'", "''")
+    fmt = file_format(path)
+    if fmt == "parquet":
+        return f"read_parquet('{safe_path}')"
+    if fmt == "arrow":
+        pa = _import_pyarrow()
+        name = f"arrow_{file_sha256_name(path)}"
+        con.register(name, pa.dataset.dataset(path, format="ipc"))
+        return name
+    return csv_reader_sql(path, sniff_csv_dialect(path, cache_dir))
+
+
+def file_sha256_name(path: str) -> str:
+    """Short stable identifier for a path, used to name registered Arrow sources."""
+    import hashlib
+
+    return hashlib.sha256(os.path.abspath(path).encode("utf-8")).hexdigest()[:16]
+
+
+def projected_source_sql(con: duckdb.DuckDBPyConnection, path: str, columns: List[str], cache_dir: str = None) -> str:
+    """Read only ``columns`` of ``path`` (projection pushdown), cast to VARCHAR.
+
+    CSV files are already read as text; for Parquet and Arrow the cast keeps
+    cleaning and scoring identical whatever the column types.
+    """
+    return projected_sql(source_sql(con, path, cache_dir), columns)
+
+
+def projected_sql(source: str, columns: List[str]) -> str:
+    """Select ``columns`` of the table expression ``source``, cast to VARCHAR."""
+    casts = ", ".join(f'CAST("{c}" AS VARCHAR) AS "{c}"' for c in columns)
+    return f"(SELECT {casts} FROM {source})"
+
+
+def relation_columns(con: duckdb.DuckDBPyConnection, source: str) -> List[str]:
+    """Column names of the table expression ``source`` on ``con``."""
+    return [c[0] for c in con.execute(f"SELECT * FROM {source} LIMIT 0").description]
+
+
+def copy_query(con: duckdb.DuckDBPyConnection, query: str, path: str, fmt: str = "csv") -> None:
+    """Write the result of ``query`` to ``path`` as CSV, Parquet or Arrow IPC."""
+    if fmt == "parquet":
+        con.execute(f"COPY ({query}) TO '{path}' (FORMAT PARQUET);")
+    elif fmt == "arrow":
+        pa = _import_pyarrow()
+        result = con.execute(query)
+        # to_arrow_reader() replaces fetch_record_batch() in recent DuckDB releases
+        reader = result.to_arrow_reader() if hasattr(result, "to_arrow_reader") else result.fetch_record_batch()
+        # Same names as the CSV and Parquet writers: repeated columns get a _1, _2... suffix
+        names = []
+        for name in reader.schema.names:
+            unique, n = name, 0
+            while unique in names:
+                n += 1
+                unique = f"{name}_{n}"
+            names.append(unique)
+        schema = pa.schema([field.with_name(name) for field, name in zip(reader.schema, names)])
+        with pa.ipc.new_file(path, schema) as writer:
+            for batch in reader:
+                writer.write_batch(pa.RecordBatch.from_arrays(batch.columns, schema=schema))
+    else:
+        con.execute(f"COPY ({query}) TO '{path}' (HEADER, DELIMITER ',');")
+
+
+def read_header(path: str, cache_dir: str = None) -> List[str]:
+    """Return the column names of ``path`` without scanning the data.
 
-def build_join_pairs(args) -> List[str]:
+    CSV headers come from the sniffed dialect (see ``sniff_csv_dialect()``),
+    Parquet and Arrow headers from the file metadata.
+    """
+    if file_format(path) == "csv":
+        return list(sniff_csv_dialect(path, cache_dir)["columns"])
+    con = duckdb.connect(database=":memory:")
+    res = con.execute(f"SELECT * FROM {source_sql(con, path)} LIMIT 0")
+    return [c[0] for c in res.description]
+
+
+# --infer-values: rows read from the start of each file, MinHash sketch size,
+# q-gram length and default minimum confidence of a selected pair
+INFER_SAMPLE_ROWS = 5_000
+INFER_SKETCH_SIZE = 128
+INFER_QGRAM = 3
+INFER_VALUES_THRESHOLD = 0.2
+
+
+def rank_column_pairs(
+    con: duckdb.DuckDBPyConnection,
+    input_sql: str,
+    ref_sql: str,
+    sample_rows: int = INFER_SAMPLE_ROWS,
+    sketch_size: int = INFER_SKETCH_SIZE,
+) -> List[dict]:
+    """Rank every (input column, reference column) pair by the overlap of their values.
+
+    The first ``sample_rows`` rows of each table expression are read, so the
+    cost does not depend on the file size. The distinct values of each column
+    are lowercased, stripped of accents and split into character q-grams;
+    each column keeps a MinHash sketch of its q-gram set, ``sketch_size``
+    minimum hashes. The confidence of a pair is the share of equal minimum
+    hashes, an estimate of the Jaccard similarity of the two q-gram sets, so
+    typos and a different sample of the same values still overlap.
+
+    Returns one dict per pair with ``input``, ``reference``, ``confidence``
+    and ``name_similarity`` (header names, ``difflib``), best first.
+    """
+    from difflib import SequenceMatcher
+
+    pad = " " * (INFER_QGRAM - 2)
+    values = []
+    sampled = True
+    for side, source in (("input", input_sql), ("reference", ref_sql)):
+        con.execute(
+            f"CREATE OR REPLACE TEMP TABLE infer_sample_{side} AS "
+            f"SELECT COLUMNS(*)::VARCHAR FROM {source} LIMIT {int(sample_rows)}"
+        )
+        sampled = sampled and con.execute(f"SELECT COUNT(*) FROM infer_sample_{side}").fetchone()[0] > 0
+        values.append(f"""
+            SELECT DISTINCT '{side}' AS side, col,
+                   ' {pad}' || strip_accents(lower(trim(regexp_replace(v, '\\s+', ' ', 'g')))) || '{pad} ' AS v
+            FROM (UNPIVOT infer_sample_{side} ON COLUMNS(*) INTO NAME col VALUE v)
+        """)
+    rows = [] if not sampled else con.execute(f"""
+        WITH sample_values AS ({' UNION ALL '.join(values)}),
+        grams AS (
+            SELECT DISTINCT side, col, substr(v, unnest(range(1, length(v) - {INFER_QGRAM} + 2)), {INFER_QGRAM}) AS g
+            FROM sample_values
+        ),
+        sketches AS (
+            SELECT side, col, s.seed, min(hash(g, s.seed)) AS h
+            FROM grams, range({int(sketch_size)}) s(seed)
+            GROUP BY ALL
+        )
+        SELECT i.col, r.col, count(*) FILTER (WHERE i.h = r.h) / {int(sketch_size)}
+        FROM sketches i
+        JOIN sketches r ON r.seed = i.seed AND r.side = 'reference'
+        WHERE i.side = 'input'
+        GROUP BY ALL
+    """).fetchall()
+    con.execute("DROP TABLE IF EXISTS infer_sample_input; DROP TABLE IF EXISTS infer_sample_reference;")
+    ranked = [
+        {
+            "input": inp,
+            "reference": ref,
+            "confidence": round(confidence, 4),
+            "name_similarity": round(SequenceMatcher(None, inp.lower(), ref.lower()).ratio(), 4),
+        }
+        for inp, ref, confidence in rows
+    ]
+    ranked.sort(key=lambda c: (-c["confidence"], -c["name_similarity"], c["input"], c["reference"]))
+    return ranked
+
+
+def select_column_pairs(ranked: List[dict], threshold: float = INFER_VALUES_THRESHOLD) -> List[str]:
+    """Join pairs from ``rank_column_pairs()``: best first, each column used once, confidence >= ``threshold``."""
+    used_inp, used_ref, pairs = set(), set(), []
+    for candidate in ranked:
+        if candidate["confidence"] < threshold:
+            break
+        if candidate["input"] in used_inp or candidate["reference"] in used_ref:
+            continue
+        used_inp.add(candidate["input"])
+        used_ref.add(candidate["reference"])
+        candidate["selected"] = True
+        pairs.append(f"{candidate['input']},{candidate['reference']}")
+    return pairs
+
+
+def log_column_pairs(ranked: List[dict], per_column: int = 3) -> None:
+    """Log the best ``per_column`` reference columns of each input column, with their confidence."""
+    if not ranked:
+        logging.info("No sampled values to infer join pairs from.")
+        return
+    shown = {}
+    lines = []
+    for c in ranked:
+        if shown.get(c["input"], 0) >= per_column or not c["confidence"]:
+            continue
+        shown[c["input"]] = shown.get(c["input"], 0) + 1
+        lines.append(
+            f"  {c['input']} -> {c['reference']}: confidence {c['confidence']:.2f}, "
+            f"name similarity {c['name_similarity']:.2f}{'  (selected)' if c.get('selected') else ''}"
+        )
+    logging.info("Join pair candidates from sampled values:\n" + "\n".join(lines))
+
+
+def build_join_pairs(
+    args,
+    input_cols: List[str] = None,
+    ref_cols: List[str] = None,
+    con: duckdb.DuckDBPyConnection = None,
+    input_source: str = None,
+    reference_source: str = None,
+    ranked: List[dict] = None,
+) -> List[str]:
+    """Join pairs of ``args``: the ``-j`` pairs, or pairs inferred from the two files.
+
+    With ``--infer-values`` the pairs come from ``rank_column_pairs()`` on
+    ``input_source``/``reference_source`` (table expressions on ``con``;
+    default: the input and reference files); the ranking is appended to
+    ``ranked`` when given. Otherwise same-name columns are paired, plus, with
+    ``--infer-pairs``, the most similar header name of each input column.
+    """
     if args.join_pair:
         pairs = []
         for p in args.join_pair:
             pairs.append(p.strip())
         return pairs
-    # otherwise infer common columns
-    input_cols = read_header(args.input_file)
-    ref_cols = read_header(args.reference_file)
+    if getattr(args, "infer_values", False):
+        cache_dir = getattr(args, "ref_cache", None)
+        own_con = con is None
+        if own_con:
+            con = duckdb.connect(database=":memory:")
+        try:
+            candidates = rank_column_pairs(
+                con,
+                input_source or source_sql(con, args.input_file, cache_dir),
+                reference_source or source_sql(con, args.reference_file, cache_dir),
+                args.infer_sample,
+            )
+        finally:
+            if own_con:
+                con.close()
+        threshold = INFER_VALUES_THRESHOLD if args.infer_threshold is None else args.infer_threshold
+        pairs = select_column_pairs(candidates, threshold)
+        log_column_pairs(candidates)
+        if ranked is not None:
+            ranked.extend(candidates)
+        return pairs
+    # otherwise infer common columns (headers default to the input and reference files)
+    cache_dir = getattr(args, "ref_cache", None)
+    if input_cols is None:
+        input_cols = read_header(args.input_file, cache_dir)
+    if ref_cols is None:
+        ref_cols = read_header(args.reference_file, cache_dir)
     pairs = []
     # exact matches first
     for col in input_cols:
@@ -157,7 +772,7 @@ def build_join_pairs(args) -> List[str]:
                 if score > best_score:
                     best_score = score
                     best = ref
-            if best and best_score >= args.infer_threshold:
+            if best and best_score >= (0.7 if args.infer_threshold is None else args.infer_threshold):
                 pairs.append(f"{inp},{best}")
     return pairs
 
@@ -205,169 +820,1629 @@ def try_load_rapidfuzz(con: duckdb.DuckDBPyConnection) -> bool:
         return False
 
 
+# Levenshtein distance normalized by the longer string, the fallback for
+# Indel-based scorers when the rapidfuzz extension cannot be loaded.
+LEVENSHTEIN_SCORE_SQL = (
+    "(1.0 - CAST({distance}({a}, {b}) AS DOUBLE) / NULLIF(GREATEST(LENGTH({a}), LENGTH({b})),0)) * 100"
+)
+JARO_WINKLER_SCORE_SQL = "jaro_winkler_similarity({a}, {b}) * 100"
+
+# --scorer choices. ``sql`` is the score with the rapidfuzz extension and
+# ``fallback`` the score with DuckDB alone (None: not available); ``python``
+# is the rapidfuzz function of --engine cdist, whose scores times ``scale``
+# are 0-100. ``column`` is the preprocessed column compared: "clean",
+# "sorted" for the cleaned value with its tokens sorted once per distinct
+# value, so the pairwise stage only runs ``ratio``, or "tokset" for its
+# sorted distinct tokens, which leave token_set_ratio nothing to
+# deduplicate or reorder per pair. ``exact`` means a score
+# of 100 only for identical strings, which makes the exact-match pre-pass
+# lossless, and ``metric`` is the normalization used by
+# length_bound_conditions() with the extension (None: no length bound).
+Scorer = namedtuple("Scorer", ["sql", "fallback", "python", "scale", "column", "exact", "metric"])
+SCORERS = {
+    "ratio": Scorer("rapidfuzz_ratio({a}, {b})", LEVENSHTEIN_SCORE_SQL, "fuzz.ratio", 1, "clean", True, "indel"),
+    # token_set_ratio only sees the token sets, which "tokset" keeps
+    "token_set_ratio": Scorer(
+        "rapidfuzz_token_set_ratio({a}, {b})", None, "fuzz.token_set_ratio", 1, "tokset", False, None
+    ),
+    # ratio of the sorted tokens is exactly rapidfuzz's token_sort_ratio
+    "token_sort_ratio": Scorer("rapidfuzz_ratio({a}, {b})", LEVENSHTEIN_SCORE_SQL, "fuzz.ratio", 1, "sorted", True, "indel"),
+    "partial_ratio": Scorer("rapidfuzz_partial_ratio({a}, {b})", None, "fuzz.partial_ratio", 1, "clean", False, None),
+    "WRatio": Scorer(None, None, "fuzz.WRatio", 1, "clean", True, None),
+    "jaro_winkler": Scorer(
+        JARO_WINKLER_SCORE_SQL, JARO_WINKLER_SCORE_SQL, "JaroWinkler.normalized_similarity", 100, "clean", True, None
+    ),
+    # ratio without the levenshtein fallback: always Indel-normalized
+    "indel": Scorer("rapidfuzz_ratio({a}, {b})", None, "fuzz.ratio", 1, "clean", True, "indel"),
+}
+
+
+def sorted_tokens_sql(expr: str, distinct: bool = False) -> str:
+    """SQL for the whitespace-separated tokens of ``expr``, sorted and joined with one space.
+
+    The same string as ``" ".join(sorted(value.split()))``, which rapidfuzz's
+    ``token_sort_ratio`` compares with ``ratio``. With ``distinct`` each token
+    is kept once, as in the token sets of ``token_set_ratio``.
+    """
+    trimmed = f"regexp_replace({expr}, '^\\s+|\\s+$', '', 'g')"
+    tokens = f"string_split_regex({trimmed}, '\\s+')"
+    if distinct:
+        tokens = f"list_distinct({tokens})"
+    return f"array_to_string(list_sort({tokens}), ' ')"
+
+
+def score_column(scorer: str, column: str) -> str:
+    """Quoted preprocessed column that ``scorer`` compares for the join column ``column``."""
+    return f'"{column}_{SCORERS[scorer].column}"'
+
+
+def rapidfuzz_scorer(scorer: str) -> tuple:
+    """``(function, scale)`` of ``scorer`` for ``rapidfuzz.process``; scores times ``scale`` are 0-100."""
+    from rapidfuzz import distance, fuzz
+
+    spec = SCORERS[scorer]
+    module_name, function_name = spec.python.split(".", 1)
+    module = fuzz if module_name == "fuzz" else getattr(distance, module_name)
+    return getattr(module, function_name), spec.scale
+
+
 def choose_score_expr(
     using_rapidfuzz: bool,
     join_pairs: List[str],
     scorer: str,
     args: "argparse.Namespace",
     preprocessed: bool = False,
+    distance: str = "levenshtein",
 ) -> str:
-    import re
+    """Sum of the ``scorer`` scores of ``join_pairs`` as SQL, comparing ``ref`` with ``inp``.
 
-    # Fast-path: columns have already been normalised into *_clean aliases.
-    # Build the score expression by simply referencing those aliases so the
-    # CROSS JOIN only runs the distance function.
-    if preprocessed:
-        exprs: List[str] = []
-
-        if using_rapidfuzz:
-            score_func = 'rapidfuzz_token_set_ratio' if scorer == 'token_set_ratio' else 'rapidfuzz_ratio'
-            for pair in join_pairs:
-                inp_col, ref_col = [c.strip().replace('"', '').replace("'", "") for c in pair.split(",")]
-                exprs.append(f"{score_func}(ref.\"{ref_col}_clean\", inp.\"{inp_col}_clean\")")
-        else:
-            if scorer != 'ratio':
-                logging.error(f"The '{scorer}' scorer requires the rapidfuzz extension, which could not be loaded.")
-                sys.exit(1)
-            for pair in join_pairs:
-                inp_col, ref_col = [c.strip().replace('"', '').replace("'", "") for c in pair.split(",")]
-                exprs.append(
-                    f"(1.0 - CAST(levenshtein(ref.\"{ref_col}_clean\", inp.\"{inp_col}_clean\") AS DOUBLE) "
-                    f"/ NULLIF(GREATEST(LENGTH(ref.\"{ref_col}_clean\"), LENGTH(inp.\"{inp_col}_clean\")),0)) * 100"
-                )
-        return " + ".join(exprs)
-    # ...resto della funzione...
-        expr = base_expr
-        if not args.raw_whitespace:
-            expr = f"trim(regexp_replace({expr}, '\\s+', ' ', 'g'))"
-        if args.latinize:
-            expr = f"strip_accents({expr})"
-        return expr
+    Columns have already been normalised into the ``*_clean`` (or
+    ``*_sorted``/``*_tokset``) columns of ``input_keys``/``ref_preproc``, so the CROSS
+    JOIN only runs the distance function; ``preprocessed`` is kept for
+    compatibility. Without the rapidfuzz extension the DuckDB fallback is
+    used, with ``distance`` as the edit distance function. Raises
+    FuzzyJoinError when the scorer has no SQL form available.
+    """
+    spec = SCORERS[scorer]
+    template = spec.sql if using_rapidfuzz and spec.sql else spec.fallback
+    if template is None:
+        raise FuzzyJoinError(f"The '{scorer}' scorer requires the rapidfuzz extension, which could not be loaded.")
 
-    exprs = []
+    exprs: List[str] = []
+    for pair in join_pairs:
+        inp_col, ref_col = [c.strip().replace('"', '').replace("'", "") for c in pair.split(",")]
+        ref_expr = f"ref.{score_column(scorer, ref_col)}"
+        inp_expr = f"inp.{score_column(scorer, inp_col)}"
+        exprs.append(template.format(a=ref_expr, b=inp_expr, distance=distance))
+    return " + ".join(exprs)
 
-    # Determine if case sensitive (raw) or not
-    raw_case = getattr(args, "raw_case", False)
 
-    def maybe_lower(expr):
-        return expr if raw_case else f"LOWER({expr})"
+def length_bound_conditions(join_pairs: List[str], threshold: float, metric: str) -> List[str]:
+    """Build join conditions that discard pairs whose lengths alone rule out the threshold.
 
-    if using_rapidfuzz:
-        # Select the function name based on the scorer argument
-        if scorer == 'token_set_ratio':
-            score_func = 'rapidfuzz_token_set_ratio'
-        else: # default to 'ratio'
-            score_func = 'rapidfuzz_ratio'
+    An edit distance is at least the length difference, so a normalized score
+    can only reach ``t`` (0-1) when ``min(len) >= r * max(len)``, with
+    ``r = t`` for levenshtein-style scores (distance / max length) and
+    ``r = t / (2 - t)`` for the Indel-based ``ratio`` (distance / sum of
+    lengths). With several join pairs each pair only needs the score that
+    still lets the average reach the threshold, so the bound is derived per
+    pair from ``n * threshold - (n - 1) * 100``. Lengths are read from the
+    ``*_len`` columns of ``inp`` and ``ref``.
+    """
+    num_pairs = len(join_pairs)
+    pair_min = (num_pairs * threshold - (num_pairs - 1) * 100.0) / 100.0
+    if metric not in ('indel', 'levenshtein') or pair_min <= 0:
+        return []
+    pair_min = min(pair_min, 1.0)
+    ratio = pair_min / (2.0 - pair_min) if metric == 'indel' else pair_min
 
-        for pair in join_pairs:
-            inp, ref = pair.split(",")
-            inp = inp.replace('"', '').replace("'", '').strip()
-            ref = ref.replace('"', '').replace("'", '').strip()
+    conditions = []
+    for pair in join_pairs:
+        inp_col, ref_col = [c.strip().replace('"', '').replace("'", "") for c in pair.split(",")]
+        inp_len = f'inp."{inp_col}_len"'
+        ref_len = f'ref."{ref_col}_len"'
+        # Small tolerance so floating point rounding never drops a borderline pair
+        conditions.append(f"{ref_len} >= {inp_len} * {ratio!r} - 1e-9")
+        conditions.append(f"{ref_len} * {ratio!r} <= {inp_len} + 1e-9")
+    return conditions
 
-            inp_expr = clean_column_expr("inp", inp, args)
-            ref_expr = clean_column_expr("ref", ref, args)
 
-            exprs.append(f"{score_func}({maybe_lower(ref_expr)}, {maybe_lower(inp_expr)})")
-    else:
-        # Fallback logic without rapidfuzz
-        if scorer != 'ratio':
-            logging.error(f"The '{scorer}' scorer requires the rapidfuzz extension, which could not be loaded.")
-            sys.exit(1)
+def _combined_clean_expr(alias: str, columns: List[str]) -> str:
+    """Concatenate the cleaned join columns of ``alias`` into a single blocking string."""
+    return "concat_ws('|', " + ", ".join(f'{alias}."{c}_clean"' for c in columns) + ")"
 
-        for pair in join_pairs:
-            inp, ref = pair.split(",")
-            inp = inp.replace('"', '').replace("'", '').strip()
-            ref = ref.replace('"', '').replace("'", '').strip()
 
-            inp_expr = clean_column_expr("inp", inp, args)
-            ref_expr = clean_column_expr("ref", ref, args)
+def reference_index(con: duckdb.DuckDBPyConnection, spec: str, build) -> str:
+    """Name of the reference index temp table identified by ``spec``, built on first use.
 
-            # we will build an expression that computes: (1 - levenshtein/NULLIF(GREATEST(LENGTH(a), LENGTH(b)),0)) * 100
-            expr = (
-                f"(1.0 - CAST(levenshtein({maybe_lower(ref_expr)}, {maybe_lower(inp_expr)}) AS DOUBLE) / NULLIF(GREATEST(LENGTH({maybe_lower(ref_expr)}), LENGTH({maybe_lower(inp_expr)})),0)) * 100"
-            )
-            exprs.append(expr)
+    The reference side of a blocking pass (its N-grams, phonetic codes or
+    sort order) only depends on ``ref_preproc``, so it is kept in a
+    ``ref_index_*`` table and reused by every later chunk, batch file or
+    served request on ``con``; only the input side is rebuilt. ``spec`` must
+    identify the content (the SQL that builds it, or the pass and columns);
+    ``build(name)`` creates the table when it does not exist yet.
+    ``drop_pipeline()`` drops the indexes together with ``ref_preproc``.
+    """
+    import hashlib
 
-    # average
-    return " + ".join(exprs)
+    name = "ref_index_" + hashlib.md5(spec.encode("utf-8")).hexdigest()[:16]
+    exists = con.execute(
+        "SELECT COUNT(*) FROM duckdb_tables() WHERE temporary AND table_name = ?", [name]
+    ).fetchone()[0]
+    if not exists:
+        try:
+            build(name)
+        except BaseException:
+            # A partly built index must not be reused
+            con.execute(f"DROP TABLE IF EXISTS temp.{name};")
+            raise
+    return name
 
 
-def main():
-    args = parse_args()
+def reference_index_sql(con: duckdb.DuckDBPyConnection, sql: str) -> str:
+    """``reference_index()`` of the table ``sql`` selects."""
+    return reference_index(con, sql, lambda name: con.execute(f"CREATE TEMP TABLE {name} AS {sql};"))
 
-    # Configure logging
-    if args.quiet:
-        logging.basicConfig(level=logging.CRITICAL, format='%(levelname)s: %(message)s')
-    elif args.verbose == 1:
-        logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
-    elif args.verbose >= 2:
-        logging.basicConfig(level=logging.DEBUG, format='%(levelname)s: %(message)s')
-    else:
-        logging.basicConfig(level=logging.WARNING, format='%(levelname)s: %(message)s')
 
-    if '--help' in sys.argv or '-h' in sys.argv:
-        logging.info("\nExample:")
-        logging.info("  tometo_tomato input.csv ref.csv -j \"col1,col_ref1\" -j \"col2,col_ref2\" -a \"field_to_add1\" -a \"field_to_add2\" -o \"output_clean.csv\"")
-        logging.info("") # Add an empty line for better formatting
+def build_ngram_candidates(
+    con: duckdb.DuckDBPyConnection,
+    join_pairs: List[str],
+    args: "argparse.Namespace",
+    q: int = None,
+    pairs: List[str] = None,
+    table: str = "candidate_pairs",
+) -> int:
+    """Create the ``table`` temp table of candidate pairs with q-gram blocking.
 
-    # Build join pairs
-    join_pairs = build_join_pairs(args)
-    if not join_pairs:
-        logging.error("No join pair found. Exiting.")
-        sys.exit(1)
+    The cleaned join values of each input key and reference row are split into
+    distinct character N-grams (``--block-ngram``) and the reference N-grams
+    form an inverted index. Input keys probe the index only with N-grams found
+    in at most ``--block-ngram-max-df`` of the reference rows; keys made only
+    of frequent N-grams fall back to all of their N-grams, so they are never
+    left without candidates. A pair is a candidate when it shares at least one
+    probed N-gram. With a single join pair and the ``ratio`` scorer a count
+    filter derived from the threshold is applied too: ``k`` edits destroy at
+    most ``N * k`` N-grams, and a score of ``t`` allows at most
+    ``(1 - t/100) * (len(a) + len(b))`` edits.
 
-    # Verify that join pair columns exist in the actual datasets
-    input_cols = read_header(args.input_file)
-    ref_cols = read_header(args.reference_file)
+    ``q`` defaults to ``--block-ngram``; ``pairs`` restricts the blocking
+    string to a subset of ``join_pairs``. The reference N-grams and the
+    frequent ones are built once per connection (see ``reference_index()``).
 
-    for pair in join_pairs:
+    Returns the number of candidate pairs.
+    """
+    q = q or args.block_ngram
+    inp_cols = []
+    ref_cols = []
+    for pair in pairs or join_pairs:
         inp_col, ref_col = [c.strip().replace('"', '').replace("'", "") for c in pair.split(",")]
-        if inp_col not in input_cols:
-            logging.error(f"Column '{inp_col}' not found in input file. Available columns: {', '.join(input_cols)}")
-            sys.exit(1)
-        if ref_col not in ref_cols:
-            logging.error(f"Column '{ref_col}' not found in reference file. Available columns: {', '.join(ref_cols)}")
-            sys.exit(1)
+        inp_cols.append(inp_col)
+        ref_cols.append(ref_col)
 
+    def grams_sql(alias: str, id_col: str, source: str, columns: List[str]) -> str:
+        return f"""
+            SELECT DISTINCT {id_col}, substr(s, pos, {q}) AS gram
+            FROM (
+                SELECT {alias}.{id_col} AS {id_col}, s,
+                       unnest(range(1, greatest(length(s) - {q} + 2, 2))) AS pos
+                FROM (SELECT {alias}.*, {_combined_clean_expr(alias, columns)} AS s FROM {source} AS {alias}) AS {alias}
+                WHERE s <> ''
+            ) t
+        """
 
+    ref_grams = reference_index_sql(con, grams_sql('ref', 'ref_id', 'ref_preproc', ref_cols))
+    try:
+        con.execute(f"CREATE TEMP TABLE {table}_key_grams AS {grams_sql('inp', 'key_id', 'input_keys', inp_cols)};")
 
-    # prepare select clauses
-    add_fields = []
-    if args.add_field:
-        # The `action='append'` in argparse creates a list of all given fields.
-        add_fields = [a.strip() for a in args.add_field]
+        ref_count = con.execute("SELECT COUNT(*) FROM ref_preproc").fetchone()[0]
+        max_df = max(1, int(args.block_ngram_max_df * ref_count))
+        frequent_grams = reference_index_sql(
+            con, f"SELECT gram FROM {ref_grams} GROUP BY gram HAVING COUNT(*) > {max_df}"
+        )
+        frequent = con.execute(f"SELECT COUNT(*) FROM {frequent_grams}").fetchone()[0]
+        logging.debug(f"q-gram blocking: not probing with {frequent:,} N-grams found in more than {max_df:,} reference rows")
+        con.execute(f"""
+            CREATE TEMP TABLE {table}_probe_grams AS
+            WITH rare AS (
+                SELECT key_id, gram FROM {table}_key_grams
+                WHERE gram NOT IN (SELECT gram FROM {frequent_grams})
+            )
+            SELECT key_id, gram FROM rare
+            UNION ALL
+            SELECT key_id, gram FROM {table}_key_grams
+            WHERE key_id NOT IN (SELECT key_id FROM rare);
+        """)
 
-    select_clean_cols, select_ambiguous_cols, selected_input_cols_list = prepare_select_clauses(join_pairs, add_fields, args.show_score)
+        # Every probed N-gram of the key that survives the edits is found in the
+        # reference value, so n_probed - N * k is a lower bound of the shared count.
+        min_shared = "1"
+        if len(join_pairs) == 1 and args.scorer == 'ratio' and args.threshold > 0:
+            max_edits_ratio = max(0.0, 1.0 - args.threshold / 100.0)
+            min_shared = (
+                f"GREATEST(1, ks.n_probed "
+                f"- {q} * FLOOR({max_edits_ratio!r} * (ks.len + length({_combined_clean_expr('ref', ref_cols)})) + 1e-9))"
+            )
 
-    # For ambiguous output, use actual column names from the datasets
-    # Get all columns from input that are used in joins (using real column names)
-    actual_input_cols_used = []
-    for pair in join_pairs:
-        inp_col = pair.split(",")[0].strip().replace('"', '').replace("'", "")
-        actual_input_cols_used.append(inp_col)
-    actual_input_cols_used = list(set(actual_input_cols_used))  # Remove duplicates
+        con.execute(f"""
+            CREATE TEMP TABLE {table} AS
+            WITH shared AS (
+                SELECT pg.key_id, rg.ref_id, COUNT(*) AS n_shared
+                FROM {table}_probe_grams pg
+                JOIN {ref_grams} rg ON pg.gram = rg.gram
+                GROUP BY pg.key_id, rg.ref_id
+            ),
+            ks AS (
+                SELECT inp.key_id, COUNT(*) AS n_probed, length({_combined_clean_expr('inp', inp_cols)}) AS len
+                FROM input_keys inp JOIN {table}_probe_grams pg ON pg.key_id = inp.key_id
+                GROUP BY ALL
+            )
+            SELECT shared.key_id, shared.ref_id
+            FROM shared
+            JOIN ks ON ks.key_id = shared.key_id
+            JOIN ref_preproc ref ON ref.ref_id = shared.ref_id
+            WHERE shared.n_shared >= {min_shared};
+        """)
+    finally:
+        for suffix in ("key_grams", "probe_grams"):
+            con.execute(f"DROP TABLE IF EXISTS {table}_{suffix};")
+    candidates = con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    logging.debug(f"q-gram blocking (N={q}) produced {candidates:,} candidate pairs")
+    return candidates
 
-    # Build ambiguous output column list with actual column names
-    ambiguous_cols_list = []
-    # Input columns used in joins (prefix with inp.)
-    for col in actual_input_cols_used:
-        ambiguous_cols_list.append(f'inp."{col}"')
-    # Reference columns used in joins (prefix with s.)
-    for pair in join_pairs:
-        ref_col = pair.split(",")[1].strip().replace('"', '').replace("'", "")
-        ambiguous_cols_list.append(f's."{ref_col}"')
-    # Additional fields (prefix with s.)
-    if add_fields:
-        for f in add_fields:
-            ambiguous_cols_list.append(f's."{f}"')
-    if args.show_score:
-        ambiguous_cols_list.append('s.avg_score')
-    select_ambiguous_cols_fixed = ', '.join(ambiguous_cols_list)
 
-    con = duckdb.connect(database=":memory:")
+def build_phonetic_candidates(
+    con: duckdb.DuckDBPyConnection,
+    join_pairs: List[str],
+    args: "argparse.Namespace",
+    algorithm: str = None,
+    pairs: List[str] = None,
+    table: str = "candidate_pairs",
+) -> int:
+    """Create the ``table`` temp table of candidate pairs with phonetic blocking.
 
-    # Register UDF for latinization if needed
-    if args.latinize:
+    Each distinct cleaned value of the reference join columns is encoded once
+    per connection with the ``algorithm`` encoder (default
+    ``--block-phonetic``), and the blocking keys of the reference rows are
+    kept with the codes (see ``reference_index()``). Only the input values
+    missing from the reference codes are encoded on each call, into a
+    ``{table}_codes`` temp table. The blocking key of a record is the
+    concatenation of the codes of its join columns (or of the ``pairs``
+    subset), and pairs sharing the same key become candidates.
+
+    Returns the number of candidate pairs.
+    """
+    import numpy as np
+
+    algorithm = algorithm or args.block_phonetic
+    encode = PHONETIC_ENCODERS[algorithm]
+    inp_cols = []
+    ref_cols = []
+    for pair in pairs or join_pairs:
+        inp_col, ref_col = [c.strip().replace('"', '').replace("'", "") for c in pair.split(",")]
+        inp_cols.append(inp_col)
+        ref_cols.append(ref_col)
+
+    def encode_values(name: str, values_sql: str) -> int:
+        values = [row[0] for row in con.execute(values_sql).fetchall()]
+        con.execute(f"CREATE TEMP TABLE {name} (value VARCHAR, code VARCHAR);")
+        if values:
+            phonetic_codes = {
+                'value': np.array(values, dtype=object),
+                'code': np.array([encode(v) for v in values], dtype=object),
+            }
+            con.register('phonetic_codes_np', phonetic_codes)
+            try:
+                con.execute(f"INSERT INTO {name} SELECT * FROM phonetic_codes_np;")
+            finally:
+                con.unregister('phonetic_codes_np')
+        return len(values)
+
+    def phonetic_key_sql(alias: str, columns: List[str], codes: str) -> str:
+        joins = []
+        keys = []
+        for i, col in enumerate(columns):
+            joins.append(f'JOIN {codes} pc{i} ON pc{i}.value = {alias}."{col}_clean"')
+            keys.append(f"pc{i}.code")
+        return f"concat_ws('|', {', '.join(keys)})", " ".join(joins)
+
+    def build_ref_codes(name: str) -> None:
+        distinct_sql = " UNION ".join(f'SELECT "{c}_clean" AS value FROM ref_preproc' for c in ref_cols)
+        n_values = encode_values(name, f"SELECT value FROM ({distinct_sql}) WHERE value IS NOT NULL")
+        logging.debug(f"Phonetic blocking ({algorithm}): encoded {n_values:,} distinct reference values")
+
+    ref_codes = reference_index(con, f"phonetic:{algorithm}:{'|'.join(ref_cols)}", build_ref_codes)
+    ref_key, ref_joins = phonetic_key_sql('ref', ref_cols, ref_codes)
+    ref_keys = reference_index_sql(
+        con, f"SELECT ref.ref_id, {ref_key} AS phonetic_key FROM ref_preproc ref {ref_joins}"
+    )
+
+    try:
+        distinct_sql = " UNION ".join(f'SELECT "{c}_clean" AS value FROM input_keys' for c in inp_cols)
+        n_values = encode_values(
+            f"{table}_codes",
+            f"SELECT value FROM ({distinct_sql}) WHERE value IS NOT NULL AND value NOT IN (SELECT value FROM {ref_codes})",
+        )
+        logging.debug(f"Phonetic blocking ({algorithm}): encoded {n_values:,} distinct input values")
+
+        inp_key, inp_joins = phonetic_key_sql('inp', inp_cols, 'codes')
+        con.execute(f"""
+            CREATE TEMP TABLE {table} AS
+            WITH codes AS (
+                SELECT value, code FROM {ref_codes}
+                UNION ALL
+                SELECT value, code FROM {table}_codes
+            ),
+            ik AS (
+                SELECT inp.key_id, {inp_key} AS phonetic_key
+                FROM input_keys inp {inp_joins}
+            )
+            SELECT ik.key_id, rk.ref_id
+            FROM ik
+            JOIN {ref_keys} rk ON ik.phonetic_key = rk.phonetic_key
+            WHERE ik.phonetic_key <> '';
+        """)
+    finally:
+        con.execute(f"DROP TABLE IF EXISTS {table}_codes;")
+    candidates = con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    logging.debug(f"Phonetic blocking ({algorithm}) produced {candidates:,} candidate pairs")
+    return candidates
+
+
+def build_window_candidates(
+    con: duckdb.DuckDBPyConnection,
+    join_pairs: List[str],
+    args: "argparse.Namespace",
+    window: int = None,
+    reverse: bool = None,
+    pairs: List[str] = None,
+    table: str = "candidate_pairs",
+) -> int:
+    """Create the ``table`` temp table of candidate pairs with sorted-neighbourhood blocking.
+
+    Input keys and reference rows are sorted together on their combined
+    cleaned join values. Each input key is paired with the ``--block-window``
+    reference rows nearest to it in that order (half before, half after), so
+    candidate generation is O((n + m) * W) and no block can grow with a common
+    prefix. With ``--block-window-reverse`` a second pass sorts the reversed
+    strings, catching keys whose first characters are wrong. ``window`` and
+    ``reverse`` default to those options; ``pairs`` restricts the sort key to
+    a subset of ``join_pairs``. The sorted reference positions are built once
+    per connection (see ``reference_index()``); each call only sorts the
+    input keys among the distinct reference values.
+
+    Returns the number of candidate pairs.
+    """
+    window = window or args.block_window
+    reverse = args.block_window_reverse if reverse is None else reverse
+    before = (window + 1) // 2 - 1
+    after = window // 2
+    inp_cols = []
+    ref_cols = []
+    for pair in pairs or join_pairs:
+        inp_col, ref_col = [c.strip().replace('"', '').replace("'", "") for c in pair.split(",")]
+        inp_cols.append(inp_col)
+        ref_cols.append(ref_col)
+
+    def window_pass_sql(transform: str) -> str:
+        inp_sort = transform.format(_combined_clean_expr('inp', inp_cols))
+        ref_sort = transform.format(_combined_clean_expr('ref', ref_cols))
+        ref_order = reference_index_sql(con, f"""
+            SELECT id, s, SUM(1) OVER (ORDER BY s, id ROWS UNBOUNDED PRECEDING) AS ref_pos
+            FROM (SELECT ref.ref_id AS id, {ref_sort} AS s FROM ref_preproc ref) refs
+            WHERE s <> ''
+        """)
+        ref_bounds = reference_index_sql(con, f"SELECT s, MAX(ref_pos) AS ref_pos FROM {ref_order} GROUP BY s")
+        # ref_pos counts the reference rows sorted at or before each input key:
+        # the last position of the reference values up to its own. References
+        # sort before inputs with the same value so exact matches fall inside
+        # the window.
+        return f"""
+            SELECT i.id AS key_id, r.id AS ref_id
+            FROM (
+                SELECT id, is_ref,
+                       COALESCE(MAX(ref_pos) OVER (ORDER BY s, is_ref DESC ROWS UNBOUNDED PRECEDING), 0) AS ref_pos
+                FROM (
+                    SELECT inp.key_id AS id, 0 AS is_ref, {inp_sort} AS s, NULL AS ref_pos FROM input_keys inp
+                    UNION ALL
+                    SELECT NULL AS id, 1 AS is_ref, s, ref_pos FROM {ref_bounds}
+                ) keys
+                WHERE s <> ''
+            ) i
+            JOIN {ref_order} r ON r.ref_pos BETWEEN i.ref_pos - {before} AND i.ref_pos + {after}
+            WHERE i.is_ref = 0
+        """
+
+    passes = [window_pass_sql("{}")]
+    if reverse:
+        passes.append(window_pass_sql("reverse({})"))
+    con.execute(f"CREATE TEMP TABLE {table} AS {' UNION '.join(passes)};")
+    candidates = con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    logging.debug(f"Sorted-neighbourhood blocking (window {window}) produced {candidates:,} candidate pairs")
+    return candidates
+
+
+def build_prefix_candidates(
+    con: duckdb.DuckDBPyConnection,
+    join_pairs: List[str],
+    args: "argparse.Namespace",
+    size: int = None,
+    pairs: List[str] = None,
+    table: str = "candidate_pairs",
+) -> int:
+    """Create the ``table`` temp table of candidate pairs sharing a prefix block key.
+
+    Same key as ``--block-prefix`` (first ``size`` characters of each cleaned
+    join column, joined with ``'|'``), optionally built on a ``pairs`` subset
+    of ``join_pairs``. Used when prefix blocking is one of several passes,
+    or with ``--block-max-pairs``: a block whose input keys x reference rows
+    exceed the cap is split by keying its rows on one more character, until
+    every block fits or the prefix covers the whole values. The split works
+    in ``{table}_*`` helper tables, so passes writing different tables never
+    share them.
+
+    Returns the number of candidate pairs.
+    """
+    size = size or args.block_prefix
+    inp_cols = []
+    ref_cols = []
+    for pair in pairs or join_pairs:
+        inp_col, ref_col = [c.strip().replace('"', '').replace("'", "") for c in pair.split(",")]
+        inp_cols.append(inp_col)
+        ref_cols.append(ref_col)
+
+    def inp_key(length: int) -> str:
+        return " || '|' || ".join(f'substr(inp."{c}_clean", 1, {length})' for c in inp_cols)
+
+    def ref_key(length: int) -> str:
+        return " || '|' || ".join(f'substr(ref."{c}_clean", 1, {length})' for c in ref_cols)
+
+    if not args.block_max_pairs:
+        con.execute(f"""
+            CREATE TEMP TABLE {table} AS
+            SELECT inp.key_id, ref.ref_id
+            FROM input_keys inp
+            JOIN ref_preproc ref ON {inp_key(size)} = {ref_key(size)};
+        """)
+        candidates = con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        logging.debug(f"Prefix blocking (N={size}) produced {candidates:,} candidate pairs")
+        return candidates
+
+    # Blocks are measured on the distinct keys and the reference, then the
+    # oversized ones are re-keyed one character longer. Every refined key
+    # extends its parent's key, so blocks of different parents never merge.
+    try:
+        con.execute(f"CREATE TEMP TABLE {table}_prefix_blocks_inp AS SELECT inp.key_id, {inp_key(size)} AS block_key FROM input_keys inp;")
+        con.execute(f"CREATE TEMP TABLE {table}_prefix_blocks_ref AS SELECT ref.ref_id, {ref_key(size)} AS block_key FROM ref_preproc ref;")
+        max_length = con.execute(f"""
+            SELECT GREATEST(
+                (SELECT MAX(GREATEST({', '.join(f'length(inp."{c}_clean")' for c in inp_cols)})) FROM input_keys inp),
+                (SELECT MAX(GREATEST({', '.join(f'length(ref."{c}_clean")' for c in ref_cols)})) FROM ref_preproc ref)
+            )
+        """).fetchone()[0] or 0
+        oversized_sql = f"""
+            SELECT i.block_key, i.n * r.n AS pairs
+            FROM (SELECT block_key, COUNT(*) AS n FROM {table}_prefix_blocks_inp GROUP BY ALL) i
+            JOIN (SELECT block_key, COUNT(*) AS n FROM {table}_prefix_blocks_ref GROUP BY ALL) r ON r.block_key = i.block_key
+            WHERE i.n * r.n > {int(args.block_max_pairs)}
+        """
+        length = size
+        split_blocks = 0
+        while True:
+            con.execute(f"CREATE OR REPLACE TEMP TABLE {table}_oversized_blocks AS {oversized_sql};")
+            n_oversized, oversized_pairs = con.execute(f"SELECT COUNT(*), COALESCE(SUM(pairs), 0) FROM {table}_oversized_blocks").fetchone()
+            if not n_oversized or length >= max_length:
+                break
+            split_blocks += n_oversized
+            length += 1
+            con.execute(f"""
+                UPDATE {table}_prefix_blocks_inp SET block_key = {inp_key(length)}
+                FROM input_keys inp
+                WHERE inp.key_id = {table}_prefix_blocks_inp.key_id
+                  AND {table}_prefix_blocks_inp.block_key IN (SELECT block_key FROM {table}_oversized_blocks);
+            """)
+            con.execute(f"""
+                UPDATE {table}_prefix_blocks_ref SET block_key = {ref_key(length)}
+                FROM ref_preproc ref
+                WHERE ref.ref_id = {table}_prefix_blocks_ref.ref_id
+                  AND {table}_prefix_blocks_ref.block_key IN (SELECT block_key FROM {table}_oversized_blocks);
+            """)
+
+        con.execute(f"""
+            CREATE TEMP TABLE {table} AS
+            SELECT i.key_id, r.ref_id
+            FROM {table}_prefix_blocks_inp i
+            JOIN {table}_prefix_blocks_ref r ON r.block_key = i.block_key;
+        """)
+    finally:
+        for suffix in ("prefix_blocks_inp", "prefix_blocks_ref", "oversized_blocks"):
+            con.execute(f"DROP TABLE IF EXISTS {table}_{suffix};")
+    candidates = con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    logging.info(
+        f"Prefix blocking (N={size}): {split_blocks:,} block splits over --block-max-pairs "
+        f"{args.block_max_pairs:,} (prefixes up to {length} characters), {candidates:,} candidate pairs"
+    )
+    if n_oversized:
+        logging.warning(
+            f"{n_oversized:,} prefix blocks still exceed --block-max-pairs {args.block_max_pairs:,} "
+            f"with whole values as keys; {oversized_pairs:,} candidate pairs remain in them"
+        )
+    return candidates
+
+
+# Scorers for which a score of 100 means the compared strings are identical,
+# so the exact-match pre-pass cannot change the result.
+EXACT_PREPASS_SCORERS = tuple(name for name, spec in SCORERS.items() if spec.exact)
+
+BLOCK_PASS_KINDS = ("prefix", "ngram", "phonetic", "window", "window-reverse")
+
+
+def parse_block_spec(spec: str, join_pairs: List[str]) -> dict:
+    """Parse a ``--block`` pass specification ``KIND:VALUE[:COLUMN]``.
+
+    ``KIND`` is one of ``BLOCK_PASS_KINDS``; ``VALUE`` is the prefix length,
+    N-gram size, window size or phonetic algorithm. ``COLUMN`` restricts the
+    pass to the join pair that uses that input or reference column. Raises
+    ``ValueError`` on an invalid specification.
+    """
+    parts = [p.strip() for p in spec.split(":", 2)]
+    if len(parts) < 2 or parts[0] not in BLOCK_PASS_KINDS:
+        raise ValueError(
+            f"Invalid --block '{spec}'. Expected KIND:VALUE[:COLUMN] with KIND one of {', '.join(BLOCK_PASS_KINDS)}."
+        )
+    kind, value = parts[0], parts[1]
+    block_pass = {"kind": kind, "pairs": None}
+    if kind == "phonetic":
+        if value not in PHONETIC_ENCODERS:
+            raise ValueError(f"Invalid --block '{spec}': phonetic algorithm must be one of {', '.join(sorted(PHONETIC_ENCODERS))}.")
+        block_pass["algorithm"] = value
+    else:
+        try:
+            block_pass["size"] = int(value)
+        except ValueError:
+            block_pass["size"] = 0
+        if block_pass["size"] <= 0:
+            raise ValueError(f"Invalid --block '{spec}': {value!r} is not a positive integer.")
+    if len(parts) == 3:
+        column = parts[2]
+        selected = [
+            pair for pair in join_pairs
+            if column in [c.strip().replace('"', '').replace("'", "") for c in pair.split(",")]
+        ]
+        if not selected:
+            raise ValueError(f"Invalid --block '{spec}': column '{column}' is not used in any join pair.")
+        block_pass["pairs"] = selected
+    return block_pass
+
+
+def blocking_passes(args: "argparse.Namespace", join_pairs: List[str]) -> List[dict]:
+    """Collect the blocking passes requested with the single-mode flags and ``--block``."""
+    passes = []
+    if args.block_prefix and args.block_prefix > 0:
+        passes.append({"kind": "prefix", "size": args.block_prefix, "pairs": None})
+    if args.block_ngram and args.block_ngram > 0:
+        passes.append({"kind": "ngram", "size": args.block_ngram, "pairs": None})
+    if args.block_phonetic:
+        passes.append({"kind": "phonetic", "algorithm": args.block_phonetic, "pairs": None})
+    if args.block_window and args.block_window > 0:
+        kind = "window-reverse" if args.block_window_reverse else "window"
+        passes.append({"kind": kind, "size": args.block_window, "pairs": None})
+    for spec in args.block or []:
+        passes.append(parse_block_spec(spec, join_pairs))
+    return passes
+
+
+def build_candidates(
+    con: duckdb.DuckDBPyConnection,
+    join_pairs: List[str],
+    args: "argparse.Namespace",
+    passes: List[dict],
+    table: str = "candidate_pairs",
+    profile: dict = None,
+) -> int:
+    """Run every blocking pass and union their candidates into ``table``.
+
+    Each pass writes its own ``{table}_<n>`` table; the union removes the
+    pairs found by more than one pass, so each ``(key_id, ref_id)`` pair is
+    scored once. With a ``profile``, the pairs of each pass are counted in it.
+
+    Returns the number of distinct candidate pairs.
+    """
+    pass_tables = []
+    try:
+        for i, block_pass in enumerate(passes):
+            pass_table = table if len(passes) == 1 else f"{table}_{i + 1}"
+            kind = block_pass["kind"]
+            if kind == "prefix":
+                build_prefix_candidates(con, join_pairs, args, block_pass["size"], block_pass["pairs"], pass_table)
+            elif kind == "ngram":
+                build_ngram_candidates(con, join_pairs, args, block_pass["size"], block_pass["pairs"], pass_table)
+            elif kind == "phonetic":
+                build_phonetic_candidates(con, join_pairs, args, block_pass["algorithm"], block_pass["pairs"], pass_table)
+            else:
+                build_window_candidates(
+                    con, join_pairs, args, block_pass["size"], kind == "window-reverse", block_pass["pairs"], pass_table
+                )
+            pass_tables.append(pass_table)
+            if profile is not None:
+                label = f"{kind}:{block_pass.get('size', block_pass.get('algorithm'))}"
+                if block_pass["pairs"]:
+                    label += f" ({'; '.join(block_pass['pairs'])})"
+                profile_rows(profile, f"candidate_pairs[{label}]", con.execute(f"SELECT COUNT(*) FROM {pass_table}").fetchone()[0])
+
+        if len(pass_tables) > 1:
+            union_sql = " UNION ".join(f"SELECT key_id, ref_id FROM {t}" for t in pass_tables)
+            con.execute(f"CREATE TEMP TABLE {table} AS {union_sql};")
+    finally:
+        # The pass tables of a multi-pass union, also when a pass fails
+        if len(passes) > 1:
+            for i in range(len(passes)):
+                con.execute(f"DROP TABLE IF EXISTS {table}_{i + 1};")
+    candidates = con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    profile_rows(profile, "candidate_pairs", candidates)
+    if len(pass_tables) > 1:
+        logging.debug(f"{len(pass_tables)} blocking passes produced {candidates:,} distinct candidate pairs")
+    return candidates
+
+
+REF_CACHE_VERSION = 3
+
+
+def file_sha256(path: str) -> str:
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def ref_cache_path(args: "argparse.Namespace", join_pairs: List[str]) -> str:
+    """Return the cache file for the normalized reference of this run.
+
+    The key combines the reference content hash, the reference join columns
+    (in pair order, as they build the block key), the ``--add-field`` columns
+    (only those are read from the reference) and every flag that changes the
+    ``ref_preproc`` columns, including a scorer that compares sorted tokens.
+    """
+    import hashlib
+    import json
+
+    ref_cols = [pair.split(",")[1].strip().replace('"', '').replace("'", "") for pair in join_pairs]
+    key = {
+        "version": REF_CACHE_VERSION,
+        "reference_sha256": file_sha256(args.reference_file),
+        "ref_cols": ref_cols,
+        "add_fields": [a.strip() for a in args.add_field or []],
+        "raw_case": bool(args.raw_case),
+        "raw_whitespace": bool(args.raw_whitespace),
+        "latinize": bool(args.latinize),
+        "keep_alphanumeric": bool(args.keep_alphanumeric),
+        "block_prefix": args.block_prefix or 0,
+    }
+    if SCORERS[args.scorer].column != "clean":
+        # The extra compared column, and the lengths measured on it
+        key["score_column"] = SCORERS[args.scorer].column
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+    return os.path.join(args.ref_cache, f"ref_{digest[:32]}.parquet")
+
+
+def evict_ref_cache(cache_dir: str, max_bytes: float, keep: str) -> None:
+    """Delete least recently used cache entries until the directory fits in ``max_bytes``.
+
+    The entries are the prepared references and the sniffed CSV dialects.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if (name.startswith("ref_") and name.endswith(".parquet")) or (name.startswith("csv_") and name.endswith(".json")):
+            path = os.path.join(cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        try:
+            os.remove(path)
+            total -= size
+            logging.debug(f"Evicted reference cache entry: {path}")
+        except OSError as e:
+            logging.debug(f"Could not evict reference cache entry {path}: {e}")
+
+
+CHECKPOINT_VERSION = 2
+
+# Options that do not change the matching result; a checkpoint written with
+# different values for them can still be resumed.
+CHECKPOINT_IGNORED_OPTIONS = (
+    "output_clean", "output_ambiguous", "ref_cache", "ref_cache_size",
+    "resume", "workers", "threads", "memory_limit", "temp_directory", "verbose", "quiet", "force", "profile",
+    "estimate", "max_pairs", "max_seconds", "max_memory", "state",
+)
+
+
+def run_fingerprint(args: "argparse.Namespace", join_pairs: List[str]) -> str:
+    """Hash the input and reference content plus every option that changes the result."""
+    import hashlib
+    import json
+
+    options = {k: v for k, v in sorted(vars(args).items()) if k not in CHECKPOINT_IGNORED_OPTIONS}
+    key = {
+        "version": CHECKPOINT_VERSION,
+        "input_sha256": file_sha256(args.input_file),
+        "reference_sha256": file_sha256(args.reference_file),
+        "join_pairs": join_pairs,
+        "options": {k: v for k, v in options.items() if k not in ("input_file", "reference_file")},
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def load_checkpoint(parts_dir: str, fingerprint: str, resume: bool) -> dict:
+    """Return the checkpoint of a chunked run, starting a new one unless resuming.
+
+    Raises ValueError when resuming a run made with different files or options.
+    """
+    import json
+
+    checkpoint_file = os.path.join(parts_dir, "checkpoint.json")
+    if resume and os.path.exists(checkpoint_file):
+        with open(checkpoint_file, encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("fingerprint") != fingerprint:
+            raise ValueError(
+                f"Checkpoint {checkpoint_file} was written for different input/reference files or options. "
+                "Run without --resume to start over."
+            )
+        return checkpoint
+    if resume:
+        logging.info(f"No checkpoint found in {parts_dir}, starting from the first chunk")
+    if os.path.isdir(parts_dir):
+        shutil.rmtree(parts_dir)
+    os.makedirs(parts_dir)
+    return {"fingerprint": fingerprint, "completed": {}}
+
+
+def write_checkpoint(parts_dir: str, checkpoint: dict) -> None:
+    """Atomically record the finished chunks (chunk id -> ambiguous key count)."""
+    import json
+
+    checkpoint_file = os.path.join(parts_dir, "checkpoint.json")
+    with open(f"{checkpoint_file}.tmp", "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(f"{checkpoint_file}.tmp", checkpoint_file)
+
+
+STATE_VERSION = 1
+
+# Options that do not change the match of a key; a --state written with
+# different values for them is still valid. The join pairs are part of the
+# fingerprint, so the options that only infer them are left out.
+STATE_IGNORED_OPTIONS = CHECKPOINT_IGNORED_OPTIONS + (
+    "input_file", "output_format", "chunk_size", "show_score",
+    "infer_pairs", "infer_threshold", "infer_values", "infer_sample",
+)
+
+
+def state_fingerprint(args: "argparse.Namespace", plan: dict) -> str:
+    """Hash the reference content, the join pairs and every option that changes the match of a key."""
+    import hashlib
+    import json
+
+    key = {
+        "version": STATE_VERSION,
+        "tometo_tomato_version": __version__,
+        "reference_sha256": file_sha256(args.reference_file),
+        "join_pairs": plan["join_pairs"],
+        "using_rapidfuzz": plan["using_rapidfuzz"],
+        "options": {
+            k: v for k, v in sorted(vars(args).items()) if k not in STATE_IGNORED_OPTIONS and k != "reference_file"
+        },
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def load_state(con: duckdb.DuckDBPyConnection, args: "argparse.Namespace", plan: dict) -> None:
+    """Load the ``--state`` of the previous run, when it is still valid, as ``state_keys``/``state_matches``.
+
+    The state holds the hash of every distinct cleaned key the previous run
+    matched and its ``key_matches`` rows; ``prepare_keys()`` then only
+    matches the keys it does not know. A state written for another
+    reference file, other join pairs or other matching options is ignored,
+    and replaced by ``save_state()`` at the end of the run.
+    """
+    import json
+
+    fingerprint = state_fingerprint(args, plan)
+    plan["state"] = {"dir": args.state, "fingerprint": fingerprint, "loaded": False, "recorded": False}
+    state_file = os.path.join(args.state, "state.json")
+    if not os.path.exists(state_file):
+        logging.info(f"No state in {args.state}, matching every key")
+        return
+    with open(state_file, encoding="utf-8") as f:
+        state = json.load(f)
+    if state.get("fingerprint") != fingerprint:
+        logging.info(f"The state in {args.state} was written for a different reference or options, matching every key")
+        return
+    con.execute(f"CREATE TEMP TABLE state_keys AS SELECT * FROM read_parquet('{os.path.join(args.state, 'keys.parquet')}');")
+    con.execute(
+        f"CREATE TEMP VIEW state_matches AS SELECT * FROM read_parquet('{os.path.join(args.state, 'matches.parquet')}');"
+    )
+    plan["state"]["loaded"] = True
+    logging.info(f"State loaded from {args.state}: {state['keys']:,} keys of the previous run")
+
+
+def record_state(con: duckdb.DuckDBPyConnection, plan: dict) -> None:
+    """Add the keys and ``key_matches`` rows of the current scope to the next ``--state``."""
+    matches_sql = """
+        SELECT kh.key_hash, km.* EXCLUDE (key_id)
+        FROM key_matches km
+        JOIN key_hashes kh ON kh.key_id = km.key_id
+    """
+    if plan["state"]["recorded"]:
+        con.execute("INSERT INTO state_next_keys SELECT key_hash FROM key_hashes;")
+        con.execute(f"INSERT INTO state_next_matches BY NAME {matches_sql};")
+    else:
+        con.execute("CREATE TEMP TABLE state_next_keys AS SELECT key_hash FROM key_hashes;")
+        con.execute(f"CREATE TEMP TABLE state_next_matches AS {matches_sql};")
+        plan["state"]["recorded"] = True
+
+
+def save_state(con: duckdb.DuckDBPyConnection, plan: dict) -> None:
+    """Replace the ``--state`` directory with the keys and matches of this run.
+
+    ``state.json`` is removed first and written last, so an interrupted
+    write leaves no state rather than a partial one.
+    """
+    import json
+
+    state = plan["state"]
+    if not state["recorded"]:
+        return
+    state_dir = state["dir"]
+    os.makedirs(state_dir, exist_ok=True)
+    state_file = os.path.join(state_dir, "state.json")
+    if os.path.exists(state_file):
+        os.remove(state_file)
+    # A key seen in several chunks is recorded once per chunk, with the same rows
+    for name, query in (
+        ("keys", "SELECT DISTINCT key_hash FROM state_next_keys"),
+        ("matches", "SELECT DISTINCT * FROM state_next_matches"),
+    ):
+        path = os.path.join(state_dir, f"{name}.parquet")
+        con.execute(f"COPY ({query}) TO '{path}.tmp' (FORMAT PARQUET);")
+        os.replace(f"{path}.tmp", path)
+    n_keys = con.execute("SELECT COUNT(DISTINCT key_hash) FROM state_next_keys").fetchone()[0]
+    with open(f"{state_file}.tmp", "w", encoding="utf-8") as f:
+        json.dump({"version": STATE_VERSION, "fingerprint": state["fingerprint"], "keys": n_keys}, f)
+    os.replace(f"{state_file}.tmp", state_file)
+    logging.info(f"State saved to {state_dir}: {n_keys:,} keys")
+
+
+def concat_parts(con: duckdb.DuckDBPyConnection, parts: List[str], target: str, fmt: str = "csv") -> None:
+    """Concatenate chunk part files, in order, into ``target``."""
+    if fmt == "parquet":
+        files = ", ".join(f"'{part}'" for part in parts)
+        con.execute(f"COPY (SELECT * FROM read_parquet([{files}])) TO '{target}' (FORMAT PARQUET);")
+    elif fmt == "arrow":
+        pa = _import_pyarrow()
+        schema = pa.ipc.open_file(parts[0]).schema
+        with pa.ipc.new_file(target, schema) as writer:
+            for part in parts:
+                reader = pa.ipc.open_file(part)
+                for i in range(reader.num_record_batches):
+                    writer.write_batch(reader.get_batch(i))
+    else:
+        concat_csv_parts(parts, target)
+
+
+def concat_csv_parts(parts: List[str], target: str) -> None:
+    """Concatenate CSV part files that share a header, keeping the header once.
+
+    Raises ``ValueError`` when a part's header differs from the first one.
+    """
+    header = None
+    with open(target, "wb") as out:
+        for part in parts:
+            with open(part, "rb") as f:
+                line = f.readline()
+                if header is None:
+                    header = line
+                    out.write(line)
+                elif line != header:
+                    raise ValueError(
+                        f"Cannot concatenate {part}: its header differs from the first part's "
+                        f"({line.decode(errors='replace').strip()!r} != {header.decode(errors='replace').strip()!r})"
+                    )
+                shutil.copyfileobj(f, out)
+
+
+def score_keys_cdist(
+    con: duckdb.DuckDBPyConnection,
+    join_pairs: List[str],
+    args: "argparse.Namespace",
+    candidate_table: str = None,
+    keys_table: str = "input_keys",
+    pair_order: List[int] = None,
+) -> int:
+    """Score ``input_keys`` (or ``keys_table``) against ``ref_preproc`` in-process with rapidfuzz.
+
+    The distinct cleaned values of each join column are compared with
+    ``rapidfuzz.process.cdist`` (all cores), in chunks of input keys and,
+    with ``--block-prefix``, block by block. When ``candidate_table`` names a
+    table of ``(key_id, ref_id)`` candidate pairs, only those pairs are
+    scored, with ``rapidfuzz.process.cpdist``. Only the pairs whose average
+    score reaches the threshold are written to the ``cdist_scores`` temp
+    table as ``(key_id, ref_id, avg_score)``.
+
+    Join pairs are scored one at a time in ``pair_order`` (default: the
+    declared order). After each one, the pairs whose partial sum is below
+    ``stage_cutoff()`` are dropped, and the next scorer only sees the
+    survivors, with a ``score_cutoff`` of the smallest score a survivor
+    still needs.
+
+    Returns the number of surviving pairs.
+    """
+    import numpy as np
+    from rapidfuzz import process
+
+    scorer_func, scale = rapidfuzz_scorer(args.scorer)
+    num_pairs = len(join_pairs)
+    order = pair_order or list(range(num_pairs))
+    use_blocks = bool(args.block_prefix and args.block_prefix > 0)
+
+    inp_clean_cols = []
+    ref_clean_cols = []
+    for pair in join_pairs:
+        inp_col, ref_col = [c.strip().replace('"', '').replace("'", "") for c in pair.split(",")]
+        inp_clean_cols.append(score_column(args.scorer, inp_col))
+        ref_clean_cols.append(score_column(args.scorer, ref_col))
+    block_col = ', block_key' if use_blocks else ''
+
+    # A single pair below this score can no longer lift the average to the threshold.
+    pair_cutoff = max(0.0, stage_cutoff(num_pairs, 1, args.threshold))
+
+    def survivors(k: int, pair_scores, partial, valid):
+        """Mask of the pairs still able to reach the threshold after the ``k``-th scored join pair."""
+        need = stage_cutoff(num_pairs, k, args.threshold)
+        if pair_cutoff > 0:
+            valid &= pair_scores >= pair_cutoff - 1e-9
+        if need > 0:
+            valid &= partial >= need - 1e-9
+        return valid
+
+    def next_cutoff(k: int, partial) -> float:
+        """``score_cutoff`` for the ``k``-th scored join pair: the least any survivor still needs.
+
+        In the scorer's own scale and slightly lowered, as rapidfuzz can
+        return 0 for a score equal to the cutoff; ``survivors()`` decides.
+        """
+        cutoff = pair_cutoff
+        if partial is not None and partial.size:
+            cutoff = max(pair_cutoff, stage_cutoff(num_pairs, k, args.threshold) - float(partial.max()))
+        return max(0.0, cutoff / scale - 1e-6)
+
+    key_ids_out = []
+    ref_ids_out = []
+    scores_out = []
+
+    if candidate_table:
+        res = con.execute(f"""
+            SELECT cp.key_id, cp.ref_id,
+                   {', '.join(f'inp.{c}' for c in inp_clean_cols)},
+                   {', '.join(f'ref.{c}' for c in ref_clean_cols)}
+            FROM {candidate_table} cp
+            JOIN {keys_table} inp ON inp.key_id = cp.key_id
+            JOIN ref_preproc ref ON ref.ref_id = cp.ref_id
+        """)
+        while True:
+            batch = res.fetchmany(1_000_000)
+            if not batch:
+                break
+            alive = np.arange(len(batch))
+            partial = None
+            stage_scores = {}
+            for k, p in enumerate(order, 1):
+                queries = [batch[i][2 + p] for i in alive]
+                choices = [batch[i][2 + num_pairs + p] for i in alive]
+                valid = np.array([a is not None and b is not None for a, b in zip(queries, choices)], dtype=bool)
+                pair_scores = process.cpdist(
+                    ["" if a is None else a for a in queries],
+                    ["" if b is None else b for b in choices],
+                    scorer=scorer_func,
+                    score_cutoff=next_cutoff(k, partial),
+                    dtype=np.float64,
+                    workers=-1,
+                ) * scale
+                partial = pair_scores if partial is None else partial + pair_scores
+                keep = survivors(k, pair_scores, partial, valid)
+                stage_scores[p] = pair_scores
+                alive, partial = alive[keep], partial[keep]
+                stage_scores = {q: scores[keep] for q, scores in stage_scores.items()}
+            # Summed in the declared pair order, like the SQL engine
+            total = np.zeros(len(alive), dtype=np.float64)
+            for p in range(num_pairs):
+                total += stage_scores[p]
+            avg = total / num_pairs
+            keep = avg >= args.threshold
+            key_ids_out.append(np.array([batch[i][0] for i in alive[keep]], dtype=np.int64))
+            ref_ids_out.append(np.array([batch[i][1] for i in alive[keep]], dtype=np.int64))
+            scores_out.append(avg[keep])
+        return _store_cdist_scores(con, key_ids_out, ref_ids_out, scores_out, args.threshold)
+
+    input_rows = con.execute(
+        f"SELECT key_id, {', '.join(inp_clean_cols)}{block_col} FROM {keys_table}"
+    ).fetchall()
+    ref_rows = con.execute(
+        f"SELECT ref_id, {', '.join(ref_clean_cols)}{block_col} FROM ref_preproc"
+    ).fetchall()
+
+    def group_by_block(rows):
+        groups = {}
+        for row in rows:
+            groups.setdefault(row[-1] if use_blocks else None, []).append(row)
+        return groups
+
+    input_blocks = group_by_block(input_rows)
+    ref_blocks = group_by_block(ref_rows)
+
+    for block, block_refs in ref_blocks.items():
+        block_inputs = input_blocks.get(block)
+        if not block_inputs:
+            continue
+        ref_ids = np.array([r[0] for r in block_refs], dtype=np.int64)
+
+        # Score distinct reference values only, then expand to reference rows.
+        # Missing values point at an extra, always-invalid column.
+        choices_per_pair = []
+        for p in range(num_pairs):
+            distinct = {}
+            index = []
+            for r in block_refs:
+                value = r[p + 1]
+                index.append(-1 if value is None else distinct.setdefault(value, len(distinct)))
+            index = np.array(index, dtype=np.int64)
+            index[index == -1] = len(distinct)
+            choices_per_pair.append((list(distinct), index))
+
+        # The first join pair expands its scores to every reference row of the
+        # block, so the chunk is sized on that width, not on the distinct values
+        chunk_rows = max(1, 4_000_000 // (len(block_refs) + 1))
+        for start in range(0, len(block_inputs), chunk_rows):
+            chunk = block_inputs[start:start + chunk_rows]
+            # Surviving (input, reference) positions; None until the first join pair is scored
+            rows = cols = partial = None
+            stage_scores = {}
+            for k, p in enumerate(order, 1):
+                choices, index = choices_per_pair[p]
+                queries = [row[p + 1] for row in chunk]
+                missing = np.array([q is None for q in queries], dtype=bool)
+                cutoff = next_cutoff(k, partial)
+                if rows is not None and rows.size < len(chunk) * (len(choices) + 1):
+                    # Fewer survivors than matrix cells: score the survivors alone
+                    values = np.array(choices + [""], dtype=object)[index[cols]]
+                    pair_scores = process.cpdist(
+                        ["" if queries[i] is None else queries[i] for i in rows],
+                        values.tolist(),
+                        scorer=scorer_func,
+                        score_cutoff=cutoff,
+                        dtype=np.float64,
+                        workers=-1,
+                    ) * scale
+                else:
+                    matrix = np.zeros((len(chunk), len(choices) + 1), dtype=np.float64)
+                    if choices:
+                        matrix[:, :-1] = process.cdist(
+                            ["" if q is None else q for q in queries],
+                            choices,
+                            scorer=scorer_func,
+                            score_cutoff=cutoff,
+                            dtype=np.float64,
+                            workers=-1,
+                        ) * scale
+                    if rows is None:
+                        # First join pair: filter the whole chunk x block matrix
+                        pair_scores = matrix[:, index]
+                        valid = (index[np.newaxis, :] != len(choices)) & ~missing[:, np.newaxis]
+                        rows, cols = np.nonzero(survivors(k, pair_scores, pair_scores, valid))
+                        partial = pair_scores[rows, cols]
+                        stage_scores[p] = partial
+                        continue
+                    pair_scores = matrix[rows, index[cols]]
+                valid = (index[cols] != len(choices)) & ~missing[rows]
+                partial = partial + pair_scores
+                keep = survivors(k, pair_scores, partial, valid)
+                stage_scores[p] = pair_scores
+                rows, cols, partial = rows[keep], cols[keep], partial[keep]
+                stage_scores = {q: scores[keep] for q, scores in stage_scores.items()}
+            total = np.zeros(len(rows), dtype=np.float64)
+            for p in range(num_pairs):
+                total += stage_scores[p]
+            avg = total / num_pairs
+            keep = avg >= args.threshold
+            key_ids_out.append(np.array([chunk[i][0] for i in rows[keep]], dtype=np.int64))
+            ref_ids_out.append(ref_ids[cols[keep]])
+            scores_out.append(avg[keep])
+
+    return _store_cdist_scores(con, key_ids_out, ref_ids_out, scores_out, args.threshold)
+
+
+def _store_cdist_scores(con, key_ids_out, ref_ids_out, scores_out, threshold: float) -> int:
+    """Write the surviving ``(key_id, ref_id, avg_score)`` chunks to the ``cdist_scores`` temp table."""
+    import numpy as np
+
+    cdist_scores = {
+        'key_id': np.concatenate(key_ids_out) if key_ids_out else np.array([], dtype=np.int64),
+        'ref_id': np.concatenate(ref_ids_out) if ref_ids_out else np.array([], dtype=np.int64),
+        'avg_score': np.concatenate(scores_out) if scores_out else np.array([], dtype=np.float64),
+    }
+    con.register('cdist_scores_np', cdist_scores)
+    con.execute("CREATE TEMP TABLE cdist_scores AS SELECT * FROM cdist_scores_np;")
+    con.unregister('cdist_scores_np')
+    surviving = len(cdist_scores['key_id'])
+    logging.debug(f"cdist engine kept {surviving:,} pairs at or above threshold {threshold}")
+    return surviving
+
+
+# Candidate pairs per DuckDB thread when --threads auto sizes the pool
+PAIRS_PER_THREAD = 2_000_000
+
+MEMORY_UNITS = {
+    "b": 1, "kb": 1000, "mb": 1000 ** 2, "gb": 1000 ** 3, "tb": 1000 ** 4,
+    "kib": 1024, "mib": 1024 ** 2, "gib": 1024 ** 3, "tib": 1024 ** 4,
+}
+
+
+def parse_memory_size(text: str) -> int:
+    """Parse a size such as ``512MB``, ``4GB`` or ``1.5GiB`` into bytes.
+
+    Raises ValueError for malformed sizes.
+    """
+    import re
+
+    match = re.fullmatch(r"\s*([0-9]+(?:\.[0-9]+)?)\s*([a-zA-Z]*)\s*", text or "")
+    unit = (match.group(2).lower() or "b") if match else None
+    if unit not in MEMORY_UNITS:
+        raise ValueError(f"Invalid memory size '{text}'. Use a number with a unit, e.g. 512MB or 4GB.")
+    return int(float(match.group(1)) * MEMORY_UNITS[unit])
+
+
+def _read_cgroup_value(path: str) -> str:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def available_cpus() -> int:
+    """CPUs this process may use: the cgroup CPU quota if set, else the scheduler affinity."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    # cgroup v2 ("max 100000" or "<quota> <period>"), then cgroup v1
+    quota_period = _read_cgroup_value("/sys/fs/cgroup/cpu.max").split()
+    if len(quota_period) != 2:
+        quota_period = [
+            _read_cgroup_value("/sys/fs/cgroup/cpu/cpu.cfs_quota_us"),
+            _read_cgroup_value("/sys/fs/cgroup/cpu/cpu.cfs_period_us"),
+        ]
+    try:
+        quota, period = int(quota_period[0]), int(quota_period[1])
+        if quota > 0 and period > 0:
+            cpus = min(cpus, max(1, -(-quota // period)))
+    except ValueError:
+        pass
+    return cpus
+
+
+def container_memory_limit() -> int:
+    """Memory this process may use in bytes: the cgroup limit if set, else physical memory."""
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        memory = 0
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        value = _read_cgroup_value(path)
+        if value.isdigit():
+            # cgroup v1 reports "unlimited" as a huge page-aligned number
+            limit = int(value)
+            if 0 < limit < (1 << 60):
+                memory = min(memory, limit) if memory else limit
+            break
+    return memory
+
+
+def resolve_duckdb_settings(args: "argparse.Namespace") -> dict:
+    """Turn --threads, --memory-limit and --temp-directory into per-connection DuckDB settings.
+
+    ``auto`` threads start at the available CPUs and are narrowed by
+    ``auto_threads()`` once the candidate count is known; ``auto`` memory is
+    80% of the container (or physical) memory. With --workers the threads and
+    the memory are split between the workers, the main connection keeping one
+    share of the memory. Raises ValueError for invalid values.
+    """
+    settings = {"threads": None, "memory_limit": None, "temp_directory": args.temp_directory}
+    if args.threads == "auto":
+        settings["threads"] = available_cpus()
+    elif args.threads is not None:
+        if not args.threads.isdigit() or int(args.threads) < 1:
+            raise ValueError(f"Invalid --threads '{args.threads}': use a positive number or 'auto'.")
+        settings["threads"] = int(args.threads)
+    if args.memory_limit == "auto":
+        settings["memory_limit"] = int(container_memory_limit() * 0.8) or None
+    elif args.memory_limit is not None:
+        settings["memory_limit"] = parse_memory_size(args.memory_limit)
+    if settings["memory_limit"] and args.workers > 1:
+        settings["memory_limit"] //= args.workers + 1
+    return settings
+
+
+def auto_threads(estimated_pairs: int) -> int:
+    """Threads for --threads auto: one per PAIRS_PER_THREAD candidate pairs, up to the available CPUs."""
+    return max(1, min(available_cpus(), -(-estimated_pairs // PAIRS_PER_THREAD)))
+
+
+def apply_duckdb_settings(con: duckdb.DuckDBPyConnection, settings: dict) -> None:
+    """Apply the resolved threads, memory limit and spill directory to a connection."""
+    if settings.get("threads"):
+        con.execute(f"SET threads = {settings['threads']};")
+    if settings.get("memory_limit"):
+        con.execute(f"SET memory_limit = '{settings['memory_limit']}B';")
+    if settings.get("temp_directory"):
+        con.execute(f"SET temp_directory = '{settings['temp_directory']}';")
+
+
+def estimate_candidate_pairs(con: duckdb.DuckDBPyConnection, args: "argparse.Namespace") -> int:
+    """Upper bound of the pairs to score: input rows x reference rows, per block with --block-prefix."""
+    if args.block_prefix:
+        return con.execute("""
+            SELECT COALESCE(SUM(i.n * r.n), 0)
+            FROM (SELECT block_key, COUNT(*) AS n FROM input_preproc GROUP BY block_key) i
+            JOIN (SELECT block_key, COUNT(*) AS n FROM ref_preproc GROUP BY block_key) r ON r.block_key = i.block_key
+        """).fetchone()[0]
+    return con.execute("SELECT (SELECT COUNT(*) FROM input_rows) * (SELECT COUNT(*) FROM ref_preproc)").fetchone()[0]
+
+
+def score_partition(task: dict) -> str:
+    """Score one partition in a worker process and write its pairs to Parquet.
+
+    The worker opens its own DuckDB connection over the partition files
+    written by ``score_keys_partitioned()`` and keeps only the pairs reaching
+    the threshold, as ``(key_id, ref_id, avg_score)``.
+    """
+    args = task["args"]
+    con = duckdb.connect(database=":memory:")
+    apply_duckdb_settings(con, task["settings"])
+    for view, path in task["sources"].items():
+        con.execute(f"CREATE VIEW {view} AS SELECT * FROM read_parquet('{path}');")
+    if args.engine == 'cdist':
+        score_keys_cdist(con, task["join_pairs"], args, task["candidate_table"], pair_order=task["pair_order"])
+        scores_sql = "SELECT key_id, ref_id, avg_score FROM cdist_scores"
+    else:
+        if task["using_rapidfuzz"]:
+            try_load_rapidfuzz(con)
+        scores_sql = f"""
+            SELECT * FROM (
+                SELECT inp.key_id, ref.ref_id, {task['avg_score_expr']} AS avg_score
+                FROM ref_preproc AS ref
+                {task['key_join']}
+            ) t
+            WHERE avg_score >= {args.threshold}
+        """
+    con.execute(f"COPY ({scores_sql}) TO '{task['output']}' (FORMAT PARQUET);")
+    con.close()
+    return task["output"]
+
+
+def worker_pool(args: "argparse.Namespace"):
+    """Process pool for ``--workers`` (None for a single process)."""
+    if args.workers <= 1:
+        return None
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # spawn: forking a process that holds a multithreaded DuckDB connection is unsafe
+    return ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def score_keys_partitioned(
+    con: duckdb.DuckDBPyConnection,
+    join_pairs: List[str],
+    args: "argparse.Namespace",
+    executor,
+    work_dir: str,
+    candidate_table: str = None,
+    key_join: str = None,
+    avg_score_expr: str = None,
+    using_rapidfuzz: bool = False,
+    settings: dict = None,
+    pair_order: List[int] = None,
+) -> List[str]:
+    """Hash-partition the scoring inputs to Parquet and score the partitions in worker processes.
+
+    With ``--block-prefix`` alone, ``input_keys`` and ``ref_preproc`` are
+    partitioned on ``block_key``, so every block lands in one partition. With
+    a candidate table, input keys and their candidate pairs are partitioned on
+    ``key_id`` and each partition gets the reference rows its pairs use.
+    Otherwise input keys are partitioned on ``key_id`` and every partition
+    reads the whole reference. There are four partitions per worker so that
+    skewed blocks even out across processes.
+
+    Partition files are written by DuckDB, which spills to disk, so neither
+    side has to fit in memory at once. Returns the partial score files.
+    """
+    n_parts = args.workers * 4
+    key_part = "hash(block_key)" if candidate_table is None and args.block_prefix else "hash(key_id)"
+    con.execute(f"""
+        COPY (SELECT *, {key_part} % {n_parts} AS part FROM input_keys)
+        TO '{work_dir}/input_keys' (FORMAT PARQUET, PARTITION_BY (part));
+    """)
+    if candidate_table:
+        con.execute(f"""
+            COPY (SELECT *, hash(key_id) % {n_parts} AS part FROM {candidate_table})
+            TO '{work_dir}/candidates' (FORMAT PARQUET, PARTITION_BY (part));
+        """)
+        con.execute(f"""
+            COPY (
+                SELECT ref.*, cp.part
+                FROM ref_preproc ref
+                JOIN (SELECT DISTINCT ref_id, hash(key_id) % {n_parts} AS part FROM {candidate_table}) cp
+                  ON cp.ref_id = ref.ref_id
+            ) TO '{work_dir}/ref_preproc' (FORMAT PARQUET, PARTITION_BY (part));
+        """)
+    elif args.block_prefix:
+        con.execute(f"""
+            COPY (SELECT *, hash(block_key) % {n_parts} AS part FROM ref_preproc)
+            TO '{work_dir}/ref_preproc' (FORMAT PARQUET, PARTITION_BY (part));
+        """)
+    else:
+        con.execute(f"COPY (SELECT * FROM ref_preproc) TO '{work_dir}/ref_preproc.parquet' (FORMAT PARQUET);")
+
+    settings = settings or {}
+    threads = max(1, (settings.get("threads") or available_cpus()) // args.workers)
+    tasks = []
+    for part in range(n_parts):
+        sources = {"input_keys": f"{work_dir}/input_keys/part={part}/*.parquet"}
+        if candidate_table:
+            sources[candidate_table] = f"{work_dir}/candidates/part={part}/*.parquet"
+        if candidate_table or args.block_prefix:
+            sources["ref_preproc"] = f"{work_dir}/ref_preproc/part={part}/*.parquet"
+        else:
+            sources["ref_preproc"] = f"{work_dir}/ref_preproc.parquet"
+        # A partition without input keys or reference rows has no pairs to score
+        if not all(os.path.exists(os.path.dirname(path)) for path in sources.values()):
+            continue
+        tasks.append({
+            "args": args,
+            "join_pairs": join_pairs,
+            "settings": {
+                "threads": threads,
+                "memory_limit": settings.get("memory_limit"),
+                # Each worker spills to its own directory, removed with work_dir
+                "temp_directory": f"{work_dir}/spill_{part:04d}",
+            },
+            "sources": sources,
+            "candidate_table": candidate_table,
+            "key_join": key_join,
+            "avg_score_expr": avg_score_expr,
+            "pair_order": pair_order,
+            "using_rapidfuzz": using_rapidfuzz,
+            "output": f"{work_dir}/scores_{part:04d}.parquet",
+        })
+    logging.debug(f"Scoring {len(tasks)} non-empty partitions of {n_parts} with {args.workers} workers")
+    return list(executor.map(score_partition, tasks))
+
+
+def new_profile() -> dict:
+    """Empty ``--profile`` record, filled by ``profile_stage()`` and ``profile_rows()``."""
+    return {"stages": {}, "rows": {}, "block_pairs": {}, "scoring_query": None, "running": None}
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far, in MB (None where unsupported)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def profile_stage(profile: dict, stage: str, con: duckdb.DuckDBPyConnection = None) -> None:
+    """End the running stage of ``profile`` and start ``stage`` (None only ends it).
+
+    A stage accumulates its wall time and number of runs (the matching stages
+    run once per chunk), the process peak RSS when it ended and the largest
+    DuckDB memory use seen at its end. Does nothing without a profile.
+    """
+    if profile is None:
+        return
+    now = time.perf_counter()
+    if profile["running"]:
+        name, start = profile["running"]
+        entry = profile["stages"].setdefault(name, {"seconds": 0.0, "runs": 0})
+        entry["seconds"] += now - start
+        entry["runs"] += 1
+        entry["peak_rss_mb"] = peak_rss_mb()
+        if con is not None:
+            used = con.execute("SELECT COALESCE(SUM(memory_usage_bytes), 0) FROM duckdb_memory()").fetchone()[0]
+            entry["duckdb_memory_mb"] = max(entry.get("duckdb_memory_mb", 0.0), round(used / 2**20, 1))
+    profile["running"] = (stage, now) if stage else None
+
+
+def profile_rows(profile: dict, name: str, count: int) -> None:
+    """Add ``count`` to the row count ``name`` of ``profile`` (summed over chunks)."""
+    if profile is not None:
+        profile["rows"][name] = profile["rows"].get(name, 0) + count
+
+
+def profiled_execute(con: duckdb.DuckDBPyConnection, sql: str, profile: dict) -> None:
+    """Run ``sql``, keeping DuckDB's JSON query profile (operator timings and cardinalities) in ``profile``."""
+    if profile is None:
+        con.execute(sql)
+        return
+    import json
+
+    fd, path = tempfile.mkstemp(prefix="tometo_tomato_profile_", suffix=".json")
+    os.close(fd)
+    try:
+        con.execute("PRAGMA enable_profiling = 'json';")
+        con.execute(f"PRAGMA profiling_output = '{path}';")
+        try:
+            con.execute(sql)
+        finally:
+            con.execute("PRAGMA disable_profiling;")
+        with open(path, encoding="utf-8") as f:
+            profile["scoring_query"] = json.load(f)
+    finally:
+        os.remove(path)
+
+
+def write_profile(profile: dict, path: str, args: "argparse.Namespace", total_seconds: float) -> None:
+    """Write the ``--profile`` JSON report."""
+    import json
+
+    report = {
+        "tometo_tomato_version": __version__,
+        "duckdb_version": duckdb.__version__,
+        "options": vars(args),
+        "total_seconds": round(total_seconds, 4),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": [
+            {"stage": name, **entry, "seconds": round(entry["seconds"], 4)} for name, entry in profile["stages"].items()
+        ],
+        "rows": profile["rows"],
+        "block_pairs": profile["block_pairs"],
+        "scoring_query": profile["scoring_query"],
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, default=str)
+
+
+def prepare_join(
+    con: duckdb.DuckDBPyConnection,
+    args: "argparse.Namespace",
+    input_source: str = None,
+    reference_source: str = None,
+    reuse_reference: bool = False,
+    profile: dict = None,
+) -> dict:
+    """Validate ``args`` and build the staged tables and views every match reads.
+
+    ``input_source`` and ``reference_source`` are table expressions on ``con``
+    that replace the input and reference files. ``reuse_reference``
+    materializes the prepared reference for repeated ``match_keys()`` calls
+    (as ``--chunk-size`` does); ``profile`` (see ``new_profile()``) records
+    the stages and row counts of this and later ``match_keys()`` calls. Creates
+    ``input_source``, ``ref_source``, ``input_rows``, ``input_scope``,
+    ``input_preproc`` and ``ref_preproc`` on ``con`` and returns the plan that
+    ``match_keys()`` and the output queries use. Raises ``FuzzyJoinError``.
+    """
+    profile_stage(profile, "read_headers")
+    try:
+        input_cols = (
+            relation_columns(con, input_source) if input_source else read_header(args.input_file, args.ref_cache)
+        )
+        source_ref_cols = relation_columns(con, reference_source) if reference_source else None
+        inferred_pairs = []
+        join_pairs = build_join_pairs(
+            args, input_cols, source_ref_cols, con, input_source, reference_source, ranked=inferred_pairs
+        )
+    except ImportError as e:
+        raise FuzzyJoinError(str(e))
+    if not join_pairs:
+        raise FuzzyJoinError("No join pair found.")
+
+    if args.chunk_size < 0:
+        raise FuzzyJoinError("--chunk-size must be a positive number of rows.")
+    if args.workers < 1:
+        raise FuzzyJoinError("--workers must be at least 1.")
+    if args.block_max_pairs < 0:
+        raise FuzzyJoinError("--block-max-pairs must be a positive number of pairs.")
+    if args.resume and not args.chunk_size:
+        raise FuzzyJoinError("--resume requires --chunk-size.")
+    try:
+        duckdb_settings = resolve_duckdb_settings(args)
+        block_passes = blocking_passes(args, join_pairs)
+    except ValueError as e:
+        raise FuzzyJoinError(str(e))
+
+    # A reference cache hit replaces the reference file entirely, header included.
+    ref_cache_file = None
+    ref_cache_hit = False
+    if args.ref_cache:
+        if reference_source:
+            raise FuzzyJoinError("--ref-cache needs a reference file.")
+        os.makedirs(args.ref_cache, exist_ok=True)
+        ref_cache_file = ref_cache_path(args, join_pairs)
+        ref_cache_hit = os.path.exists(ref_cache_file)
+    if ref_cache_hit:
+        ref_cols = read_header(ref_cache_file, args.ref_cache)
+    elif reference_source:
+        ref_cols = source_ref_cols
+    else:
+        try:
+            ref_cols = read_header(args.reference_file, args.ref_cache)
+        except ImportError as e:
+            raise FuzzyJoinError(str(e))
+
+    # Verify that join pair columns exist in the actual datasets
+    for pair in join_pairs:
+        inp_col, ref_col = [c.strip().replace('"', '').replace("'", "") for c in pair.split(",")]
+        if inp_col not in input_cols:
+            raise FuzzyJoinError(f"Column '{inp_col}' not found in input file. Available columns: {', '.join(input_cols)}")
+        if ref_col not in ref_cols:
+            raise FuzzyJoinError(f"Column '{ref_col}' not found in reference file. Available columns: {', '.join(ref_cols)}")
+    for field in args.add_field or []:
+        if field.strip() not in ref_cols:
+            raise FuzzyJoinError(f"Field '{field.strip()}' not found in reference file. Available columns: {', '.join(ref_cols)}")
+
+    # prepare select clauses
+    add_fields = []
+    if args.add_field:
+        # The `action='append'` in argparse creates a list of all given fields.
+        add_fields = [a.strip() for a in args.add_field]
+
+    select_clean_cols, select_ambiguous_cols, selected_input_cols_list = prepare_select_clauses(join_pairs, add_fields, args.show_score)
+
+    # For ambiguous output, use actual column names from the datasets
+    # Get all columns from input that are used in joins (using real column names)
+    actual_input_cols_used = []
+    for pair in join_pairs:
+        inp_col = pair.split(",")[0].strip().replace('"', '').replace("'", "")
+        actual_input_cols_used.append(inp_col)
+    actual_input_cols_used = list(dict.fromkeys(actual_input_cols_used))  # Remove duplicates, keep the pair order
+
+    # Build ambiguous output column list with actual column names
+    ambiguous_cols_list = []
+    # Input columns used in joins (prefix with inp.)
+    for col in actual_input_cols_used:
+        ambiguous_cols_list.append(f'inp."{col}"')
+    # Reference columns used in joins (prefix with s.)
+    for pair in join_pairs:
+        ref_col = pair.split(",")[1].strip().replace('"', '').replace("'", "")
+        ambiguous_cols_list.append(f's."{ref_col}"')
+    # Additional fields (prefix with s.)
+    if add_fields:
+        for f in add_fields:
+            ambiguous_cols_list.append(f's."{f}"')
+    if args.show_score:
+        ambiguous_cols_list.append('s.avg_score')
+    select_ambiguous_cols_fixed = ', '.join(ambiguous_cols_list)
+
+    try:
+        apply_duckdb_settings(con, duckdb_settings)
+    except duckdb.Error as e:
+        raise FuzzyJoinError(f"Invalid DuckDB resource settings: {e}")
+
+    # Register UDF for latinization if needed
+    if args.latinize and not con.execute(
+        "SELECT COUNT(*) FROM duckdb_functions() WHERE function_name = 'latinize_udf'"
+    ).fetchone()[0]:
         def latinize_udf(text):
             if text is None:
                 return None
@@ -382,267 +2457,1733 @@ def main():
         except Exception as e:
             err_msg = str(e)
             if 'numpy' in err_msg.lower() or 'numpy' in getattr(e, 'args', ('',))[0].lower():
-                logging.error("Registering latinize_udf failed: DuckDB requires numpy to register Python UDFs. Install numpy and retry.")
+                raise FuzzyJoinError("Registering latinize_udf failed: DuckDB requires numpy to register Python UDFs. Install numpy and retry.")
+            raise FuzzyJoinError(f"Failed to register latinize_udf: {e}")
+
+    # ------------------------------------------------------------------
+    # Staging: read each source once, projected to the columns in use, into a
+    # temp table that every later stage reads (a reference cache hit reads
+    # the cached Parquet file instead). A chunked run keeps the input as a
+    # view and reads one chunk at a time, see scope_input_chunk().
+    # ------------------------------------------------------------------
+    stream_chunks = bool(args.chunk_size) and not args.estimate
+    input_source_cols = sorted({pair.split(",")[0].strip().replace('"', '').replace("'", "") for pair in join_pairs})
+    ref_source_cols = list(dict.fromkeys(
+        [pair.split(",")[1].strip().replace('"', '').replace("'", "") for pair in join_pairs] + add_fields
+    ))
+    profile_stage(profile, "stage_input", con)
+    if input_source:
+        input_projection = projected_sql(input_source, input_source_cols)
+    else:
+        input_projection = projected_source_sql(con, args.input_file, input_source_cols, args.ref_cache)
+    con.execute(f"""
+        CREATE TEMP {'VIEW' if stream_chunks else 'TABLE'} input_source AS
+        SELECT * FROM {input_projection};
+    """)
+    profile_stage(profile, "stage_reference", con)
+    if not ref_cache_hit:
+        if reference_source:
+            ref_projection = projected_sql(reference_source, ref_source_cols)
+        else:
+            ref_projection = projected_source_sql(con, args.reference_file, ref_source_cols, args.ref_cache)
+        con.execute(f"""
+            CREATE TEMP TABLE ref_source AS
+            SELECT * FROM {ref_projection};
+        """)
+
+    profile_stage(profile, "size_check", con)
+    if profile is not None:
+        profile_rows(profile, "input_rows", con.execute("SELECT COUNT(*) FROM input_source").fetchone()[0])
+        ref_rows_source = f"read_parquet('{ref_cache_file}')" if ref_cache_hit else "ref_source"
+        profile_rows(profile, "reference_rows", con.execute(f"SELECT COUNT(*) FROM {ref_rows_source}").fetchone()[0])
+
+    # Check dataset size and warn if --latinize might be slow
+    if args.latinize:
+        # Quick row count estimate
+        try:
+            input_count_res = con.execute("SELECT COUNT(*) FROM input_source")
+            input_count = input_count_res.fetchone()[0]
+
+            if ref_cache_hit:
+                ref_count_res = con.execute(f"SELECT COUNT(*) FROM read_parquet('{ref_cache_file}')")
             else:
-                logging.error(f"Failed to register latinize_udf: {e}")
-            sys.exit(1)
+                ref_count_res = con.execute("SELECT COUNT(*) FROM ref_source")
+            ref_count = ref_count_res.fetchone()[0]
+
+            total_combinations = input_count * ref_count
+
+            if total_combinations > 10_000_000:  # 10 million combinations
+                logging.warning(f"Large dataset detected ({input_count:,} × {ref_count:,} = {total_combinations:,} combinations)")
+                logging.warning("--latinize option may cause significant performance impact on large datasets.")
+                logging.warning("Consider using smaller samples or removing --latinize for better performance.")
+
+        except Exception as e:
+            logging.debug(f"Could not estimate dataset size: {e}")
+
+    profile_stage(profile, "load_scorer", con)
+    # length_metric tells length_bound_conditions() how the score is normalized
+    length_metric = None
+    using_rapidfuzz = try_load_rapidfuzz(con) if args.engine == 'sql' else False
+    # One score expression per join pair, for staged_score_expr()
+    pair_score_exprs = None
+    scorer_spec = SCORERS[args.scorer]
+    if args.engine == 'cdist':
+        # Scores are computed in Python by score_keys_cdist(); no SQL expression needed.
+        score_expr_base = None
+    elif using_rapidfuzz and scorer_spec.sql:
+        pair_score_exprs = [choose_score_expr(True, [pair], args.scorer, args, True) for pair in join_pairs]
+        score_expr_base = " + ".join(pair_score_exprs)
+        length_metric = scorer_spec.metric
+    elif scorer_spec.fallback is None:
+        needs = "the rapidfuzz extension, which could not be loaded, or " if scorer_spec.sql else ""
+        raise FuzzyJoinError(f"The '{args.scorer}' scorer requires {needs}--engine cdist.")
+    elif scorer_spec.fallback == LEVENSHTEIN_SCORE_SQL:
+        distance = None
+        for function in ("levenshtein", "damerau_levenshtein"):
+            try:
+                con.execute(f"SELECT {function}('a','b')")
+                distance = function
+                break
+            except Exception:
+                continue
+        if distance is None:
+            raise FuzzyJoinError("No fuzzy function available in DuckDB (rapidfuzz, levenshtein or damerau_levenshtein). Install the rapidfuzz extension or use a DuckDB version that includes levenshtein.")
+        pair_score_exprs = [
+            choose_score_expr(False, [pair], args.scorer, args, True, distance=distance) for pair in join_pairs
+        ]
+        score_expr_base = " + ".join(pair_score_exprs)
+        length_metric = 'levenshtein'
+    else:
+        pair_score_exprs = [choose_score_expr(False, [pair], args.scorer, args, True) for pair in join_pairs]
+        score_expr_base = " + ".join(pair_score_exprs)
+
+    # avg_score = (score_expr_base) / num_pairs
+    num_pairs = len(join_pairs)
+    avg_score_expr = f"({score_expr_base}) / {num_pairs}"
+
+    profile_stage(profile, "prepare_views", con)
+    # ------------------------------------------------------------------
+    # Pre-process the join columns once so the CROSS JOIN only executes
+    # the distance function, not the expensive cleaning logic.
+    # ------------------------------------------------------------------
+    def _build_clean_expr(table_alias: str, column: str) -> str:
+        expr = f'{table_alias}."{column}"'
+        if not args.raw_whitespace:
+            expr = f"trim(regexp_replace({expr}, '\\s+', ' ', 'g'))"
+        if args.latinize:
+            expr = f"strip_accents({expr})"
+        if args.keep_alphanumeric:
+            expr = f"regexp_replace({expr}, '[^a-zA-Z0-9 ]', '', 'g')"
+        if not args.raw_case:
+            expr = f"lower({expr})"
+        return expr
+
+    # Create temporary views for common CTEs
+    # Extract unique input columns from join_pairs for SQL selection
+    input_join_cols_for_sql = set()
+    for pair in join_pairs:
+        inp_col = pair.split(",")[0].strip().replace('"', '').replace("'", "")
+        input_join_cols_for_sql.add(f'"{inp_col}"')
+    input_join_cols_for_sql_list = sorted(list(input_join_cols_for_sql))
+    input_cols_for_cte = ", ".join(input_join_cols_for_sql_list)
+
+    # Build WHERE clause to filter out empty rows based on join columns
+    where_clause_parts = []
+    for col in input_join_cols_for_sql_list:
+        where_clause_parts.append(f"{col} IS NOT NULL AND {col} != ''")
+    where_clause = " AND ".join(where_clause_parts)
+    if where_clause:
+        where_clause = f"WHERE {where_clause}"
+
+    # Hash of an input join-column tuple, to recognize it in later chunks
+    input_key_hash = f"md5_number(to_json(list_value({input_cols_for_cte})))"
+    if stream_chunks:
+        # input_chunk reads the rows of the current chunk, numbered by their
+        # position in the input (see scope_input_chunk()); input_seen holds
+        # the keys of the previous chunks.
+        con.execute("CREATE TEMP VIEW input_chunk AS SELECT *, 0::BIGINT AS input_id FROM input_source LIMIT 0;")
+        con.execute("CREATE TEMP TABLE input_seen (key_hash UHUGEINT);")
+        con.execute(f"""
+            CREATE TEMP VIEW input_with_id AS
+            SELECT input_id, {input_cols_for_cte}
+            FROM input_chunk
+            {where_clause};
+        """)
+    else:
+        con.execute(f"""
+            CREATE TEMP VIEW input_with_id AS
+            SELECT ROW_NUMBER() OVER () AS input_id, {input_cols_for_cte}
+            FROM input_source
+            {where_clause};
+        """)
+
+    # Identical input rows produce identical output rows: keep one row per
+    # distinct join-column tuple (in first-seen order) instead of running
+    # SELECT DISTINCT over the full joined output. input_scope is the part
+    # of input_rows being matched: all of it, or one chunk with --chunk-size,
+    # without the keys already matched in an earlier chunk.
+    input_rows_sql = f"""
+        SELECT MIN(input_id) AS input_id, {input_cols_for_cte}
+        FROM input_with_id
+        GROUP BY {input_cols_for_cte}
+    """
+    if stream_chunks:
+        input_rows_sql = f"""
+            SELECT t.*
+            FROM ({input_rows_sql}) t
+            ANTI JOIN input_seen s ON s.key_hash = {input_key_hash}
+        """
+    con.execute(f"CREATE TEMP VIEW input_rows AS {input_rows_sql};")
+    con.execute(f"CREATE TEMP {'TABLE' if stream_chunks else 'VIEW'} input_scope AS SELECT * FROM input_rows;")
+
+    input_clean_cols_sql = []
+    ref_clean_cols_sql = []
+    inp_clean_col_names = []
+    # Lengths of the compared columns feed the length-bound candidate pruning
+    inp_len_cols_sql = []
+    ref_len_cols_sql = []
+    # Token-sorting scorers get the sorted tokens once per distinct key and reference row
+    inp_sorted_cols_sql = []
+    ref_sorted_cols_sql = []
+    for pair in join_pairs:
+        inp_col, ref_col = [c.strip().replace('"', '').replace("'", "") for c in pair.split(",")]
+        input_clean_cols_sql.append(f"{_build_clean_expr('inp', inp_col)} AS \"{inp_col}_clean\"")
+        ref_clean_cols_sql.append(f"{_build_clean_expr('ref', ref_col)} AS \"{ref_col}_clean\"")
+        inp_clean_col_names.append(f'"{inp_col}_clean"')
+        if scorer_spec.column in ("sorted", "tokset"):
+            distinct = scorer_spec.column == "tokset"
+            inp_clean = f't."{inp_col}_clean"'
+            ref_clean = f't."{ref_col}_clean"'
+            inp_sorted_cols_sql.append(f'{sorted_tokens_sql(inp_clean, distinct)} AS {score_column(args.scorer, inp_col)}')
+            ref_sorted_cols_sql.append(f'{sorted_tokens_sql(ref_clean, distinct)} AS {score_column(args.scorer, ref_col)}')
+        inp_len_cols_sql.append(f'length(t.{score_column(args.scorer, inp_col)}) AS "{inp_col}_len"')
+        ref_len_cols_sql.append(f'length(t.{score_column(args.scorer, ref_col)}) AS "{ref_col}_len"')
+
+    con.execute(f"""
+        CREATE TEMP VIEW input_preproc AS
+        SELECT inp.input_id, {', '.join(input_clean_cols_sql)}
+        {',' if args.block_prefix and args.block_prefix > 0 else ''}
+        {(" || '|' || ".join([f"substr(" + _build_clean_expr('inp', pair.split(',')[0].strip().replace('"','').replace("'",'')) + f", 1, {args.block_prefix})" for pair in join_pairs])) + " AS block_key" if args.block_prefix and args.block_prefix > 0 else ''}
+        FROM input_scope inp;
+    """)
+
+    ref_clean_sql = f"""
+            SELECT ref.*, ROW_NUMBER() OVER () AS ref_id, {', '.join(ref_clean_cols_sql)}
+            {',' if args.block_prefix and args.block_prefix > 0 else ''}
+            {(" || '|' || ".join([f"substr(" + _build_clean_expr('ref', pair.split(',')[1].strip().replace('"','').replace("'",'')) + f", 1, {args.block_prefix})" for pair in join_pairs])) + " AS block_key" if args.block_prefix and args.block_prefix > 0 else ''}
+            FROM ref_source AS ref
+    """
+    if ref_sorted_cols_sql:
+        ref_clean_sql = f"SELECT t.*, {', '.join(ref_sorted_cols_sql)} FROM ({ref_clean_sql}) t"
+    ref_preproc_sql = f"""
+        SELECT t.*, {', '.join(ref_len_cols_sql)}
+        FROM ({ref_clean_sql}) t
+    """
+
+    profile_stage(profile, "prepare_reference", con)
+    if ref_cache_file:
+        if ref_cache_hit:
+            logging.info(f"Reference cache hit: {ref_cache_file}")
+            # Refresh the access time used by the LRU eviction
+            os.utime(ref_cache_file)
+        else:
+            logging.info(f"Reference cache miss, writing: {ref_cache_file}")
+            tmp_file = f"{ref_cache_file}.{os.getpid()}.tmp"
+            con.execute(f"COPY ({ref_preproc_sql}) TO '{tmp_file}' (FORMAT PARQUET);")
+            os.replace(tmp_file, ref_cache_file)
+            evict_ref_cache(args.ref_cache, args.ref_cache_size * 1024 * 1024, keep=ref_cache_file)
+        con.execute(f"""
+            CREATE TEMP VIEW ref_preproc AS
+            SELECT * FROM read_parquet('{ref_cache_file}');
+        """)
+    elif args.chunk_size or reuse_reference:
+        # Every chunk is matched against the same reference: prepare it once
+        con.execute(f"CREATE TEMP TABLE ref_preproc AS {ref_preproc_sql};")
+    else:
+        con.execute(f"CREATE TEMP VIEW ref_preproc AS {ref_preproc_sql};")
+
+    if args.threads == "auto":
+        estimated_pairs = estimate_candidate_pairs(con, args)
+        duckdb_settings["threads"] = auto_threads(estimated_pairs)
+        apply_duckdb_settings(con, {"threads": duckdb_settings["threads"]})
+        logging.info(
+            f"Auto threads: ~{estimated_pairs:,} candidate pairs (upper bound), "
+            f"{available_cpus()} CPUs available"
+        )
+    threads, memory_limit, temp_directory = con.execute(
+        "SELECT current_setting('threads'), current_setting('memory_limit'), current_setting('temp_directory')"
+    ).fetchone()
+    logging.info(f"DuckDB settings: threads={threads}, memory_limit={memory_limit}, temp_directory={temp_directory}")
+    profile_stage(profile, None, con)
+
+    return {
+        "join_pairs": join_pairs,
+        # --infer-values ranking, see rank_column_pairs()
+        "inferred_pairs": inferred_pairs,
+        "input_columns": input_source_cols,
+        "input_key_hash": input_key_hash,
+        "reference_columns": ref_source_cols,
+        "block_passes": block_passes,
+        "duckdb_settings": duckdb_settings,
+        "select_clean_cols": select_clean_cols,
+        "select_ambiguous_cols": select_ambiguous_cols_fixed,
+        "inp_clean_col_names": inp_clean_col_names,
+        "inp_len_cols_sql": inp_len_cols_sql,
+        "inp_sorted_cols_sql": inp_sorted_cols_sql,
+        "avg_score_expr": avg_score_expr,
+        "pair_score_exprs": pair_score_exprs,
+        "length_metric": length_metric,
+        "using_rapidfuzz": using_rapidfuzz,
+        "profile": profile,
+    }
+
+
+def prepare_keys(con: duckdb.DuckDBPyConnection, args: "argparse.Namespace", plan: dict) -> str:
+    """Build the distinct input keys of ``input_scope``, the exact pre-pass and the blocking candidates.
+
+    Creates ``input_distinct_keys``, ``input_keys`` (the keys left for fuzzy
+    scoring), ``input_key_map`` and, with blocking, the candidate table,
+    whose name is returned (None when no candidate table is needed).
+    """
+    join_pairs = plan["join_pairs"]
+    block_passes = plan["block_passes"]
+    profile = plan["profile"]
+    profile_stage(profile, "distinct_keys", con)
+    # ------------------------------------------------------------------
+    # DISTINCT optimization: deduplicate input join keys before the
+    # expensive CROSS JOIN so fuzzy matching runs only on unique combos.
+    # ------------------------------------------------------------------
+    clean_cols_csv = ', '.join(plan["inp_clean_col_names"])
+    block_key_col = ', block_key' if args.block_prefix and args.block_prefix > 0 else ''
+
+    # Materialized so key_id stays stable across every stage that reads it
+    distinct_keys_sql = f"SELECT DISTINCT {clean_cols_csv}{block_key_col} FROM input_preproc"
+    if plan["inp_sorted_cols_sql"]:
+        distinct_keys_sql = f"SELECT t.*, {', '.join(plan['inp_sorted_cols_sql'])} FROM ({distinct_keys_sql}) t"
+    con.execute(f"""
+        CREATE TEMP TABLE input_distinct_keys AS
+        SELECT ROW_NUMBER() OVER () AS key_id, t.*, {', '.join(plan["inp_len_cols_sql"])}
+        FROM ({distinct_keys_sql}) t;
+    """)
+
+    # ------------------------------------------------------------------
+    # Exact-match pre-pass: hash-join the distinct keys to the reference on
+    # the compared columns. With a scorer that gives 100 only to identical
+    # strings, a key with exactly one exact hit cannot have a better or tied
+    # candidate, so it skips the fuzzy stage; keys with several exact hits
+    # are tied at 100 and still go through it, so the ambiguous output lists
+    # all their candidates. input_keys holds the keys left for fuzzy scoring.
+    # ------------------------------------------------------------------
+    if profile is not None:
+        profile_rows(profile, "distinct_input_rows", con.execute("SELECT COUNT(*) FROM input_scope").fetchone()[0])
+        profile_rows(profile, "distinct_keys", con.execute("SELECT COUNT(*) FROM input_distinct_keys").fetchone()[0])
+
+    # ------------------------------------------------------------------
+    # --state: keys matched by the previous run keep their stored matches
+    # (see match_keys()); only the new and changed keys, changed_keys, go
+    # through the exact pre-pass, blocking and scoring.
+    # ------------------------------------------------------------------
+    keys_table = "input_distinct_keys"
+    state = plan.get("state")
+    if state:
+        con.execute(f"""
+            CREATE TEMP TABLE key_hashes AS
+            SELECT key_id, md5(to_json(list_value({clean_cols_csv}))) AS key_hash
+            FROM input_distinct_keys;
+        """)
+        if state["loaded"]:
+            con.execute("""
+                CREATE OR REPLACE TEMP VIEW changed_keys AS
+                SELECT idk.*
+                FROM input_distinct_keys idk
+                JOIN key_hashes kh ON kh.key_id = idk.key_id
+                ANTI JOIN state_keys sk ON sk.key_hash = kh.key_hash;
+            """)
+            keys_table = "changed_keys"
+            n_keys, n_changed = con.execute(
+                "SELECT (SELECT COUNT(*) FROM input_distinct_keys), (SELECT COUNT(*) FROM changed_keys)"
+            ).fetchone()
+            logging.info(
+                f"State: {n_keys - n_changed:,} of {n_keys:,} distinct keys reuse the previous run; "
+                f"{n_changed:,} to match"
+            )
+            profile_rows(profile, "state_reused_keys", n_keys - n_changed)
+
+    exact_prepass = args.scorer in EXACT_PREPASS_SCORERS
+    if exact_prepass:
+        profile_stage(profile, "exact_prepass", con)
+        exact_on = ' AND '.join(
+            f'inp.{inp_score} = ref.{ref_score} AND inp.{inp_score} <> \'\''
+            for inp_score, ref_score in [
+                [score_column(args.scorer, c.strip().replace('"', '').replace("'", "")) for c in pair.split(",")]
+                for pair in join_pairs
+            ]
+        )
+        con.execute(f"""
+            CREATE TEMP TABLE exact_matches AS
+            SELECT inp.key_id, ref.ref_id, COUNT(*) OVER (PARTITION BY inp.key_id) AS n_exact
+            FROM {keys_table} inp
+            JOIN ref_preproc ref ON {exact_on};
+        """)
+        con.execute(f"""
+            CREATE OR REPLACE TEMP VIEW input_keys AS
+            SELECT inp.*
+            FROM {keys_table} inp
+            ANTI JOIN (SELECT key_id FROM exact_matches WHERE n_exact = 1) em ON em.key_id = inp.key_id;
+        """)
+        n_keys, n_unique, n_multi = con.execute(f"""
+            SELECT (SELECT COUNT(*) FROM {keys_table}),
+                   COUNT(DISTINCT key_id) FILTER (WHERE n_exact = 1),
+                   COUNT(DISTINCT key_id) FILTER (WHERE n_exact > 1)
+            FROM exact_matches
+        """).fetchone()
+        logging.info(
+            f"Exact pre-pass: {n_unique:,} of {n_keys:,} distinct keys matched exactly once, "
+            f"{n_multi:,} matched several reference rows; {n_keys - n_unique:,} go to fuzzy scoring"
+        )
+        profile_rows(profile, "exact_matched_keys", n_unique)
+    else:
+        con.execute(f"CREATE OR REPLACE TEMP VIEW input_keys AS SELECT * FROM {keys_table};")
+
+    join_on_clauses = ' AND '.join(
+        [f'ip.{col} IS NOT DISTINCT FROM ik.{col}' for col in plan["inp_clean_col_names"]]
+    )
+    if args.block_prefix and args.block_prefix > 0:
+        join_on_clauses += ' AND ip.block_key IS NOT DISTINCT FROM ik.block_key'
+
+    con.execute(f"""
+        CREATE OR REPLACE TEMP VIEW input_key_map AS
+        SELECT ip.input_id, ik.key_id
+        FROM input_preproc ip
+        JOIN input_distinct_keys ik ON {join_on_clauses};
+    """)
+
+    # Blocking modes that are not a plain block_key equality produce an explicit
+    # candidate_pairs table; both engines then score only those pairs.
+    # --block-prefix on its own keeps the direct block_key equality join,
+    # unless --block-max-pairs may split its blocks.
+    candidate_table = None
+    direct_prefix = len(block_passes) == 1 and block_passes[0]["kind"] == "prefix" and args.block_prefix
+    if block_passes and not (direct_prefix and not args.block_max_pairs):
+        profile_stage(profile, "candidates", con)
+        build_candidates(con, join_pairs, args, block_passes, profile=profile)
+        candidate_table = "candidate_pairs"
+    elif profile is not None:
+        profile_join_pairs(con, args, profile)
+    return candidate_table
+
+
+def profile_join_pairs(con: duckdb.DuckDBPyConnection, args: "argparse.Namespace", profile: dict) -> None:
+    """Count the pairs of the joins without a candidate table in ``profile``.
+
+    With ``--block-prefix`` on its own these are the pairs of the block_key
+    equality join, counted from the block sizes of both sides, together with
+    a histogram of the pairs per block (power-of-two buckets); otherwise the
+    keys to score times the reference rows.
+    """
+    if not (args.block_prefix and args.block_prefix > 0):
+        n_keys = con.execute("SELECT COUNT(*) FROM input_keys").fetchone()[0]
+        n_ref = con.execute("SELECT COUNT(*) FROM ref_preproc").fetchone()[0]
+        profile_rows(profile, "candidate_pairs", n_keys * n_ref)
+        return
+    buckets = block_pairs_histogram(con, PREFIX_BLOCK_PAIRS_SQL)
+    pairs = sum(n_pairs for _, _, n_pairs in buckets)
+    profile_rows(profile, f"candidate_pairs[prefix:{args.block_prefix}]", pairs)
+    profile_rows(profile, "candidate_pairs", pairs)
+    for label, blocks, _ in buckets:
+        profile["block_pairs"][label] = profile["block_pairs"].get(label, 0) + blocks
+
+
+# Pairs of each --block-prefix block: its input keys times its reference rows
+PREFIX_BLOCK_PAIRS_SQL = """
+    SELECT inp.block_key, inp.n AS input_keys, ref.n AS reference_rows, inp.n * ref.n AS pairs
+    FROM (SELECT block_key, COUNT(*) AS n FROM input_keys GROUP BY ALL) inp
+    JOIN (SELECT block_key, COUNT(*) AS n FROM ref_preproc GROUP BY ALL) ref ON ref.block_key = inp.block_key
+"""
+
+
+def block_pairs_histogram(con: duckdb.DuckDBPyConnection, blocks_sql: str) -> List[tuple]:
+    """Bucket the blocks of ``blocks_sql`` (one row with a ``pairs`` column per block) by power-of-two size.
+
+    Returns ``(label, blocks, pairs)`` per non-empty bucket, smallest first,
+    with labels such as ``"1"``, ``"2-3"`` and ``"4-7"``.
+    """
+    buckets = con.execute(f"""
+        SELECT floor(log2(pairs))::INTEGER AS bucket, COUNT(*) AS blocks, SUM(pairs) AS pairs
+        FROM ({blocks_sql}) t
+        WHERE pairs > 0
+        GROUP BY ALL
+        ORDER BY bucket
+    """).fetchall()
+    histogram = []
+    for bucket, blocks, pairs in buckets:
+        low, high = 2 ** bucket, 2 ** (bucket + 1) - 1
+        histogram.append((str(low) if low == high else f"{low}-{high}", blocks, int(pairs)))
+    return histogram
+
+
+def prune_candidates(con: duckdb.DuckDBPyConnection, args: "argparse.Namespace", plan: dict, candidate_table: str) -> str:
+    """Keep the candidate pairs whose cleaned lengths can still reach the threshold, in ``scoring_pairs``.
+
+    The input lengths are joined to the candidates first and the reference
+    lengths second, so the length bounds filter plain equality joins. Left
+    in the scoring query, they let DuckDB plan an inequality join of every
+    input key with every reference row before the candidates are applied.
+    Returns the table to score (``candidate_table`` when no bound applies).
+    """
+    conditions = length_bound_conditions(plan["join_pairs"], args.threshold, plan["length_metric"])
+    if not conditions:
+        return candidate_table
+    inp_lens, ref_lens = zip(*[
+        [f'"{col.strip()}_len"' for col in pair.replace('"', '').replace("'", "").split(",")]
+        for pair in plan["join_pairs"]
+    ])
+    con.execute(f"""
+        CREATE TEMP TABLE scoring_pairs_lengths AS
+        SELECT cp.key_id, cp.ref_id, {', '.join(f'inp.{c}' for c in inp_lens)}
+        FROM {candidate_table} cp
+        JOIN input_keys inp ON inp.key_id = cp.key_id;
+    """)
+    con.execute(f"""
+        CREATE TEMP TABLE scoring_pairs AS
+        SELECT inp.key_id, inp.ref_id
+        FROM scoring_pairs_lengths AS inp
+        JOIN (SELECT ref_id, {', '.join(ref_lens)} FROM ref_preproc) AS ref ON ref.ref_id = inp.ref_id
+        WHERE {' AND '.join(conditions)};
+    """)
+    con.execute("DROP TABLE scoring_pairs_lengths;")
+    return "scoring_pairs"
+
+
+def scoring_join(args: "argparse.Namespace", plan: dict, candidate_table: str = None, prune: bool = True) -> str:
+    """Join clause after ``FROM ref_preproc AS ref`` giving the ``(inp, ref)`` pairs the SQL engine scores.
+
+    The pairs are the candidate pairs, the same block with ``--block-prefix``
+    alone, or every key against every reference row, minus (with ``prune``)
+    the pairs whose cleaned lengths cannot reach the threshold.
+    """
+    # Pairs whose cleaned lengths cannot reach the threshold are never scored
+    key_join_conditions = []
+    if prune:
+        key_join_conditions = length_bound_conditions(plan["join_pairs"], args.threshold, plan["length_metric"])
+    if key_join_conditions:
+        logging.debug(f"Length-bound pruning: {' AND '.join(key_join_conditions)}")
+    if candidate_table:
+        key_join = (
+            f"JOIN {candidate_table} AS cp ON cp.ref_id = ref.ref_id\n"
+            f"            JOIN input_keys AS inp ON inp.key_id = cp.key_id"
+        )
+        if key_join_conditions:
+            key_join += f"\n            WHERE {' AND '.join(key_join_conditions)}"
+        return key_join
+    if args.block_prefix and args.block_prefix > 0:
+        key_join_conditions.insert(0, "ref.block_key = inp.block_key")
+    if key_join_conditions:
+        return f"JOIN input_keys AS inp\n              ON {' AND '.join(key_join_conditions)}"
+    return "CROSS JOIN input_keys AS inp"
+
+
+# Pairs sampled by order_join_pairs() to rank the join pairs
+STAGED_SAMPLE_PAIRS = 5_000
+
+
+def stage_cutoff(num_pairs: int, scored: int, threshold: float) -> float:
+    """Sum of the first ``scored`` pair scores below which the average can no longer reach ``threshold``.
+
+    Each of the ``num_pairs - scored`` pairs left adds at most 100.
+    """
+    return num_pairs * threshold - (num_pairs - scored) * 100.0
+
+
+def order_join_pairs(
+    con: duckdb.DuckDBPyConnection,
+    args: "argparse.Namespace",
+    plan: dict,
+    candidate_table: str = None,
+    key_join: str = None,
+) -> tuple:
+    """Order the join pairs for staged scoring, from a sample of the pairs to score.
+
+    Each join pair is ranked by ``cost / (1 - pass rate)``, so cheap pairs
+    that reject most candidates are scored first. The cost is the mean
+    cleaned length of the sampled values (the product of the lengths for
+    DuckDB's quadratic ``levenshtein``); the pass rate is the share of
+    sampled pairs reaching the score a join pair needs on its own
+    (``stage_cutoff(n, 1, threshold)``, or the threshold when that bound is
+    not positive). A stage guard after the first ``k`` pairs is kept when
+    the sample says the pairs it rejects save more than re-scoring the first
+    ``k`` pairs in the final average costs.
+
+    Returns ``(order, guards)``: the join pair indices in scoring order and
+    the numbers of leading pairs after which ``staged_score_expr()`` checks
+    the partial sum. With a single pair or an empty sample the declared
+    order is kept and there are no guards.
+    """
+    import math
+
+    join_pairs = plan["join_pairs"]
+    num_pairs = len(join_pairs)
+    declared = list(range(num_pairs))
+    if num_pairs < 2:
+        return declared, []
+    if candidate_table:
+        sample_sql = f"SELECT key_id, ref_id FROM {candidate_table} USING SAMPLE reservoir({STAGED_SAMPLE_PAIRS} ROWS) REPEATABLE (42)"
+    else:
+        side = math.isqrt(STAGED_SAMPLE_PAIRS)
+        if key_join is None:
+            key_join = scoring_join(args, plan, prune=False)
+        sample_join = key_join.replace(
+            "input_keys AS inp",
+            f"(SELECT * FROM input_keys USING SAMPLE reservoir({side} ROWS) REPEATABLE (42)) AS inp",
+        )
+        sample_sql = f"""
+            SELECT inp.key_id, ref.ref_id
+            FROM (SELECT * FROM ref_preproc USING SAMPLE reservoir({side} ROWS) REPEATABLE (42)) AS ref
+            {sample_join}
+        """
+    con.execute(f"CREATE OR REPLACE TEMP TABLE staged_sample AS {sample_sql};")
+
+    inp_cols, ref_cols = zip(*[
+        [score_column(args.scorer, col.strip()) for col in pair.replace('"', '').replace("'", "").split(",")]
+        for pair in join_pairs
+    ])
+    lengths = [f"length(inp.{i}), length(ref.{r})" for i, r in zip(inp_cols, ref_cols)]
+    if args.engine == 'cdist':
+        values = [f"inp.{i}, ref.{r}" for i, r in zip(inp_cols, ref_cols)]
+    else:
+        values = plan["pair_score_exprs"]
+    rows = con.execute(f"""
+        SELECT {', '.join(values)}, {', '.join(lengths)}
+        FROM staged_sample ss
+        JOIN input_keys AS inp ON inp.key_id = ss.key_id
+        JOIN ref_preproc AS ref ON ref.ref_id = ss.ref_id
+    """).fetchall()
+    con.execute("DROP TABLE staged_sample;")
+    if not rows:
+        return declared, []
+
+    if args.engine == 'cdist':
+        from rapidfuzz import process
+
+        scorer_func, scale = rapidfuzz_scorer(args.scorer)
+        scores = [
+            (process.cpdist(
+                [row[2 * p] or "" for row in rows], [row[2 * p + 1] or "" for row in rows], scorer=scorer_func, workers=-1
+            ) * scale).tolist()
+            for p in declared
+        ]
+        length_offset = 2 * num_pairs
+    else:
+        scores = [[row[p] for row in rows] for p in declared]
+        length_offset = num_pairs
+    quadratic = args.engine == 'sql' and plan["length_metric"] == 'levenshtein' and not plan["using_rapidfuzz"]
+    costs = []
+    for p in declared:
+        inp_lens = [row[length_offset + 2 * p] or 0 for row in rows]
+        ref_lens = [row[length_offset + 2 * p + 1] or 0 for row in rows]
+        if quadratic:
+            costs.append(1 + sum(a * b for a, b in zip(inp_lens, ref_lens)) / len(rows))
+        else:
+            costs.append(1 + sum(a + b for a, b in zip(inp_lens, ref_lens)) / len(rows))
+
+    first_cutoff = stage_cutoff(num_pairs, 1, args.threshold)
+    alone = first_cutoff if first_cutoff > 0 else args.threshold
+    pass_rates = [sum(1 for v in scores[p] if v is not None and v >= alone) / len(rows) for p in declared]
+    order = sorted(declared, key=lambda p: (costs[p] / max(1.0 - pass_rates[p], 1e-9), costs[p], p))
+
+    guards = []
+    alive = list(range(len(rows)))
+    total_cost = sum(costs)
+    for k in range(1, num_pairs):
+        cutoff = stage_cutoff(num_pairs, k, args.threshold)
+        if cutoff <= 0 or not alive:
+            continue
+        passing = [
+            i for i in alive
+            if all(scores[p][i] is not None for p in order[:k])
+            and sum(scores[p][i] for p in order[:k]) >= cutoff - 1e-9
+        ]
+        if len(passing) / len(alive) < 1.0 - sum(costs[p] for p in order[:k]) / total_cost:
+            guards.append(k)
+            alive = passing
+    logging.debug(
+        "Staged scoring order: "
+        + ", ".join(f"{join_pairs[p].strip()} (pass {pass_rates[p]:.1%})" for p in order)
+        + f"; guards after {guards or 'none'}"
+    )
+    return order, guards
+
+
+def staged_score_expr(plan: dict, order: List[int], guards: List[int], threshold: float) -> str:
+    """``avg_score_expr`` wrapped in the stage guards of ``order_join_pairs()``.
+
+    Each guard checks the partial sum of the first ``k`` join pairs in
+    ``order`` against ``stage_cutoff()``. DuckDB evaluates a ``CASE`` branch
+    only for the rows that pass its condition, so a pair that fails a guard
+    gets a NULL score without the remaining distance calls. The average
+    itself is still summed in the declared pair order, so passing pairs
+    keep exactly the same score.
+    """
+    expr = plan["avg_score_expr"]
+    num_pairs = len(plan["join_pairs"])
+    for k in reversed(guards):
+        partial = " + ".join(plan["pair_score_exprs"][p] for p in order[:k])
+        # Small tolerance so floating point rounding never drops a borderline pair
+        expr = f"CASE WHEN {partial} >= {stage_cutoff(num_pairs, k, threshold)!r} - 1e-9 THEN {expr} END"
+    return expr
+
+
+def match_keys(
+    con: duckdb.DuckDBPyConnection,
+    args: "argparse.Namespace",
+    plan: dict,
+    executor=None,
+    work_dir: str = None,
+) -> int:
+    """Score the input rows of ``input_scope`` into the ``key_matches`` table.
+
+    ``plan`` comes from ``prepare_join()``. Returns the number of ambiguous
+    input rows; ``clean_output_sql()`` and ``ambiguous_output_sql()`` read
+    the result and ``drop_match_tables()`` clears it before the next scope.
+    """
+    join_pairs = plan["join_pairs"]
+    profile = plan["profile"]
+    candidate_table = prepare_keys(con, args, plan)
+    exact_prepass = args.scorer in EXACT_PREPASS_SCORERS
+
+    # Scoring runs lazily through the views below, when key_matches is built
+    profile_stage(profile, "scoring", con)
+    key_join = None
+    if args.engine == 'sql':
+        if candidate_table:
+            candidate_table = prune_candidates(con, args, plan, candidate_table)
+        key_join = scoring_join(args, plan, candidate_table, prune=candidate_table is None)
+    # The pair order is sampled on the first scope and reused by the next
+    # ones (chunks, batch inputs); match_records() resets it per request.
+    if plan.get("pair_order") is None:
+        plan["pair_order"] = order_join_pairs(con, args, plan, candidate_table, key_join)
+    order, guards = plan["pair_order"]
+    score_expr = plan["avg_score_expr"]
+    if args.engine == 'sql' and guards:
+        score_expr = staged_score_expr(plan, order, guards, args.threshold)
+
+    if executor:
+        # Workers score the partitions; the best-match and ambiguity logic
+        # below runs over their merged partial results.
+        partial_files = score_keys_partitioned(
+            con, join_pairs, args, executor, work_dir, candidate_table, key_join, score_expr,
+            plan["using_rapidfuzz"], plan["duckdb_settings"], order,
+        )
+        partial_scores = (
+            f"read_parquet([{', '.join(repr(f) for f in partial_files)}])" if partial_files
+            else "(SELECT 0::BIGINT AS key_id, 0::BIGINT AS ref_id, 0::DOUBLE AS avg_score WHERE false)"
+        )
+        con.execute(f"""
+            CREATE OR REPLACE TEMP VIEW fuzzy_scores AS
+            SELECT ps.key_id, ref.*, ps.avg_score
+            FROM {partial_scores} AS ps
+            JOIN ref_preproc AS ref ON ref.ref_id = ps.ref_id;
+        """)
+    elif args.engine == 'cdist':
+        score_keys_cdist(con, join_pairs, args, candidate_table, pair_order=order)
+        con.execute("""
+            CREATE OR REPLACE TEMP VIEW fuzzy_scores AS
+            SELECT cs.key_id, ref.*, cs.avg_score
+            FROM cdist_scores AS cs
+            JOIN ref_preproc AS ref ON ref.ref_id = cs.ref_id;
+        """)
+    else:
+        con.execute(f"""
+            CREATE OR REPLACE TEMP VIEW fuzzy_scores AS
+            SELECT inp.key_id, ref.*, {score_expr} AS avg_score
+            FROM ref_preproc AS ref
+            {key_join};
+        """)
+
+    if exact_prepass:
+        # Exact hits score 100; the fuzzy stage only re-finds them for keys
+        # with several exact hits, so its 100s are dropped to avoid duplicates.
+        con.execute("""
+            CREATE OR REPLACE TEMP VIEW key_scores AS
+            SELECT em.key_id, ref.*, CAST(100 AS DOUBLE) AS avg_score
+            FROM exact_matches em
+            JOIN ref_preproc ref ON ref.ref_id = em.ref_id
+            UNION ALL
+            SELECT * FROM fuzzy_scores WHERE avg_score < 100;
+        """)
+    else:
+        con.execute("CREATE OR REPLACE TEMP VIEW key_scores AS SELECT * FROM fuzzy_scores;")
+
+    # ------------------------------------------------------------------
+    # Single scoring pass: materialize only the above-threshold candidates
+    # per input key, with the best score, the number of candidates tied at
+    # the best score and the rank, in one windowed aggregation. Both output
+    # queries and the ambiguity count are served from this table.
+    # ------------------------------------------------------------------
+    # With --state, the keys known to the previous run get their stored rows back
+    state = plan.get("state")
+    reused_matches = ""
+    if state and state["loaded"]:
+        reused_matches = """
+            UNION ALL BY NAME
+            SELECT kh.key_id, sm.* EXCLUDE (key_hash)
+            FROM state_matches sm
+            JOIN key_hashes kh ON kh.key_hash = sm.key_hash
+        """
+    profiled_execute(con, f"""
+        CREATE TEMP TABLE key_matches AS
+        SELECT *, COUNT(*) FILTER (WHERE avg_score = best_score) OVER (PARTITION BY key_id) AS n_best
+        FROM (
+            SELECT ks.*,
+                   MAX(ks.avg_score) OVER (PARTITION BY ks.key_id) AS best_score,
+                   ROW_NUMBER() OVER (PARTITION BY ks.key_id ORDER BY ks.avg_score DESC) AS rnk
+            FROM key_scores ks
+            WHERE ks.avg_score >= {args.threshold}
+        ) t
+        {reused_matches};
+    """, profile)
+    if state:
+        record_state(con, plan)
+
+    profile_stage(profile, "ambiguity", con)
+    ambiguous_count = con.execute("""
+        SELECT COUNT(*)
+        FROM input_key_map ikm
+        JOIN key_matches km ON ikm.key_id = km.key_id AND km.rnk = 1 AND km.n_best > 1
+    """).fetchone()[0]
+    if profile is not None:
+        profile_rows(profile, "pairs_above_threshold", con.execute("SELECT COUNT(*) FROM key_matches").fetchone()[0])
+        profile_rows(profile, "matched_rows", con.execute("""
+            SELECT COUNT(*)
+            FROM input_key_map ikm
+            JOIN key_matches km ON ikm.key_id = km.key_id AND km.rnk = 1 AND km.n_best = 1
+        """).fetchone()[0])
+        profile_rows(profile, "ambiguous_rows", ambiguous_count)
+    profile_stage(profile, None, con)
+    return ambiguous_count
+
+
+def clean_output_sql(plan: dict) -> str:
+    """Clean output of the last ``match_keys()``: every input row, with its unique best match if any."""
+    # LEFT JOIN behavior - include ALL input records
+    return f"""
+        SELECT {plan["select_clean_cols"]}
+        FROM input_scope inp
+        JOIN input_key_map ikm ON inp.input_id = ikm.input_id
+        LEFT JOIN key_matches bst ON ikm.key_id = bst.key_id AND bst.rnk = 1 AND bst.n_best = 1
+        ORDER BY inp.input_id
+    """
+
+
+def ambiguous_output_sql(plan: dict) -> str:
+    """Ambiguous output of the last ``match_keys()``, in no particular order.
+
+    For every input row whose key has several candidates tied at the best
+    score (``n_best > 1``), one distinct row per above-threshold candidate of
+    that key, the tied ones and the lower-scored ones alike.
+    """
+    return f"""
+        SELECT DISTINCT {plan["select_ambiguous_cols"]}
+        FROM key_matches s
+        JOIN input_key_map ikm ON s.key_id = ikm.key_id
+        JOIN input_scope inp ON ikm.input_id = inp.input_id
+        WHERE s.n_best > 1
+    """
 
-    # Check dataset size and warn if --latinize might be slow
-    if args.latinize:
-        # Quick row count estimate
-        try:
-            input_count_res = con.execute(f"SELECT COUNT(*) FROM read_csv_auto('{args.input_file}', header=true, all_varchar=true)")
-            input_count = input_count_res.fetchone()[0]
 
-            ref_count_res = con.execute(f"SELECT COUNT(*) FROM read_csv_auto('{args.reference_file}', header=true, all_varchar=true)")
-            ref_count = ref_count_res.fetchone()[0]
+# Pairs scored to time the scoring expression in --estimate
+ESTIMATE_SAMPLE_PAIRS = 20_000
 
-            total_combinations = input_count * ref_count
 
-            if total_combinations > 10_000_000:  # 10 million combinations
-                logging.warning(f"Large dataset detected ({input_count:,} × {ref_count:,} = {total_combinations:,} combinations)")
-                logging.warning("--latinize option may cause significant performance impact on large datasets.")
-                logging.warning("Consider using smaller samples or removing --latinize for better performance.")
+def estimate_join(
+    con: duckdb.DuckDBPyConnection,
+    args: "argparse.Namespace",
+    plan: dict,
+    sample_pairs: int = ESTIMATE_SAMPLE_PAIRS,
+) -> dict:
+    """Plan the matching of ``input_scope`` without scoring it: the ``--estimate`` report.
 
-        except Exception as e:
-            logging.debug(f"Could not estimate dataset size: {e}")
+    Builds the distinct keys, the exact pre-pass and the blocking candidates
+    as a run would, and counts exactly the pairs it would score (after
+    length-bound pruning with the SQL engine). The largest blocks show the
+    skew: reference blocks with ``--block-prefix`` alone, otherwise the keys
+    with the most candidates. A sample of up to ``sample_pairs`` pairs is
+    scored; its time per pair projects the scoring time, and its share of
+    pairs above the threshold the size, and so the memory, of ``key_matches``.
+    """
+    import math
+
+    profile = plan["profile"]
+    candidate_table = prepare_keys(con, args, plan)
+    profile_stage(profile, "estimate", con)
 
-    using_rapidfuzz = try_load_rapidfuzz(con)
-    if using_rapidfuzz:
-        score_expr_base = choose_score_expr(True, join_pairs, args.scorer, args, True)
+    def count(sql: str) -> int:
+        return con.execute(sql).fetchone()[0] or 0
+
+    report = {
+        "join_pairs": plan["join_pairs"],
+        "input_rows": count("SELECT COUNT(*) FROM input_source"),
+        "distinct_input_rows": count("SELECT COUNT(*) FROM input_scope"),
+        "reference_rows": count("SELECT COUNT(*) FROM ref_preproc"),
+        "distinct_keys": count("SELECT COUNT(*) FROM input_distinct_keys"),
+        "keys_to_score": count("SELECT COUNT(*) FROM input_keys"),
+    }
+
+    # Without a candidate table the pairs follow from histograms of the
+    # cleaned lengths (and block keys) of both sides, so even a huge cross
+    # join is counted without being enumerated.
+    len_cols = [
+        [f'"{col.strip()}_len"' for col in pair.replace('"', '').replace("'", "").split(",")]
+        for pair in plan["join_pairs"]
+    ]
+    block_col = ["block_key"] if args.block_prefix and args.block_prefix > 0 else []
+    inp_lens = ', '.join([c[0] for c in len_cols] + block_col)
+    ref_lens = ', '.join([c[1] for c in len_cols] + block_col)
+    if candidate_table:
+        report["candidate_pairs"] = count(f"SELECT COUNT(*) FROM {candidate_table}")
+        largest = con.execute(f"""
+            SELECT concat_ws('|', {', '.join(f'inp.{c}' for c in plan["inp_clean_col_names"])}), COUNT(*) AS pairs
+            FROM {candidate_table} cp
+            JOIN input_keys inp ON inp.key_id = cp.key_id
+            GROUP BY ALL
+            ORDER BY pairs DESC
+            LIMIT 5
+        """).fetchall()
+        report["largest_blocks"] = [{"key": key, "pairs": pairs} for key, pairs in largest]
+        blocks_sql = f"SELECT key_id, COUNT(*) AS pairs FROM {candidate_table} GROUP BY key_id"
+        report["block_pairs"] = {label: blocks for label, blocks, _ in block_pairs_histogram(con, blocks_sql)}
+        # --engine cdist scores every candidate pair, without length pruning
+        if args.engine == 'sql':
+            candidate_table = prune_candidates(con, args, plan, candidate_table)
+        pruned_pairs = count(f"SELECT COUNT(*) FROM {candidate_table}")
+        key_join = scoring_join(args, plan, candidate_table, prune=False)
     else:
-        try:
-            con.execute("SELECT levenshtein('a','b')")
-            score_expr_base = choose_score_expr(False, join_pairs, args.scorer, args, True)
-        except Exception:
+        key_join = scoring_join(args, plan, prune=args.engine == 'sql')
+        if block_col:
+            buckets = block_pairs_histogram(con, PREFIX_BLOCK_PAIRS_SQL)
+            report["candidate_pairs"] = sum(pairs for _, _, pairs in buckets)
+            report["block_pairs"] = {label: blocks for label, blocks, _ in buckets}
+            largest = con.execute(f"""
+                SELECT block_key, input_keys, reference_rows, pairs
+                FROM ({PREFIX_BLOCK_PAIRS_SQL}) t
+                ORDER BY pairs DESC, block_key
+                LIMIT 5
+            """).fetchall()
+            report["largest_blocks"] = [
+                {"block_key": key, "input_keys": n_inp, "reference_rows": n_ref, "pairs": pairs}
+                for key, n_inp, n_ref, pairs in largest
+            ]
+        else:
+            report["candidate_pairs"] = report["keys_to_score"] * report["reference_rows"]
+            report["largest_blocks"] = []
+            report["block_pairs"] = {}
+        inp_hist = f"SELECT {inp_lens}, COUNT(*) AS n FROM input_keys GROUP BY ALL"
+        ref_hist = f"SELECT {ref_lens}, COUNT(*) AS n FROM ref_preproc GROUP BY ALL"
+        hist_join = key_join.replace("input_keys AS inp", f"({inp_hist}) AS inp")
+        pruned_pairs = count(f"SELECT SUM(inp.n * ref.n) FROM ({ref_hist}) AS ref {hist_join}")
+    report["pairs_to_score"] = pruned_pairs
+    order, guards = order_join_pairs(con, args, plan, candidate_table, key_join)
+    score_expr = plan["avg_score_expr"]
+    if args.engine == 'sql' and guards:
+        score_expr = staged_score_expr(plan, order, guards, args.threshold)
+    if report["largest_blocks"] and report["candidate_pairs"]:
+        report["largest_block_share"] = round(report["largest_blocks"][0]["pairs"] / report["candidate_pairs"], 4)
+
+    def score_sample(n_pairs: int) -> tuple:
+        """Score a random sample of keys with up to ``n_pairs`` of their pairs; ``(pairs, above threshold, seconds)``."""
+        n_keys = 0
+        if report["pairs_to_score"]:
+            n_keys = min(
+                report["keys_to_score"],
+                max(1, math.ceil(n_pairs * report["keys_to_score"] / report["pairs_to_score"])),
+            )
+        # Drawing the sample is not part of the timing
+        con.execute(f"""
+            CREATE TEMP TABLE estimate_sample AS
+            SELECT * FROM input_keys USING SAMPLE reservoir({n_keys} ROWS) REPEATABLE (42);
+        """)
+        sample_join = key_join.replace("input_keys AS inp", "estimate_sample AS inp")
+        if args.engine == 'cdist' and not candidate_table:
+            # Without candidates cdist scores whole key x reference matrices
+            pairs = count(f"SELECT COUNT(*) FROM ref_preproc AS ref {sample_join}")
+            start = time.perf_counter()
+            above = score_keys_cdist(con, plan["join_pairs"], args, keys_table="estimate_sample", pair_order=order)
+        else:
+            con.execute(f"""
+                CREATE TEMP TABLE estimate_pairs AS
+                SELECT inp.key_id, ref.ref_id FROM ref_preproc AS ref {sample_join} LIMIT {int(n_pairs)};
+            """)
+            pairs = count("SELECT COUNT(*) FROM estimate_pairs")
+            start = time.perf_counter()
+            if args.engine == 'cdist':
+                above = score_keys_cdist(
+                    con, plan["join_pairs"], args, "estimate_pairs", keys_table="estimate_sample", pair_order=order
+                )
+            else:
+                above = count(f"""
+                    SELECT COUNT(*)
+                    FROM (
+                        SELECT {score_expr} AS avg_score
+                        FROM estimate_pairs ep
+                        JOIN estimate_sample AS inp ON inp.key_id = ep.key_id
+                        JOIN ref_preproc AS ref ON ref.ref_id = ep.ref_id
+                    ) t
+                    WHERE avg_score >= {args.threshold}
+                """)
+        seconds = time.perf_counter() - start
+        for table in ("estimate_sample", "estimate_pairs", "cdist_scores"):
+            con.execute(f"DROP TABLE IF EXISTS {table};")
+        return pairs, above, seconds
+
+    # Two sample sizes separate the fixed cost of a scoring pass (setup,
+    # result writes) from the cost per pair
+    small_pairs, _, small_seconds = score_sample(sample_pairs // 4)
+    sampled, above, sample_seconds = score_sample(sample_pairs)
+    if sampled > small_pairs and sample_seconds > small_seconds:
+        seconds_per_pair = (sample_seconds - small_seconds) / (sampled - small_pairs)
+    else:
+        seconds_per_pair = sample_seconds / sampled if sampled else 0.0
+    fixed_seconds = max(0.0, sample_seconds - seconds_per_pair * sampled)
+    above_share = above / sampled if sampled else 0.0
+    projected_matches = round(report["pairs_to_score"] * above_share)
+    # A key_matches row is a reference row plus a few numeric columns
+    ref_row_bytes = count("SELECT AVG(strlen(concat_ws('', *COLUMNS(*)))) FROM ref_preproc") + 48
+    report.update({
+        "sample_pairs": sampled,
+        "sample_seconds": round(sample_seconds, 4),
+        "pairs_per_second": round(sampled / sample_seconds) if sample_seconds else None,
+        "sample_above_threshold": round(above_share, 4),
+        "projected_scoring_seconds": round(fixed_seconds + report["pairs_to_score"] * seconds_per_pair, 1),
+        "projected_matches": projected_matches,
+        "projected_memory_mb": round((peak_rss_mb() or 0) + projected_matches * ref_row_bytes / 2**20, 1),
+    })
+    if plan["inferred_pairs"]:
+        report["inferred_pairs"] = [c for c in plan["inferred_pairs"] if c["confidence"] > 0]
+    profile_stage(profile, None, con)
+    return report
+
+
+def check_budget(report: dict, args: "argparse.Namespace") -> List[str]:
+    """The ``--max-*`` budgets the ``--estimate`` report exceeds, as messages (empty when within budget)."""
+    exceeded = []
+    if args.max_pairs is not None and report["pairs_to_score"] > args.max_pairs:
+        exceeded.append(f"{report['pairs_to_score']:,} pairs to score > --max-pairs {args.max_pairs:,}")
+    if args.max_seconds is not None and report["projected_seconds"] > args.max_seconds:
+        exceeded.append(f"projected {report['projected_seconds']:,} s > --max-seconds {args.max_seconds:,}")
+    if args.max_memory is not None:
+        max_memory_mb = parse_memory_size(args.max_memory) / 2**20
+        if report["projected_memory_mb"] > max_memory_mb:
+            exceeded.append(f"projected {report['projected_memory_mb']:,} MB > --max-memory {args.max_memory}")
+    return exceeded
+
+
+MATCH_TABLES = (
+    "input_distinct_keys", "exact_matches", "candidate_pairs", "scoring_pairs", "scoring_pairs_lengths",
+    "staged_sample", "cdist_scores", "key_matches", "estimate_sample", "estimate_pairs", "key_hashes",
+)
+
+# Per-pass tables and blocking helpers are named after candidate_pairs
+MATCH_TABLE_PREFIXES = ("candidate_pairs_",)
+
+PIPELINE_VIEWS = (
+    "key_scores", "fuzzy_scores", "input_key_map", "input_keys", "changed_keys", "ref_preproc", "input_preproc",
+    "input_scope", "input_rows", "input_with_id", "input_source", "input_chunk",
+)
+
+PIPELINE_TABLES = ("ref_preproc", "ref_source", "input_source", "input_scope", "input_seen")
+
+
+def drop_match_tables(con: duckdb.DuckDBPyConnection) -> None:
+    """Drop the temp tables built by ``match_keys()``, with any helper left by an interrupted run."""
+    # Qualified with temp: an unqualified name would reach a main table of the same name
+    for table in MATCH_TABLES:
+        con.execute(f"DROP TABLE IF EXISTS temp.{table};")
+    prefixes = " OR ".join(f"starts_with(table_name, '{prefix}')" for prefix in MATCH_TABLE_PREFIXES)
+    helpers = con.execute(f"SELECT table_name FROM duckdb_tables() WHERE temporary AND ({prefixes})").fetchall()
+    for (helper,) in helpers:
+        con.execute(f"DROP TABLE temp.{helper};")
+
+
+def drop_pipeline(con: duckdb.DuckDBPyConnection) -> None:
+    """Drop every temp table and view built by ``prepare_join()`` and ``match_keys()``, and the reference indexes."""
+    drop_match_tables(con)
+    # ref_preproc, input_source and input_scope are views or tables depending on the run
+    views = {name for (name,) in con.execute("SELECT view_name FROM duckdb_views() WHERE temporary").fetchall()}
+    for view in PIPELINE_VIEWS:
+        if view in views:
+            con.execute(f"DROP VIEW temp.{view};")
+    for table in PIPELINE_TABLES:
+        if table not in views:
+            con.execute(f"DROP TABLE IF EXISTS temp.{table};")
+    indexes = con.execute(
+        "SELECT table_name FROM duckdb_tables() WHERE temporary AND starts_with(table_name, 'ref_index_')"
+    ).fetchall()
+    for (index,) in indexes:
+        con.execute(f"DROP TABLE temp.{index};")
+
+
+FuzzyJoinResult = namedtuple("FuzzyJoinResult", ["clean", "ambiguous"])
+
+# Options that only make sense for file outputs
+FUZZY_JOIN_CLI_OPTIONS = (
+    "output_clean", "output_ambiguous", "output_format", "chunk_size", "resume", "force", "profile",
+    "estimate", "max_pairs", "max_seconds", "max_memory", "state",
+)
+
+
+def fuzzy_join(
+    input,
+    reference,
+    pairs: List[str] = None,
+    threshold: float = 85,
+    add_fields: List[str] = None,
+    show_score: bool = False,
+    scorer: str = "ratio",
+    con: duckdb.DuckDBPyConnection = None,
+    output: str = "arrow",
+    **options,
+) -> FuzzyJoinResult:
+    """Fuzzy join ``input`` to ``reference`` in memory and return the results.
+
+    ``input`` and ``reference`` are file paths (any format the command line
+    reads), DuckDB relations, Arrow tables or datasets, or DataFrames.
+    ``pairs`` lists ``"input_col,ref_col"`` join pairs (inferred from the
+    common column names when omitted). Other command-line options are
+    accepted as keyword arguments with their long name, e.g.
+    ``block="ngram"`` or ``latinize=True``.
+
+    The join runs on a cursor of ``con`` when given (the ``threads``,
+    ``memory_limit`` and ``temp_directory`` options change its resource
+    settings for the duration of the call only), otherwise on a new
+    in-memory connection. The cursor has its
+    own temp catalog, so the working tables never touch the caller's
+    objects; relations over the caller's temp tables are copied to Arrow
+    first. With ``output="arrow"`` the clean and ambiguous results are
+    ``pyarrow.Table`` objects; with ``output="relation"`` they are DuckDB
+    relations over temp tables private to the call. Raises
+    ``FuzzyJoinError`` for invalid options or inputs.
+    """
+    if output not in ("arrow", "relation"):
+        raise ValueError(f"output must be 'arrow' or 'relation', not {output!r}")
+    if output == "arrow":
+        _import_pyarrow()
+
+    def path_or_placeholder(source, placeholder):
+        return os.fspath(source) if isinstance(source, (str, os.PathLike)) else placeholder
+
+    args = parse_args([path_or_placeholder(input, "<input>"), path_or_placeholder(reference, "<reference>")])
+    args.join_pair = [pairs] if isinstance(pairs, str) else (list(pairs) if pairs else None)
+    args.threshold = threshold
+    args.add_field = [add_fields] if isinstance(add_fields, str) else (list(add_fields) if add_fields else None)
+    args.show_score = show_score
+    args.scorer = scorer
+    for name, value in options.items():
+        if name in FUZZY_JOIN_CLI_OPTIONS or not hasattr(args, name):
+            raise TypeError(f"fuzzy_join() got an unexpected keyword argument {name!r}")
+        if name == "block" and isinstance(value, str):
+            # --block can be repeated: accept one spec or a list of them
+            value = [value]
+        setattr(args, name, value)
+
+    own_con = con is None
+    if own_con:
+        con = duckdb.connect(database=":memory:")
+    caller_con = con
+    # The pipeline's fixed-name temp tables live in the cursor's private temp catalog
+    con = caller_con.cursor()
+    # The resource settings are database-wide: the caller's are restored on return
+    resource_settings = ("threads", "memory_limit", "temp_directory")
+    settings_sql = f"SELECT {', '.join(f'current_setting({name!r})' for name in resource_settings)}"
+    saved_settings = con.execute(settings_sql).fetchone()
+
+    def register(source, name):
+        if isinstance(source, (str, os.PathLike)):
+            return None
+        if isinstance(source, duckdb.DuckDBPyRelation):
             try:
-                con.execute("SELECT damerau_levenshtein('a','b')")
-                exprs = []
-                for pair in join_pairs:
-                    inp_col, ref_col = [c.strip().replace('"', '').replace("'", "") for c in pair.split(",")]
-                    inp_expr = f'inp."{inp_col}_clean"'
-                    ref_expr = f'ref."{ref_col}_clean"'
-                    exprs.append(
-                        f"(1.0 - CAST(damerau_levenshtein({ref_expr}, {inp_expr}) AS DOUBLE) "
-                        f"/ NULLIF(GREATEST(LENGTH({ref_expr}), LENGTH({inp_expr})),0)) * 100"
-                    )
-                score_expr_base = " + ".join(exprs)
-            except Exception:
-                logging.error("No fuzzy function available in DuckDB (rapidfuzz, levenshtein or damerau_levenshtein). Install the rapidfuzz extension or use a DuckDB version that includes levenshtein.")
-                sys.exit(1)
+                # Relations over files or persistent tables stay lazy
+                con.execute(f"CREATE TEMP VIEW {name} AS {source.sql_query()}")
+                return name
+            except duckdb.Error:
+                # Temp tables, registered objects or another connection: bring the rows over
+                source = source.to_arrow_table() if hasattr(source, "to_arrow_table") else source.arrow()
+        con.register(name, source)
+        return name
 
-    # avg_score = (score_expr_base) / num_pairs
-    num_pairs = len(join_pairs)
-    avg_score_expr = f"({score_expr_base}) / {num_pairs}"
+    executor = None
+    work_dir = None
+    try:
+        plan = prepare_join(
+            con, args, register(input, "fuzzy_join_input"), register(reference, "fuzzy_join_reference")
+        )
+        executor = worker_pool(args)
+        if executor:
+            work_dir = tempfile.mkdtemp(prefix="tometo_tomato_", dir=args.temp_directory)
+        match_keys(con, args, plan, executor, work_dir)
 
-    # ------------------------------------------------------------------
-    # Pre-process the join columns once so the CROSS JOIN only executes
-    # the distance function, not the expensive cleaning logic.
-    # ------------------------------------------------------------------
-    def _build_clean_expr(table_alias: str, column: str) -> str:
-        expr = f'{table_alias}."{column}"'
-        if not args.raw_whitespace:
-            expr = f"trim(regexp_replace({expr}, '\\s+', ' ', 'g'))"
-        if args.latinize:
-            expr = f"strip_accents({expr})"
-        if args.keep_alphanumeric:
-            expr = f"regexp_replace({expr}, '[^a-zA-Z0-9 ]', '', 'g')"
-        if not args.raw_case:
-            expr = f"lower({expr})"
-        return expr
+        queries = (clean_output_sql(plan), ambiguous_output_sql(plan))
+        if output == "arrow":
+            results = []
+            for query in queries:
+                result = con.execute(query)
+                results.append(result.to_arrow_table() if hasattr(result, "to_arrow_table") else result.fetch_arrow_table())
+        else:
+            results = []
+            for kind, query in zip(("clean", "ambiguous"), queries):
+                con.execute(f"CREATE TEMP TABLE fuzzy_join_{kind} AS {query}")
+                results.append(con.table(f"fuzzy_join_{kind}"))
+        return FuzzyJoinResult(*results)
+    finally:
+        if executor:
+            executor.shutdown()
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        for name, saved, current in zip(resource_settings, saved_settings, con.execute(settings_sql).fetchone()):
+            if current != saved:
+                con.execute(f"SET {name} = '{saved}';")
+        drop_pipeline(con)
+        con.execute("DROP VIEW IF EXISTS temp.fuzzy_join_input; DROP VIEW IF EXISTS temp.fuzzy_join_reference;")
+        if output == "arrow":
+            con.close()
+            if own_con:
+                caller_con.close()
 
-    # Create temporary views for common CTEs
-    # Extract unique input columns from join_pairs for SQL selection
-    input_join_cols_for_sql = set()
-    for pair in join_pairs:
-        inp_col = pair.split(",")[0].strip().replace('"', '').replace("'", "")
-        input_join_cols_for_sql.add(f'"{inp_col}"')
-    input_join_cols_for_sql_list = sorted(list(input_join_cols_for_sql))
-    input_cols_for_cte = ", ".join(input_join_cols_for_sql_list)
 
-    # Build WHERE clause to filter out empty rows based on join columns
-    where_clause_parts = []
-    for col in input_join_cols_for_sql_list:
-        where_clause_parts.append(f"{col} IS NOT NULL AND {col} != ''")
-    where_clause = " AND ".join(where_clause_parts)
-    if where_clause:
-        where_clause = f"WHERE {where_clause}"
+def prepare_server(args: "argparse.Namespace"):
+    """Prepare the reference of ``tometo_tomato serve`` once; returns ``(con, plan)``.
 
-    con.execute(f"""
-        CREATE TEMP VIEW input_with_id AS
-        SELECT ROW_NUMBER() OVER () AS input_id, {input_cols_for_cte}
-        FROM read_csv_auto('{args.input_file}', header=true, all_varchar=true)
-        {where_clause};
-    """)
+    The input side is an empty ``input_source`` table with the input join
+    columns, refilled by ``match_records()`` for every request.
+    """
+    if not args.join_pair:
+        raise FuzzyJoinError("serve needs the join pairs (-j input_col,ref_col): there is no input file to infer them from.")
+    input_cols = sorted({pair.split(",")[0].strip().replace('"', '').replace("'", "") for pair in args.join_pair})
+    nulls = ", ".join(f'NULL::VARCHAR AS "{c}"' for c in input_cols)
+    empty_input = f"(SELECT {nulls} WHERE false)"
+    con = duckdb.connect(database=":memory:")
+    plan = prepare_join(con, args, input_source=empty_input, reuse_reference=True)
+    return con, plan
 
-    input_clean_cols_sql = []
-    ref_clean_cols_sql = []
-    inp_clean_col_names = []
-    for pair in join_pairs:
-        inp_col, ref_col = [c.strip().replace('"', '').replace("'", "") for c in pair.split(",")]
-        input_clean_cols_sql.append(f"{_build_clean_expr('inp', inp_col)} AS \"{inp_col}_clean\"")
-        ref_clean_cols_sql.append(f"{_build_clean_expr('ref', ref_col)} AS \"{ref_col}_clean\"")
-        inp_clean_col_names.append(f'"{inp_col}_clean"')
 
-    con.execute(f"""
-        CREATE TEMP VIEW input_preproc AS
-        SELECT inp.input_id, {', '.join(input_clean_cols_sql)}
-        {',' if args.block_prefix and args.block_prefix > 0 else ''}
-        {(" || '|' || ".join([f"substr(" + _build_clean_expr('inp', pair.split(',')[0].strip().replace('"','').replace("'",'')) + f", 1, {args.block_prefix})" for pair in join_pairs])) + " AS block_key" if args.block_prefix and args.block_prefix > 0 else ''}
-        FROM input_with_id inp;
-    """)
+def match_records(con: duckdb.DuckDBPyConnection, args: "argparse.Namespace", plan: dict, records: list) -> list:
+    """Match a batch of records (dicts keyed by input column) in one pipeline run.
 
-    con.execute(f"""
-        CREATE TEMP VIEW ref_preproc AS
-        SELECT ref.*, {', '.join(ref_clean_cols_sql)}
-        {',' if args.block_prefix and args.block_prefix > 0 else ''}
-        {(" || '|' || ".join([f"substr(" + _build_clean_expr('ref', pair.split(',')[1].strip().replace('"','').replace("'",'')) + f", 1, {args.block_prefix})" for pair in join_pairs])) + " AS block_key" if args.block_prefix and args.block_prefix > 0 else ''}
-        FROM read_csv_auto('{args.reference_file}', header=true, all_varchar=true) AS ref;
-    """)
+    Same semantics as the batch outputs: a record gets ``"status": "match"``
+    and its unique best reference row, ``"ambiguous"`` and every candidate
+    above the threshold (the rows the ambiguous output would list), or
+    ``"no_match"``. A record's ``"id"``, if any, is echoed back. The join
+    pair order is sampled from each batch's own pairs, since requests are
+    unrelated to each other.
+    """
+    if not all(isinstance(record, dict) for record in records):
+        raise FuzzyJoinError("Each record must be a JSON object keyed by input column.")
+    input_cols = plan["input_columns"]
+    ref_cols = plan["reference_columns"]
+    values = [
+        tuple(None if record.get(c) is None else str(record[c]) for c in input_cols) for record in records
+    ]
+    con.execute("DELETE FROM input_source;")
+    if values:
+        row = f"({', '.join('?' for _ in input_cols)})"
+        con.execute(
+            f"INSERT INTO input_source VALUES {', '.join(row for _ in values)};",
+            [value for record_values in values for value in record_values],
+        )
+    plan["pair_order"] = None
+    try:
+        match_keys(con, args, plan)
+        # The unique best candidate of matched rows, every candidate of ambiguous ones
+        rows = con.execute(f"""
+            SELECT {', '.join(f'inp."{c}"' for c in input_cols)}, {', '.join(f'km."{c}"' for c in ref_cols)}, km.avg_score
+            FROM input_scope inp
+            JOIN input_key_map ikm ON ikm.input_id = inp.input_id
+            JOIN key_matches km ON km.key_id = ikm.key_id AND (km.rnk = 1 OR km.n_best > 1)
+            ORDER BY inp.input_id, km.avg_score DESC, km.ref_id
+        """).fetchall()
+    finally:
+        drop_match_tables(con)
+
+    candidates = {}
+    for row in rows:
+        candidate = dict(zip(ref_cols, row[len(input_cols):-1]))
+        candidate["score"] = row[-1]
+        candidates.setdefault(tuple(row[:len(input_cols)]), []).append(candidate)
+
+    responses = []
+    for record, record_values in zip(records, values):
+        response = {"id": record["id"]} if "id" in record else {}
+        found = candidates.get(record_values, [])
+        if len(found) == 1:
+            response.update(status="match", match=found[0])
+        elif found:
+            response.update(status="ambiguous", candidates=found)
+        else:
+            response["status"] = "no_match"
+        responses.append(response)
+    return responses
+
+
+def latency_report(stats: dict) -> dict:
+    """Request count and p50/p99 latency (nearest rank, milliseconds) of a ``serve`` session."""
+    import math
+
+    latencies = sorted(stats["latencies_ms"])
+
+    def percentile(p: float):
+        if not latencies:
+            return None
+        return round(latencies[max(0, math.ceil(p / 100 * len(latencies)) - 1)], 3)
+
+    return {
+        "requests": stats["requests"],
+        "records": stats["records"],
+        "p50_ms": percentile(50),
+        "p99_ms": percentile(99),
+    }
 
-    # ------------------------------------------------------------------
-    # DISTINCT optimization: deduplicate input join keys before the
-    # expensive CROSS JOIN so fuzzy matching runs only on unique combos.
-    # ------------------------------------------------------------------
-    clean_cols_csv = ', '.join(inp_clean_col_names)
-    block_key_col = ', block_key' if args.block_prefix and args.block_prefix > 0 else ''
 
+def handle_request(con: duckdb.DuckDBPyConnection, args: "argparse.Namespace", plan: dict, stats: dict, payload):
+    """Answer one JSON request: a record gets one response, a list of records a list of responses."""
+    import json
+
+    start = time.perf_counter()
+    try:
+        request = json.loads(payload)
+        if isinstance(request, list):
+            response = match_records(con, args, plan, request)
+        else:
+            response = match_records(con, args, plan, [request])[0]
+        stats["records"] += len(request) if isinstance(request, list) else 1
+    except (ValueError, FuzzyJoinError, duckdb.Error) as e:
+        response = {"error": str(e)}
+    stats["requests"] += 1
+    stats["latencies_ms"].append((time.perf_counter() - start) * 1000)
+    return response
+
+
+def serve_http(con, args, plan, stats: dict, address: str) -> None:
+    """Answer ``POST /match`` and ``GET /stats`` on ``[HOST:]PORT``, one request at a time."""
+    import json
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    host, _, port = address.rpartition(":")
+    try:
+        port = int(port)
+    except ValueError:
+        raise FuzzyJoinError(f"Invalid --http address '{address}': expected [HOST:]PORT.")
+
+    class MatchHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != "/match":
+                self.send_error(404)
+                return
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            response = handle_request(con, args, plan, stats, body)
+            self.reply(400 if isinstance(response, dict) and "error" in response else 200, response)
+
+        def do_GET(self):
+            if self.path != "/stats":
+                self.send_error(404)
+                return
+            self.reply(200, latency_report(stats))
+
+        def reply(self, status: int, response) -> None:
+            body = json.dumps(response, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *log_args):
+            logging.debug(format % log_args)
+
+    # A single-threaded server: requests share the one DuckDB connection
+    server = HTTPServer((host or "127.0.0.1", port), MatchHandler)
+    logging.info(f"Listening on http://{host or '127.0.0.1'}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def serve_main(argv: List[str] = None) -> None:
+    """``tometo_tomato serve``: prepare the reference once and answer match requests.
+
+    Requests are JSON lines on stdin (answered in order on stdout) or HTTP
+    with ``--http``. On exit the latency report is written to stderr as JSON.
+    """
+    import json
+    from collections import deque
+
+    args = parse_args(argv, mode="serve")
+    configure_logging(args)
+    try:
+        con, plan = prepare_server(args)
+    except FuzzyJoinError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    # Latencies of the most recent requests feed the percentiles
+    stats = {"requests": 0, "records": 0, "latencies_ms": deque(maxlen=100_000)}
+    logging.info("Reference ready, waiting for requests")
+
+    try:
+        if args.http:
+            serve_http(con, args, plan, stats, args.http)
+        else:
+            for line in sys.stdin:
+                if not line.strip():
+                    continue
+                response = handle_request(con, args, plan, stats, line)
+                sys.stdout.write(json.dumps(response, ensure_ascii=False) + "\n")
+                sys.stdout.flush()
+    except FuzzyJoinError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+    sys.stderr.write(json.dumps(latency_report(stats)) + "\n")
+
+
+def expand_inputs(patterns: List[str]) -> List[str]:
+    """Input files of ``tometo_tomato batch``: existing paths as given, glob patterns expanded and sorted."""
+    import glob
+
+    paths = []
+    for pattern in patterns:
+        matches = [pattern] if os.path.exists(pattern) else sorted(glob.glob(pattern))
+        if not matches:
+            raise FuzzyJoinError(f"No input file matches '{pattern}'.")
+        paths.extend(path for path in matches if path not in paths)
+    return paths
+
+
+def batch_output_path(template: str, input_path: str) -> str:
+    """Fill an output template: ``{stem}`` is the input file name without extensions, ``{name}`` the file name."""
+    name = os.path.basename(input_path)
+    stem = name
+    if stem.lower().endswith((".gz", ".zst")):
+        stem = os.path.splitext(stem)[0]
+    stem = os.path.splitext(stem)[0]
+    try:
+        return template.format(stem=stem, name=name)
+    except (KeyError, IndexError, ValueError) as e:
+        raise FuzzyJoinError(f"Invalid output template '{template}' (fields are {{stem}} and {{name}}): {e}")
+
+
+def restage_input(con: duckdb.DuckDBPyConnection, args: "argparse.Namespace", plan: dict, path: str) -> None:
+    """Replace the staged input of a prepared join with the file ``path``; the reference stays as prepared."""
+    try:
+        columns = read_header(path, args.ref_cache)
+    except (ImportError, duckdb.Error) as e:
+        raise FuzzyJoinError(f"Cannot read {path}: {e}")
+    for column in plan["input_columns"]:
+        if column not in columns:
+            raise FuzzyJoinError(f"Column '{column}' not found in input file {path}. Available columns: {', '.join(columns)}")
     con.execute(f"""
-        CREATE TEMP VIEW input_keys AS
-        SELECT ROW_NUMBER() OVER () AS key_id, t.*
-        FROM (
-            SELECT DISTINCT {clean_cols_csv}{block_key_col}
-            FROM input_preproc
-        ) t;
+        CREATE OR REPLACE TEMP TABLE input_source AS
+        SELECT * FROM {projected_source_sql(con, path, plan["input_columns"], args.ref_cache)};
     """)
 
-    join_on_clauses = ' AND '.join(
-        [f'ip.{col} IS NOT DISTINCT FROM ik.{col}' for col in inp_clean_col_names]
-    )
-    if args.block_prefix and args.block_prefix > 0:
-        join_on_clauses += ' AND ip.block_key IS NOT DISTINCT FROM ik.block_key'
 
+def spill_input(con: duckdb.DuckDBPyConnection, path: str) -> int:
+    """Copy the input of a chunked run to the Parquet file ``path`` in one streaming scan; return its row count."""
+    safe_path = path.replace("'", "''")
+    con.execute(f"COPY (SELECT * FROM input_source) TO '{safe_path}' (FORMAT PARQUET);")
+    return con.execute(f"SELECT COUNT(*) FROM read_parquet('{safe_path}')").fetchone()[0]
+
+
+def scope_input_chunk(con: duckdb.DuckDBPyConnection, plan: dict, path: str, chunk_id: int, chunk_size: int) -> None:
+    """Point ``input_chunk`` at chunk ``chunk_id`` of the input spilled by ``spill_input()``.
+
+    Only the row range of the chunk is read from the Parquet file, and its
+    ``input_rows`` are materialized as ``input_scope``. The keys of the chunk
+    scoped before are added to ``input_seen`` first, so ``input_rows`` leaves
+    out the keys an earlier chunk already matched: chunks are scoped in
+    order, the ones skipped by --resume included.
+    """
+    con.execute(f"INSERT INTO input_seen SELECT {plan['input_key_hash']} FROM input_scope;")
+    safe_path = path.replace("'", "''")
+    first = chunk_id * chunk_size
     con.execute(f"""
-        CREATE TEMP VIEW input_key_map AS
-        SELECT ip.input_id, ik.key_id
-        FROM input_preproc ip
-        JOIN input_keys ik ON {join_on_clauses};
+        CREATE OR REPLACE TEMP VIEW input_chunk AS
+        SELECT * EXCLUDE (file_row_number), file_row_number + 1 AS input_id
+        FROM read_parquet('{safe_path}', file_row_number = true)
+        WHERE file_row_number >= {first} AND file_row_number < {first + chunk_size};
     """)
+    con.execute("CREATE OR REPLACE TEMP TABLE input_scope AS SELECT * FROM input_rows;")
 
-    if args.block_prefix and args.block_prefix > 0:
-        con.execute(f"""
-            CREATE TEMP VIEW key_scores AS
-            SELECT inp.key_id, ref.*, {avg_score_expr} AS avg_score
-            FROM ref_preproc AS ref
-            JOIN input_keys AS inp
-              ON ref.block_key = inp.block_key;
-        """)
+
+def batch_main(argv: List[str] = None) -> None:
+    """``tometo_tomato batch``: match many input files against one reference, prepared once.
+
+    The files are matched one after the other on the same connection; each
+    one gets its own clean (and ambiguous) output from the templates. A file
+    that cannot be matched is reported and skipped, and the exit status is 1.
+    Ends with a summary of the match rates per file on stdout.
+    """
+    args = parse_args(argv, mode="batch")
+    configure_logging(args)
+    try:
+        inputs = expand_inputs(args.input_files)
+        outputs = [
+            (
+                batch_output_path(args.output_clean, path),
+                batch_output_path(args.output_ambiguous, path) if args.output_ambiguous else None,
+            )
+            for path in inputs
+        ]
+        clean_paths = [clean for clean, _ in outputs]
+        if len(set(clean_paths)) < len(clean_paths):
+            raise FuzzyJoinError(f"The output template '{args.output_clean}' gives several inputs the same output; use {{stem}} or {{name}}.")
+        # The first file stands for every input while the matching plan is built
+        args.input_file = inputs[0]
+        con = duckdb.connect(database=":memory:")
+        plan = prepare_join(con, args, reuse_reference=True)
+    except FuzzyJoinError as e:
+        logging.error(str(e))
+        sys.exit(1)
+
+    for clean_path in clean_paths:
+        if not check_file_overwrite(clean_path, args.force):
+            logging.error("Operation cancelled: will not overwrite existing file.")
+            sys.exit(1)
+
+    executor = worker_pool(args)
+    summary = []
+    for path, (clean_path, ambiguous_path) in zip(inputs, outputs):
+        output_format = args.output_format or file_format(clean_path)
+        try:
+            if path != inputs[0]:
+                restage_input(con, args, plan, path)
+            if output_format == "arrow":
+                _import_pyarrow()
+        except (FuzzyJoinError, ImportError) as e:
+            logging.error(str(e))
+            summary.append({"file": path, "error": True})
+            continue
+        work_dir = tempfile.mkdtemp(prefix="tometo_tomato_", dir=args.temp_directory) if executor else None
+        ambiguous_count = match_keys(con, args, plan, executor, work_dir)
+        copy_query(con, clean_output_sql(plan), clean_path, output_format)
+        if ambiguous_path and ambiguous_count > 0:
+            if check_file_overwrite(ambiguous_path, args.force):
+                copy_query(con, ambiguous_output_sql(plan), ambiguous_path, output_format)
+            else:
+                logging.error(f"Not overwriting existing ambiguous file {ambiguous_path}.")
+        rows, matched = con.execute("""
+            SELECT COUNT(*), COUNT(km.key_id)
+            FROM input_key_map ikm
+            LEFT JOIN key_matches km ON km.key_id = ikm.key_id AND km.rnk = 1 AND km.n_best = 1
+        """).fetchone()
+        drop_match_tables(con)
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        summary.append({"file": path, "rows": rows, "matched": matched, "ambiguous": ambiguous_count})
+        logging.info(f"{path}: {matched:,} of {rows:,} rows matched, saved to {clean_path}")
+
+    if executor:
+        executor.shutdown()
+
+    # Rows are distinct input rows with non-empty join columns, as in the clean output
+    width = max(len("file"), *(len(entry["file"]) for entry in summary))
+    print(f"{'file':<{width}}  {'rows':>9}  {'matched':>9}  {'ambiguous':>9}  {'unmatched':>9}  {'match rate':>10}")
+    for entry in summary:
+        if entry.get("error"):
+            print(f"{entry['file']:<{width}}  {'failed':>9}")
+            continue
+        unmatched = entry["rows"] - entry["matched"] - entry["ambiguous"]
+        rate = f"{100 * entry['matched'] / entry['rows']:.1f}%" if entry["rows"] else "-"
+        print(
+            f"{entry['file']:<{width}}  {entry['rows']:>9,}  {entry['matched']:>9,}  "
+            f"{entry['ambiguous']:>9,}  {unmatched:>9,}  {rate:>10}"
+        )
+    if any(entry.get("error") for entry in summary):
+        sys.exit(1)
+
+
+def configure_logging(args: "argparse.Namespace") -> None:
+    if args.quiet:
+        logging.basicConfig(level=logging.CRITICAL, format='%(levelname)s: %(message)s')
+    elif args.verbose == 1:
+        logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    elif args.verbose >= 2:
+        logging.basicConfig(level=logging.DEBUG, format='%(levelname)s: %(message)s')
     else:
-        con.execute(f"""
-            CREATE TEMP VIEW key_scores AS
-            SELECT inp.key_id, ref.*, {avg_score_expr} AS avg_score
-            FROM ref_preproc AS ref
-            CROSS JOIN input_keys AS inp;
-        """)
+        logging.basicConfig(level=logging.WARNING, format='%(levelname)s: %(message)s')
 
-    con.execute(f"""
-        CREATE TEMP VIEW all_scores AS
-        SELECT ikm.input_id, ks.* EXCLUDE (key_id)
-        FROM input_key_map ikm
-        JOIN key_scores ks ON ikm.key_id = ks.key_id;
-    """)
 
-    con.execute(f"""
-        CREATE TEMP VIEW best_matches AS
-        SELECT *, ROW_NUMBER() OVER(PARTITION BY input_id ORDER BY avg_score DESC, input_id ASC) as rnk
-        FROM all_scores
-        WHERE avg_score >= {args.threshold};
-    """)
+def main(argv: List[str] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["serve"]:
+        return serve_main(argv[1:])
+    if argv[:1] == ["batch"]:
+        return batch_main(argv[1:])
+    args = parse_args(argv)
+    configure_logging(args)
 
-    # Build DuckDB SQL for clean output (LEFT JOIN behavior - include ALL input records)
-    sql_clean = f"""
-COPY (
-    WITH max_scores AS (
-        SELECT input_id, MAX(avg_score) as max_score
-        FROM all_scores
-        WHERE avg_score >= {args.threshold}
-        GROUP BY input_id
-    ),
-    ambiguous_inputs AS (
-        SELECT ms.input_id
-        FROM max_scores ms
-        JOIN all_scores s ON ms.input_id = s.input_id AND ms.max_score = s.avg_score
-        GROUP BY ms.input_id
-        HAVING COUNT(*) > 1
-    ),
-    clean_best_matches AS (
-        SELECT * FROM best_matches
-        WHERE rnk = 1
-        AND input_id NOT IN (SELECT input_id FROM ambiguous_inputs)
-    )
-    SELECT DISTINCT {select_clean_cols}
-    FROM input_with_id inp
-    LEFT JOIN clean_best_matches bst ON inp.input_id = bst.input_id
-) TO '{args.output_clean}' (HEADER, DELIMITER ',');
-"""
+    if '--help' in sys.argv or '-h' in sys.argv:
+        logging.info("\nExample:")
+        logging.info("  tometo_tomato input.csv ref.csv -j \"col1,col_ref1\" -j \"col2,col_ref2\" -a \"field_to_add1\" -a \"field_to_add2\" -o \"output_clean.csv\"")
+        logging.info("") # Add an empty line for better formatting
+
+    output_format = args.output_format or file_format(args.output_clean)
+    if output_format == "arrow":
+        try:
+            _import_pyarrow()
+        except ImportError as e:
+            logging.error(str(e))
+            sys.exit(1)
+
+    budgets = (args.max_pairs, args.max_seconds, args.max_memory)
+    if any(budget is not None for budget in budgets) and not args.estimate:
+        logging.error("--max-pairs, --max-seconds and --max-memory require --estimate.")
+        sys.exit(1)
+    if args.max_memory is not None:
+        try:
+            parse_memory_size(args.max_memory)
+        except ValueError as e:
+            logging.error(str(e))
+            sys.exit(1)
+
+    started = time.perf_counter()
+    profile = new_profile() if args.profile else None
+    con = duckdb.connect(database=":memory:")
+    try:
+        plan = prepare_join(con, args, profile=profile)
+    except FuzzyJoinError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    if args.state:
+        profile_stage(profile, "load_state", con)
+        load_state(con, args, plan)
+        profile_stage(profile, None, con)
+
+    if args.estimate:
+        import json
+
+        report = estimate_join(con, args, plan)
+        # Everything before scoring already ran, so its time is measured, not projected
+        report["planning_seconds"] = round(time.perf_counter() - started, 1)
+        report["projected_seconds"] = round(report["planning_seconds"] + report["projected_scoring_seconds"], 1)
+        exceeded = check_budget(report, args)
+        report["within_budget"] = not exceeded
+        print(json.dumps(report, indent=2, default=str))
+        if profile is not None:
+            write_profile(profile, args.profile, args, time.perf_counter() - started)
+        for message in exceeded:
+            logging.error(f"Budget exceeded: {message}")
+        sys.exit(1 if exceeded else 0)
 
-    # Check for file overwrite before writing clean output
+    def match_scope(clean_path: str, ambiguous_path: str = None) -> int:
+        """Match the input rows of ``input_scope`` and write their clean (and ambiguous) output.
+
+        Returns the number of ambiguous input keys. The tables built here are
+        dropped on return, so the function can run once per chunk.
+        """
+        work_dir = tempfile.mkdtemp(prefix="tometo_tomato_", dir=args.temp_directory) if executor else None
+        ambiguous_count = match_keys(con, args, plan, executor, work_dir)
+
+        profile_stage(profile, "write_clean", con)
+        copy_query(con, clean_output_sql(plan), clean_path, output_format)
+
+        if ambiguous_path and ambiguous_count > 0:
+            # Only check for file overwrite if there are actually ambiguous records
+            if not check_file_overwrite(ambiguous_path, args.force):
+                logging.error("Operation cancelled: will not overwrite existing ambiguous file.")
+                sys.exit(1)
+
+            profile_stage(profile, "write_ambiguous", con)
+            copy_query(con, ambiguous_output_sql(plan), ambiguous_path, output_format)
+
+        profile_stage(profile, None, con)
+        drop_match_tables(con)
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return ambiguous_count
+
+    # Check for file overwrite before the scoring pass
     if not check_file_overwrite(args.output_clean, args.force):
         logging.error("Operation cancelled: will not overwrite existing file.")
         sys.exit(1)
 
-    con.execute(sql_clean)
+    executor = worker_pool(args)
 
-    # Check for ambiguous records before creating the ambiguous file
-    ambiguous_count_result = con.execute(f"""
-        WITH max_scores AS (
-            SELECT input_id, MAX(avg_score) as max_score
-            FROM all_scores
-            WHERE avg_score >= {args.threshold}
-            GROUP BY input_id
-        ),
-        ambiguous_inputs AS (
-            SELECT ms.input_id
-            FROM max_scores ms
-            JOIN all_scores s ON ms.input_id = s.input_id AND ms.max_score = s.avg_score
-            GROUP BY ms.input_id
-            HAVING COUNT(*) > 1
-        )
-        SELECT COUNT(*) FROM ambiguous_inputs
-    """)
-    ambiguous_count = ambiguous_count_result.fetchone()[0]
+    if not args.chunk_size:
+        ambiguous_count = match_scope(args.output_clean, args.output_ambiguous)
+    else:
+        # ------------------------------------------------------------------
+        # Chunked processing: each chunk of input rows is matched on its own
+        # and written to a part file under <output-clean>.parts; the
+        # checkpoint lists the finished chunks so --resume can skip them.
+        # ------------------------------------------------------------------
+        parts_dir = f"{args.output_clean}.parts"
+        try:
+            checkpoint = load_checkpoint(parts_dir, run_fingerprint(args, plan["join_pairs"]), args.resume)
+        except ValueError as e:
+            logging.error(str(e))
+            sys.exit(1)
+        # The input columns in use are copied once to a Parquet file that
+        # each chunk reads its row range from, so the input is never held
+        # in memory as a whole.
+        profile_stage(profile, "spill_input", con)
+        input_file = os.path.join(parts_dir, "input.parquet")
+        n_rows = spill_input(con, input_file)
+        n_chunks = max(1, -(-n_rows // args.chunk_size))
+        profile_stage(profile, None, con)
+        if checkpoint["completed"]:
+            logging.info(f"Resuming: {len(checkpoint['completed'])} of {n_chunks} chunks already done")
 
-    if args.output_ambiguous and ambiguous_count > 0:
-        # Only check for file overwrite if there are actually ambiguous records
-        if not check_file_overwrite(args.output_ambiguous, args.force):
-            logging.error("Operation cancelled: will not overwrite existing ambiguous file.")
+        for chunk_id in range(n_chunks):
+            scope_input_chunk(con, plan, input_file, chunk_id, args.chunk_size)
+            if str(chunk_id) in checkpoint["completed"]:
+                continue
+            chunk_ambiguous = match_scope(
+                os.path.join(parts_dir, f"clean_{chunk_id:06d}.{output_format}"),
+                os.path.join(parts_dir, f"ambiguous_{chunk_id:06d}.{output_format}") if args.output_ambiguous else None,
+            )
+            checkpoint["completed"][str(chunk_id)] = chunk_ambiguous
+            write_checkpoint(parts_dir, checkpoint)
+            logging.info(f"Chunk {chunk_id + 1}/{n_chunks} done")
+
+        ambiguous_count = sum(checkpoint["completed"].values())
+        profile_stage(profile, "assemble_chunks", con)
+        try:
+            concat_parts(
+                con,
+                [os.path.join(parts_dir, f"clean_{chunk_id:06d}.{output_format}") for chunk_id in range(n_chunks)],
+                args.output_clean,
+                output_format,
+            )
+            ambiguous_parts = [
+                os.path.join(parts_dir, f"ambiguous_{chunk_id:06d}.{output_format}") for chunk_id in range(n_chunks)
+                if checkpoint["completed"][str(chunk_id)] > 0
+            ]
+            if args.output_ambiguous and ambiguous_parts:
+                if not check_file_overwrite(args.output_ambiguous, args.force):
+                    logging.error("Operation cancelled: will not overwrite existing ambiguous file.")
+                    sys.exit(1)
+                concat_parts(con, ambiguous_parts, args.output_ambiguous, output_format)
+        except ValueError as e:
+            # Parts written by runs with different output columns
+            logging.error(f"{e}; rerun without --resume to rebuild the parts")
             sys.exit(1)
+        shutil.rmtree(parts_dir)
+        profile_stage(profile, None, con)
 
-        # Build DuckDB SQL for ambiguous output
-        sql_amb = f"""
-COPY (
-    WITH max_scores AS (
-        SELECT input_id, MAX(avg_score) as max_score
-        FROM all_scores
-        WHERE avg_score >= {args.threshold}
-        GROUP BY input_id
-    ),
-    ambiguous_inputs AS (
-        SELECT ms.input_id
-        FROM max_scores ms
-        JOIN all_scores s ON ms.input_id = s.input_id AND ms.max_score = s.avg_score
-        GROUP BY ms.input_id
-        HAVING COUNT(*) > 1
-    )
-    SELECT DISTINCT {select_ambiguous_cols_fixed}
-    FROM all_scores s
-    JOIN input_with_id inp ON s.input_id = inp.input_id
-    WHERE s.input_id IN (SELECT input_id FROM ambiguous_inputs)
-       AND s.avg_score >= {args.threshold}
-) TO '{args.output_ambiguous}' (HEADER, DELIMITER ',');
-"""
+    if executor:
+        executor.shutdown()
+
+    if args.state:
+        profile_stage(profile, "write_state", con)
+        save_state(con, plan)
+        profile_stage(profile, None, con)
 
-        con.execute(sql_amb)
+    if profile is not None:
+        write_profile(profile, args.profile, args, time.perf_counter() - started)
+
+    if args.output_ambiguous and ambiguous_count > 0:
         logging.warning(f"Ambiguous records found! Check file: {args.output_ambiguous}")
     elif args.output_ambiguous and ambiguous_count == 0:
         # Don't create ambiguous file if no ambiguous records exist
@@ -655,6 +4196,8 @@ COPY (
     logging.info(f"- Clean matches saved to: {args.output_clean}")
     if args.output_ambiguous and ambiguous_count > 0:
         logging.info(f"- Ambiguous matches saved to: {args.output_ambiguous}")
+    if profile is not None:
+        logging.info(f"- Profile saved to: {args.profile}")
 
 
 if __name__ == '__main__':
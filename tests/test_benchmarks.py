@@ -0,0 +1,46 @@
+import csv
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_generator_is_reproducible_with_ground_truth(tmp_path):
+    cmd = [sys.executable, os.path.join(ROOT, "benchmarks", "generate.py"), "--reference-size", "300", "--input-size", "500"]
+    subprocess.run(cmd + ["--out-dir", str(tmp_path / "a")], check=True, capture_output=True)
+    subprocess.run(cmd + ["--out-dir", str(tmp_path / "b")], check=True, capture_output=True)
+    for name in ("reference.csv", "input.csv"):
+        assert (tmp_path / "a" / name).read_bytes() == (tmp_path / "b" / name).read_bytes()
+
+    with open(tmp_path / "a" / "reference.csv", newline="", encoding="utf-8") as f:
+        codes = {row["codice_comune"] for row in csv.DictReader(f)}
+    assert len(codes) == 300
+    with open(tmp_path / "a" / "input.csv", newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 500
+    expected = [row["expected_code"] for row in rows]
+    assert all(code in codes for code in expected if code)
+    assert any(not code for code in expected)
+
+
+def test_benchmark_run_records_results(tmp_path):
+    results = tmp_path / "results.jsonl"
+    cmd = [
+        sys.executable, os.path.join(ROOT, "benchmarks", "run.py"),
+        "--sizes", "300", "--reference-size", "300", "--configs", "baseline,block-ngram",
+        "--results", str(results), "--data-dir", str(tmp_path / "data"), "--label", "test",
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+    records = [json.loads(line) for line in results.read_text().splitlines()]
+    assert [r["config"] for r in records] == ["baseline", "block-ngram"]
+    for record in records:
+        assert record["label"] == "test"
+        assert record["input_rows"] == 300
+        assert record["seconds"] > 0 and record["peak_rss_mb"] > 0
+        assert 0.9 <= record["precision"] <= 1
+        assert 0 < record["recall"] <= 1
+        assert "scoring" in record["stages"]
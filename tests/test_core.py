@@ -1,7 +1,9 @@
+import json
 import os
 import subprocess
 from types import SimpleNamespace
 
+import duckdb
 import pytest
 
 import tometo_tomato as tt
@@ -15,6 +17,16 @@ def write_csv(path, header, rows=None):
                 f.write(r + "\n")
 
 
+def run_cli(*args, **kwargs):
+    """Run the command-line script with ``args`` and return the completed process."""
+    return subprocess.run(
+        ["python3", "src/tometo_tomato/tometo_tomato.py", *[str(arg) for arg in args]],
+        capture_output=True,
+        text=True,
+        **kwargs,
+    )
+
+
 def test_read_header(tmp_path):
     p = tmp_path / "a.csv"
     write_csv(p, 'col1,col2,col3', ['1,2,3'])
@@ -44,6 +56,29 @@ def test_build_join_pairs_infer(tmp_path):
     assert any(',' in p for p in pairs)
 
 
+def test_build_join_pairs_infer_values(tmp_path):
+    inp = tmp_path / "inp3.csv"
+    ref = tmp_path / "ref3.csv"
+    # Unrelated header names: only the values tell which columns match
+    write_csv(inp, "den_com,den_reg,note", [
+        "Mlano,Lombardia,x1", "Torno,Piemonte,x2", "Palermo,Sicilia,x3", "Bari,Puglia,x4", "Napoli,Campania,x5",
+    ])
+    write_csv(ref, "CODICE,REGIONE,COMUNE", [
+        "015146,Lombardia,Milano", "001272,Piemonte,Torino", "082053,Sicilia,Palermo", "072006,Puglia,Bari",
+        "063049,Campania,Napoli", "058091,Lazio,Roma",
+    ])
+    args = SimpleNamespace(
+        join_pair=None, infer_pairs=False, infer_values=True, input_file=str(inp), reference_file=str(ref),
+        infer_threshold=None, infer_sample=1000,
+    )
+    ranked = []
+    pairs = tt.build_join_pairs(args, ranked=ranked)
+    assert sorted(pairs) == ["den_com,COMUNE", "den_reg,REGIONE"]
+    assert all(0 <= c["confidence"] <= 1 for c in ranked)
+    assert [c["selected"] for c in ranked if c.get("selected")] == [True, True]
+    assert ranked[0]["confidence"] >= ranked[-1]["confidence"]
+
+
 def test_add_field_with_spaces(tmp_path):
     """Verify that --add-field works with column names containing spaces."""
     input_path = tmp_path / "input.csv"
@@ -271,8 +306,8 @@ def test_duplicate_input_rows(tmp_path):
 
     Uses 4 input rows: 2× 'rome', 1× 'milan', 1× 'naple'.
     The DISTINCT optimization deduplicates to 3 keys before the CROSS JOIN,
-    then re-expands. The clean output uses SELECT DISTINCT, so identical
-    output rows collapse — we expect 3 distinct output rows.
+    then re-expands. The clean output keeps one row per distinct join-column
+    tuple, so identical output rows collapse — we expect 3 distinct output rows.
     """
     input_path = tmp_path / "input.csv"
     ref_path = tmp_path / "ref.csv"
@@ -296,10 +331,889 @@ def test_duplicate_input_rows(tmp_path):
     with open(output_path, "r", encoding="utf-8") as f:
         lines = f.readlines()
 
-    # Header + 3 distinct matched rows (the 2 "rome" rows collapse via SELECT DISTINCT)
+    # Header + 3 distinct matched rows (the 2 "rome" rows collapse into one)
     assert len(lines) == 4, f"Expected 4 lines (header + 3 rows), got {len(lines)}: {lines}"
     content = "".join(lines)
     assert "rome" in content.lower()
     assert "milan" in content.lower()
     assert "R01" in content
     assert "M01" in content
+
+
+def test_staged_score_expr_keeps_passing_scores():
+    """Verify that the stage guards only drop pairs whose average cannot reach the threshold."""
+    plan = {
+        "join_pairs": ["a,a", "b,b", "c,c"],
+        "avg_score_expr": "(s.a + s.b + s.c) / 3",
+        "pair_score_exprs": ["s.a", "s.b", "s.c"],
+    }
+    assert tt.stage_cutoff(3, 1, 80) == 40
+    expr = tt.staged_score_expr(plan, [2, 0, 1], [1, 2], 80)
+    assert expr.count("CASE WHEN") == 2
+    values = [0, 39.9, 40, 50, 70, 80, 90, 100]
+    con = duckdb.connect()
+    rows = con.execute(f"""
+        SELECT s.a, s.b, s.c, (s.a + s.b + s.c) / 3, {expr}
+        FROM unnest({values}) AS x(a), unnest({values}) AS y(b), unnest({values}) AS z(c),
+             LATERAL (SELECT x.a::DOUBLE AS a, y.b::DOUBLE AS b, z.c::DOUBLE AS c) AS s
+    """).fetchall()
+    for a, b, c, avg, staged in rows:
+        if avg >= 80:
+            assert staged == avg, (a, b, c)
+        else:
+            assert staged is None or staged == avg, (a, b, c)
+    # c is scored first: below 40 nothing else is computed
+    assert all(staged is None for a, b, c, avg, staged in rows if c < 40)
+
+    # No guards, no CASE
+    assert tt.staged_score_expr(plan, [0, 1, 2], [], 80) == plan["avg_score_expr"]
+
+
+def test_cdist_engine(tmp_path):
+    """Verify that --engine cdist scores in-process and keeps the clean/ambiguous logic."""
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    output_path = tmp_path / "output.csv"
+    ambiguous_path = tmp_path / "ambiguous.csv"
+
+    write_csv(input_path, "city", ["rome", "rome", "Reggio Calabria", "san marco"])
+    write_csv(ref_path, "city_ref,code", ["Rome,R01", "Reggio di Calabria,RC01", "San Marco,SM01", "San Marco,SM02"])
+
+    result = run_cli(
+        str(input_path), str(ref_path),
+        "-j", "city,city_ref",
+        "-a", "code",
+        "--engine", "cdist",
+        "--scorer", "token_set_ratio",
+        "-s",
+        "-o", str(output_path),
+        "-u", str(ambiguous_path),
+    )
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+
+    with open(output_path, "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f.readlines()]
+
+    assert lines[0] == "city,ref_city_ref,code,avg_score"
+    assert "rome,Rome,R01,100.0" in lines
+    assert "Reggio Calabria,Reggio di Calabria,RC01,100.0" in lines
+    # Tied candidates are left out of the clean output and written to the ambiguous file
+    assert "SM01" not in "".join(lines)
+    with open(ambiguous_path, "r", encoding="utf-8") as f:
+        ambiguous = f.read()
+    assert "SM01" in ambiguous and "SM02" in ambiguous
+
+
+def test_additional_scorers():
+    """Verify the extra scorers agree across engines and fail clearly where DuckDB lacks them."""
+    pa = pytest.importorskip("pyarrow")
+
+    inp = pa.table({"city": ["Calabria Reggio", "Mlano", "Giovanni in Persiceto"]})
+    ref = pa.table({
+        "city_ref": ["Reggio Calabria", "Reggio Emilia", "Milano", "San Giovanni in Persiceto"],
+        "code": ["RC", "RE", "MI", "SG"],
+    })
+
+    def codes(scorer, engine):
+        result = tt.fuzzy_join(
+            inp, ref, pairs="city,city_ref", add_fields="code", threshold=85, scorer=scorer, engine=engine,
+            show_score=True,
+        )
+        return list(zip(result.clean.column("code").to_pylist(), result.clean.column("avg_score").to_pylist()))
+
+    # Sorted tokens are precomputed, so swapped words score 100 even without the rapidfuzz extension
+    for engine in ("sql", "cdist"):
+        assert codes("token_sort_ratio", engine)[0] == ("RC", 100.0)
+    assert codes("jaro_winkler", "sql") == codes("jaro_winkler", "cdist")
+    assert codes("jaro_winkler", "cdist")[1] == ("MI", 95.0)
+    assert codes("partial_ratio", "cdist")[2] == ("SG", 100.0)
+    assert [code for code, _ in codes("WRatio", "cdist")] == ["RC", "MI", "SG"]
+    # token_set_ratio compares precomputed token sets, with the scores of the raw strings
+    from rapidfuzz import fuzz
+
+    assert codes("token_set_ratio", "cdist") == [
+        ("RC", 100.0), ("MI", fuzz.token_set_ratio("mlano", "milano")), ("SG", 100.0)
+    ]
+
+    with pytest.raises(tt.FuzzyJoinError, match="requires --engine cdist"):
+        codes("WRatio", "sql")
+
+
+def test_ref_cache(tmp_path):
+    """Verify that --ref-cache stores the normalized reference and reuses it on the next run."""
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    cache_dir = tmp_path / "cache"
+
+    write_csv(input_path, "city", ["rome", "milan"])
+    write_csv(ref_path, "city_ref,code", ["Rome,R01", "Milan,M01"])
+
+    def run(output_path, *extra):
+        result = run_cli(
+            str(input_path), str(ref_path),
+            "-j", "city,city_ref",
+            "-a", "code",
+            "-o", str(output_path),
+            "--ref-cache", str(cache_dir),
+            "-v",
+            *extra,
+        )
+        assert result.returncode == 0, f"Script failed: {result.stderr}"
+        return result.stderr
+
+    first = run(tmp_path / "out1.csv")
+    second = run(tmp_path / "out2.csv")
+    assert "Reference cache miss" in first
+    assert "Reference cache hit" in second
+    assert (tmp_path / "out1.csv").read_text() == (tmp_path / "out2.csv").read_text()
+    assert len(list(cache_dir.glob("ref_*.parquet"))) == 1
+
+    # Different normalization flags produce a different cache entry
+    third = run(tmp_path / "out3.csv", "--raw-case")
+    assert "Reference cache miss" in third
+    assert len(list(cache_dir.glob("ref_*.parquet"))) == 2
+
+    # A tiny size bound evicts every entry except the one in use, sniffed dialects included
+    assert len(list(cache_dir.glob("csv_*.json"))) == 2
+    run(tmp_path / "out4.csv", "--block-prefix", "1", "--ref-cache-size", "0")
+    assert len(list(cache_dir.glob("ref_*.parquet"))) == 1
+    assert not list(cache_dir.glob("csv_*.json"))
+
+
+def test_length_bound_conditions_keep_reachable_pairs():
+    """Verify that length-bound pruning never discards a pair that reaches the threshold."""
+    from rapidfuzz import fuzz
+    from rapidfuzz.distance import Levenshtein
+
+    scorers = {
+        'indel': fuzz.ratio,
+        'levenshtein': lambda a, b: Levenshtein.normalized_similarity(a, b) * 100,
+    }
+    words = ["roma", "rome", "romano", "milano", "mi", "reggio calabria", "reggio di calabria", "ab", "abc"]
+    con = duckdb.connect()
+    for metric, scorer in scorers.items():
+        conditions = tt.length_bound_conditions(["a,b"], 75, metric)
+        assert conditions
+        for a in words:
+            for b in words:
+                kept = con.execute(
+                    f'SELECT {" AND ".join(conditions)} '
+                    f'FROM (SELECT {len(a)} AS "a_len") inp, (SELECT {len(b)} AS "b_len") ref'
+                ).fetchone()[0]
+                if scorer(a, b) >= 75:
+                    assert kept, f"{metric}: pair ({a!r}, {b!r}) was pruned"
+        # Only the length difference matters: very different lengths are pruned
+        kept = con.execute(
+            f'SELECT {" AND ".join(conditions)} FROM (SELECT 2 AS "a_len") inp, (SELECT 20 AS "b_len") ref'
+        ).fetchone()[0]
+        assert not kept
+
+    # No bound for token-based scorers or when a single pair can score 0
+    assert tt.length_bound_conditions(["a,b"], 75, None) == []
+    assert tt.length_bound_conditions(["a,b", "c,d"], 40, 'indel') == []
+
+
+def test_block_ngram_recovers_first_letter_typos(tmp_path):
+    """Verify that --block-ngram finds matches that --block-prefix loses to a typo in the first letter."""
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    output_prefix = tmp_path / "output_prefix.csv"
+    output_ngram = tmp_path / "output_ngram.csv"
+
+    write_csv(input_path, "city", ["Palermo", "Xatania", "Kessina"])
+    write_csv(ref_path, "city_ref,code", ["Palermo,PA", "Catania,CT", "Messina,ME", "Trapani,TP"])
+
+    def run(output_path, *blocking):
+        result = run_cli(
+            str(input_path), str(ref_path),
+            "-j", "city,city_ref",
+            "-a", "code",
+            "-t", "80",
+            "-o", str(output_path),
+            *blocking,
+        )
+        assert result.returncode == 0, f"Script failed: {result.stderr}"
+        return output_path.read_text()
+
+    prefix_output = run(output_prefix, "--block-prefix", "1")
+    assert "PA" in prefix_output
+    assert "CT" not in prefix_output and "ME" not in prefix_output
+
+    for engine in ("sql", "cdist"):
+        ngram_output = run(output_ngram, "--block-ngram", "2", "--engine", engine, "-f")
+        assert "PA" in ngram_output and "CT" in ngram_output and "ME" in ngram_output
+        assert "TP" not in ngram_output
+
+
+def test_block_phonetic(tmp_path):
+    """Verify that --block-phonetic italian groups phonetic misspellings that prefix blocking splits."""
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    output_path = tmp_path / "output.csv"
+
+    write_csv(input_path, "city", ["Calascibeta", "Siacca"])
+    write_csv(ref_path, "city_ref,code", ["Calascibetta,CB", "Sciacca,SC", "Sciara,SR"])
+
+    result = run_cli(
+        str(input_path), str(ref_path),
+        "-j", "city,city_ref",
+        "-a", "code",
+        "-t", "80",
+        "--block-phonetic", "italian",
+        "-o", str(output_path),
+    )
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+
+    content = output_path.read_text()
+    assert "Calascibeta,Calascibetta,CB" in content
+    assert "Siacca,Sciacca,SC" in content
+    assert "SR" not in content
+
+
+
+def test_block_window(tmp_path):
+    """Verify sorted-neighbourhood blocking and its reversed-string pass."""
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    output_path = tmp_path / "output.csv"
+
+    write_csv(input_path, "city", ["Palermo", "Mesina", "Xatania"])
+    write_csv(ref_path, "city_ref,code", ["Aosta,AO", "Bari,BA", "Catania,CT", "Messina,ME", "Palermo,PA", "Trapani,TP"])
+
+    def run(*blocking):
+        result = run_cli(
+            str(input_path), str(ref_path),
+            "-j", "city,city_ref",
+            "-a", "code",
+            "-t", "80",
+            "-o", str(output_path),
+            "-f",
+            "--block-window", "2",
+            *blocking,
+        )
+        assert result.returncode == 0, f"Script failed: {result.stderr}"
+        return output_path.read_text()
+
+    forward = run()
+    assert "PA" in forward and "ME" in forward
+    # "xatania" sorts after every reference value, far from "catania"
+    assert "CT" not in forward
+
+    both = run("--block-window-reverse")
+    assert "PA" in both and "ME" in both and "CT" in both
+
+
+def test_multi_pass_blocking(tmp_path):
+    """Verify that several blocking passes are unioned, each pair being scored once."""
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    output_path = tmp_path / "output.csv"
+
+    write_csv(input_path, "city,region", ["Siacca,Sicilia", "Palermo,Sicilia", "Mesina,Sicilia"])
+    write_csv(ref_path, "city_ref,region_ref,code", [
+        "Sciacca,Sicilia,SC",
+        "Palermo,Sicilia,PA",
+        "Messina,Sicilia,ME",
+        "Milano,Lombardia,MI",
+    ])
+
+    def run(*blocking):
+        return run_cli(
+            str(input_path), str(ref_path),
+            "-j", "city,city_ref",
+            "-j", "region,region_ref",
+            "-a", "code",
+            "-t", "80",
+            "-o", str(output_path),
+            "-f",
+            "-vv",
+            *blocking,
+        )
+
+    # Prefix on the city column alone misses "Siacca"; the phonetic pass recovers it
+    result = run("--block", "prefix:3:city", "--block", "phonetic:italian:city_ref")
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    content = output_path.read_text()
+    assert "SC" in content and "PA" in content and "ME" in content
+    assert "2 blocking passes produced" in result.stderr
+
+    # Single-mode flags combine with each other as passes too
+    result = run("--block-prefix", "3", "--block-phonetic", "italian")
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    assert "SC" in output_path.read_text()
+
+    # Chunks reuse the reference side of every pass and give the same output
+    passes = ["--block", "ngram:3", "--block", "phonetic:italian", "--block", "window-reverse:2"]
+    result = run(*passes)
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    expected = output_path.read_text()
+    result = run(*passes, "--chunk-size", "1")
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    assert output_path.read_text() == expected
+    assert result.stderr.count("distinct reference values") == 1
+    assert result.stderr.count("distinct input values") == 3
+
+    result = run("--block", "prefix:3:unknown")
+    assert result.returncode == 1
+    assert "not used in any join pair" in result.stderr
+
+
+def test_block_max_pairs(tmp_path):
+    """Verify that --block-max-pairs splits oversized prefix blocks and reports those it cannot split."""
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    output_path = tmp_path / "output.csv"
+    write_csv(input_path, "city,region", ["Roma,Lazzio", "Rovgo,Veneto", "Ragsa,Sicilia"])
+    write_csv(ref_path, "city_ref,region_ref,code", [
+        "Roma,Lazio,RM",
+        "Roma,Molise,CB",
+        "Rovigo,Veneto,RO",
+        "Ragusa,Sicilia,RG",
+        "Rieti,Lazio,RI",
+    ])
+
+    def run(*blocking):
+        return run_cli(
+            str(input_path), str(ref_path),
+            "-j", "city,city_ref",
+            "-j", "region,region_ref",
+            "-a", "code",
+            "-t", "80",
+            "-o", str(output_path),
+            "-f",
+            "-v",
+            *blocking,
+        )
+
+    # Block "r" holds 3 keys x 5 rows; "ro" (2 x 3), "ra" and "ri" fit under the cap
+    result = run("--block", "prefix:1:city", "--block-max-pairs", "6")
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    assert "1 block splits" in result.stderr
+    content = output_path.read_text()
+    assert "RO" in content and "RG" in content and "RM" in content
+    assert "still exceed" not in result.stderr
+
+    # The two "Roma" rows share the whole blocked value, so their block cannot go under 2 pairs
+    result = run("--block", "prefix:1:city", "--block-max-pairs", "1")
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    assert "1 prefix blocks still exceed --block-max-pairs 1" in result.stderr
+    assert "RO" in output_path.read_text()
+
+    result = run("--block", "prefix:1:city", "--block-max-pairs", "-1")
+    assert result.returncode == 1
+    assert "--block-max-pairs must be" in result.stderr
+
+
+def test_exact_match_prepass(tmp_path):
+    """Verify that exact keys skip fuzzy scoring while ties at 100 stay ambiguous."""
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    output_path = tmp_path / "output.csv"
+    ambiguous_path = tmp_path / "ambiguous.csv"
+
+    write_csv(input_path, "city", ["Roma", "Milano", "Mlano", "Paris"])
+    write_csv(ref_path, "city_ref,code", [
+        "Roma,RM",
+        "Milano,MI",
+        "Paris,FR1",
+        "Paris,FR2",
+    ])
+
+    result = run_cli(
+        str(input_path), str(ref_path),
+        "-j", "city,city_ref",
+        "-a", "code",
+        "-s",
+        "-t", "80",
+        "-o", str(output_path),
+        "-u", str(ambiguous_path),
+        "-v",
+    )
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    assert "Exact pre-pass: 2 of 4 distinct keys matched exactly once, 1 matched several" in result.stderr
+
+    rows = output_path.read_text().splitlines()
+    assert any(row.startswith("Roma,Roma,RM,100") for row in rows)
+    assert any(row.startswith("Mlano,Milano,MI,") for row in rows)
+    # Two reference rows tie at 100: the input stays unmatched and both go to the ambiguous file
+    assert any(row.startswith("Paris,,") for row in rows)
+    ambiguous = ambiguous_path.read_text()
+    assert "FR1" in ambiguous and "FR2" in ambiguous
+
+
+def test_chunked_resume(tmp_path, monkeypatch):
+    """Verify that --chunk-size gives the same output and --resume skips finished chunks."""
+    import sys
+    from tometo_tomato import tometo_tomato as module
+
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    output_path = tmp_path / "output.csv"
+    chunked_path = tmp_path / "chunked.csv"
+
+    write_csv(input_path, "city", ["Roma", "Milano", "Mlano", "Torino", "Roma", "Npoli", "Bari"])
+    write_csv(ref_path, "city_ref,code", ["Roma,RM", "Milano,MI", "Torino,TO", "Napoli,NA", "Bari,BA"])
+    base_args = [
+        str(input_path), str(ref_path),
+        "-j", "city,city_ref",
+        "-a", "code",
+        "-t", "80",
+        "-f",
+    ]
+    result = run_cli(*base_args, "-o", output_path)
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+
+    # Interrupt the run right after the first chunk is checkpointed
+    write_checkpoint = module.write_checkpoint
+
+    def interrupted(parts_dir, checkpoint):
+        write_checkpoint(parts_dir, checkpoint)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(module, "write_checkpoint", interrupted)
+    monkeypatch.setattr(sys, "argv", ["tometo_tomato", *base_args, "-o", str(chunked_path), "--chunk-size", "2"])
+    with pytest.raises(KeyboardInterrupt):
+        module.main()
+    assert (tmp_path / "chunked.csv.parts" / "checkpoint.json").exists()
+
+    result = run_cli(*base_args, "-o", chunked_path, "--chunk-size", "2", "--resume", "-v")
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    assert "Resuming: 1 of 4 chunks already done" in result.stderr
+    assert chunked_path.read_text() == output_path.read_text()
+    assert not (tmp_path / "chunked.csv.parts").exists()
+
+    # A checkpoint made with other options is not resumed
+    monkeypatch.setattr(sys, "argv", ["tometo_tomato", *base_args, "-o", str(chunked_path), "--chunk-size", "2"])
+    with pytest.raises(KeyboardInterrupt):
+        module.main()
+    result = run_cli(*base_args, "-o", chunked_path, "--chunk-size", "2", "--resume", "-t", "90")
+    assert result.returncode == 1
+    assert "different input/reference files or options" in result.stderr
+
+
+def test_ambiguous_column_order(tmp_path):
+    """Verify ambiguous columns follow the join pairs and CSV parts with other headers are not concatenated."""
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    write_csv(input_path, "zeta,alpha,mid", ["Bari,Puglia,x"])
+    write_csv(ref_path, "city_ref,region_ref,code", ["Bari,Puglia,BA", "Bari,Puglia,BA2"])
+
+    headers = set()
+    for seed in ("1", "2", "3"):
+        ambiguous_path = tmp_path / f"ambiguous_{seed}.csv"
+        result = run_cli(
+            str(input_path), str(ref_path),
+            "-j", "zeta,city_ref", "-j", "alpha,region_ref", "-a", "code",
+            "-o", str(tmp_path / "clean.csv"), "-u", str(ambiguous_path), "-f",
+            env={**os.environ, "PYTHONHASHSEED": seed},
+        )
+        assert result.returncode == 0, f"Script failed: {result.stderr}"
+        headers.add(ambiguous_path.read_text().splitlines()[0])
+    assert headers == {"zeta,alpha,city_ref,region_ref,code"}
+
+    write_csv(tmp_path / "a.csv", "x,y", ["1,2"])
+    write_csv(tmp_path / "b.csv", "x,y", ["3,4"])
+    write_csv(tmp_path / "c.csv", "y,x", ["5,6"])
+    tt.concat_csv_parts([str(tmp_path / "a.csv"), str(tmp_path / "b.csv")], str(tmp_path / "ab.csv"))
+    assert (tmp_path / "ab.csv").read_text().splitlines() == ["x,y", "1,2", "3,4"]
+    with pytest.raises(ValueError, match="header differs"):
+        tt.concat_csv_parts([str(tmp_path / "a.csv"), str(tmp_path / "c.csv")], str(tmp_path / "ac.csv"))
+
+
+def test_state_incremental(tmp_path):
+    """Verify that --state only matches new or changed keys and gives the output of a full run."""
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    state_dir = tmp_path / "state"
+    output_path = tmp_path / "output.csv"
+    full_path = tmp_path / "full.csv"
+    ambiguous_path = tmp_path / "ambiguous.csv"
+
+    write_csv(ref_path, "city_ref,code", ["Roma,RM", "Milano,MI", "Torino,TO", "Napoli,NA", "Bari,BA", "Bari,BA2"])
+    base_args = [
+        input_path, ref_path,
+        "-j", "city,city_ref",
+        "-a", "code",
+        "-t", "80",
+        "-s",
+        "-f",
+        "-v",
+    ]
+    write_csv(input_path, "city", ["Roma", "Mlano", "Torino", "Npoli", "Bari"])
+    result = run_cli(*base_args, "-o", output_path, "--state", state_dir)
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    assert "No state in" in result.stderr
+    assert (state_dir / "state.json").exists()
+
+    # The next snapshot changes one row and adds one: only those two keys are matched
+    write_csv(input_path, "city", ["Roma", "Mlano", "Torno", "Npoli", "Bari", "Firenze"])
+    state_args = [*base_args, "-o", output_path, "-u", ambiguous_path, "--state", state_dir]
+    result = run_cli(*state_args)
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    assert "State: 4 of 6 distinct keys reuse the previous run; 2 to match" in result.stderr
+
+    result = run_cli(*base_args, "-o", full_path)
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    assert output_path.read_text() == full_path.read_text()
+    assert "TO" in output_path.read_text()
+    # Stored ties are still reported as ambiguous
+    assert "BA2" in ambiguous_path.read_text()
+
+    # Another threshold invalidates the state
+    result = run_cli(*state_args, "-t", "90")
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    assert "different reference or options" in result.stderr
+
+
+def test_workers_match_single_process(tmp_path):
+    """Verify that partitioned scoring in worker processes gives the single-process output."""
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+
+    write_csv(input_path, "city,region", [
+        "Roma,Lazio", "Mlano,Lombardia", "Torno,Piemonte", "Napli,Campania", "Siacca,Sicilia", "Paris,Nowhere",
+    ])
+    write_csv(ref_path, "city_ref,region_ref,code", [
+        "Roma,Lazio,RM", "Milano,Lombardia,MI", "Torino,Piemonte,TO", "Napoli,Campania,NA", "Sciacca,Sicilia,SC",
+    ])
+
+    outputs = {}
+    for label, extra in [
+        ("single", []),
+        ("workers", ["--workers", "2"]),
+        ("workers-prefix", ["--workers", "2", "--block-prefix", "1"]),
+        ("single-prefix", ["--block-prefix", "1"]),
+        ("cdist", ["--engine", "cdist"]),
+        ("workers-cdist", ["--workers", "2", "--engine", "cdist"]),
+    ]:
+        output_path = tmp_path / f"{label}.csv"
+        result = run_cli(
+            str(input_path), str(ref_path),
+            "-j", "city,city_ref",
+            "-j", "region,region_ref",
+            "-a", "code",
+            "-t", "70",
+            "-s",
+            "-o", str(output_path),
+            "-f",
+            *extra,
+        )
+        assert result.returncode == 0, f"Script failed: {result.stderr}"
+        outputs[label] = output_path.read_text()
+
+    assert outputs["workers"] == outputs["single"]
+    assert outputs["workers-prefix"] == outputs["single-prefix"]
+    assert outputs["workers-cdist"] == outputs["cdist"]
+    assert "MI" in outputs["workers"] and "SC" in outputs["workers"]
+    assert "MI" in outputs["cdist"] and "SC" in outputs["cdist"]
+
+
+def test_duckdb_resource_settings(tmp_path):
+    """Verify --threads/--memory-limit/--temp-directory parsing and that the settings are applied and logged."""
+    from tometo_tomato.tometo_tomato import parse_memory_size, resolve_duckdb_settings
+
+    assert parse_memory_size("512MB") == 512 * 1000 ** 2
+    assert parse_memory_size("1.5GiB") == int(1.5 * 1024 ** 3)
+    with pytest.raises(ValueError):
+        parse_memory_size("4 parsecs")
+
+    args = SimpleNamespace(threads="4", memory_limit="3GB", temp_directory=None, workers=2)
+    assert resolve_duckdb_settings(args) == {"threads": 4, "memory_limit": 1000 ** 3, "temp_directory": None}
+    args = SimpleNamespace(threads="auto", memory_limit="auto", temp_directory=None, workers=1)
+    settings = resolve_duckdb_settings(args)
+    assert settings["threads"] >= 1 and settings["memory_limit"] > 0
+    with pytest.raises(ValueError):
+        resolve_duckdb_settings(SimpleNamespace(threads="0", memory_limit=None, temp_directory=None, workers=1))
+
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    write_csv(input_path, "city", ["Roma", "Mlano"])
+    write_csv(ref_path, "city_ref", ["Roma", "Milano"])
+    spill_dir = tmp_path / "spill"
+    result = run_cli(
+        str(input_path), str(ref_path),
+        "-j", "city,city_ref",
+        "-o", str(tmp_path / "output.csv"),
+        "--threads", "auto",
+        "--memory-limit", "256MiB",
+        "--temp-directory", str(spill_dir),
+        "-v",
+    )
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    # Four candidate pairs need a single thread
+    assert "Auto threads: ~4 candidate pairs" in result.stderr
+    assert f"DuckDB settings: threads=1, memory_limit=256.0 MiB, temp_directory={spill_dir}" in result.stderr
+
+
+def test_columnar_and_compressed_formats(tmp_path):
+    """Verify Parquet/gzip inputs and Parquet output give the same matches as plain CSV."""
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    write_csv(input_path, "city,region", ["Roma,Lazio", "Mlano,Lombardia", "Torno,Piemonte"])
+    write_csv(ref_path, "city_ref,region_ref,code,population", [
+        "Roma,Lazio,058091,2800000",
+        "Milano,Lombardia,015146,1350000",
+        "Torino,Piemonte,001272,850000",
+    ])
+    con = duckdb.connect()
+    # Typed Parquet reference: the leading zeros of the codes must survive
+    con.execute(f"""
+        COPY (SELECT city_ref, region_ref, code, CAST(population AS BIGINT) AS population
+              FROM read_csv_auto('{ref_path}', header=true, all_varchar=true))
+        TO '{tmp_path / "ref.parquet"}' (FORMAT PARQUET)
+    """)
+    con.execute(f"COPY (SELECT * FROM read_csv_auto('{input_path}', all_varchar=true)) TO '{tmp_path / 'input.csv.gz'}' (HEADER)")
+
+    def run(input_file, ref_file, output_file):
+        result = run_cli(
+            str(input_file), str(ref_file),
+            "-j", "city,city_ref",
+            "-j", "region,region_ref",
+            "-a", "code",
+            "-t", "80",
+            "-o", str(output_file),
+            "-f",
+        )
+        assert result.returncode == 0, f"Script failed: {result.stderr}"
+
+    run(input_path, ref_path, tmp_path / "csv.csv")
+    run(tmp_path / "input.csv.gz", tmp_path / "ref.parquet", tmp_path / "columnar.csv")
+    assert (tmp_path / "columnar.csv").read_text() == (tmp_path / "csv.csv").read_text()
+    assert "015146" in (tmp_path / "csv.csv").read_text()
+
+    run(input_path, tmp_path / "ref.parquet", tmp_path / "output.parquet")
+    rows = con.execute(f"SELECT city, code FROM read_parquet('{tmp_path / 'output.parquet'}')").fetchall()
+    assert rows == [("Roma", "058091"), ("Mlano", "015146"), ("Torno", "001272")]
+
+
+def test_arrow_input_and_output(tmp_path):
+    """Verify Arrow IPC input and --output-format arrow (needs the optional pyarrow)."""
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.ipc
+
+    table = pa.table({"city": ["Roma", "Mlano"]})
+    with pyarrow.ipc.new_file(str(tmp_path / "input.arrow"), table.schema) as writer:
+        writer.write_table(table)
+    ref_path = tmp_path / "ref.csv"
+    write_csv(ref_path, "city_ref,code", ["Roma,RM", "Milano,MI"])
+    output_path = tmp_path / "output.ipc"
+
+    result = run_cli(
+        str(tmp_path / "input.arrow"), str(ref_path),
+        "-j", "city,city_ref",
+        "-a", "code",
+        "-t", "80",
+        "-o", str(output_path),
+        "--output-format", "arrow",
+    )
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    output = pyarrow.ipc.open_file(str(output_path)).read_all()
+    assert output.column("code").to_pylist() == ["RM", "MI"]
+
+
+def test_fuzzy_join_api(tmp_path):
+    """Verify the in-process API on paths, Arrow tables and relations of a caller connection."""
+    pa = pytest.importorskip("pyarrow")
+
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    write_csv(input_path, "city", ["Roma", "Mlano", "Torin", "Bari"])
+    write_csv(ref_path, "city_ref,code", ["Roma,RM", "Milano,MI", "Torino,TO", "Bari,BA", "Bari,BA2"])
+
+    result = tt.fuzzy_join(str(input_path), str(ref_path), pairs=["city,city_ref"], add_fields=["code"], threshold=80)
+    assert isinstance(result.clean, pa.Table)
+    assert result.clean.column("code").to_pylist() == ["RM", "MI", "TO", None]
+    assert sorted(result.ambiguous.column("code").to_pylist()) == ["BA", "BA2"]
+
+    # Same answer from in-memory inputs, twice on the same caller connection
+    con = duckdb.connect()
+    reference = pa.table({"city_ref": ["Roma", "Milano", "Torino", "Bari", "Bari"], "code": ["RM", "MI", "TO", "BA", "BA2"]})
+    for _ in range(2):
+        relations = tt.fuzzy_join(
+            con.read_csv(str(input_path)), reference, pairs="city,city_ref", add_fields="code", threshold=80,
+            con=con, output="relation",
+        )
+        assert relations.clean.fetchall() == [tuple(row.values()) for row in result.clean.to_pylist()]
+        assert relations.ambiguous.count("*").fetchone()[0] == 2
+
+    # The caller's objects survive, even with the names of pipeline tables
+    con.execute("CREATE TABLE key_matches AS SELECT 1 AS kept")
+    con.execute("CREATE TABLE ref_source AS SELECT 2 AS kept")
+    con.execute("CREATE TABLE input_rows AS SELECT 3 AS kept")
+    con.execute("CREATE TEMP TABLE cities AS SELECT * FROM read_csv('" + str(input_path) + "')")
+    relations = tt.fuzzy_join(
+        con.table("cities"), reference, pairs="city,city_ref", add_fields="code", threshold=80, con=con, output="relation"
+    )
+    assert relations.clean.fetchall() == [tuple(row.values()) for row in result.clean.to_pylist()]
+    for kept, table in enumerate(("key_matches", "ref_source", "input_rows"), 1):
+        assert con.execute(f"SELECT kept FROM {table}").fetchall() == [(kept,)]
+
+    # The threads option applies to the call only
+    con.execute("SET threads = 1")
+    tt.fuzzy_join(str(input_path), reference, pairs="city,city_ref", threshold=80, con=con, threads="2")
+    assert con.execute("SELECT current_setting('threads')").fetchone()[0] == 1
+
+    with pytest.raises(tt.FuzzyJoinError, match="not found"):
+        tt.fuzzy_join(str(input_path), reference, pairs="city,missing")
+    with pytest.raises(TypeError):
+        tt.fuzzy_join(str(input_path), reference, output_clean="out.csv")
+
+
+def test_serve_jsonl(tmp_path):
+    """Verify `serve` answers JSON lines with the batch matching and ambiguity rules."""
+    ref_path = tmp_path / "ref.csv"
+    write_csv(ref_path, "city_ref,code", ["Roma,RM", "Milano,MI", "Bari,BA", "Bari,BA2"])
+    requests = "\n".join([
+        '{"id": 1, "city": "Rooma"}',
+        '[{"id": 2, "city": "Milano"}, {"id": 3, "city": "Bari"}, {"id": 4, "city": "Xyz"}]',
+        "not json",
+    ]) + "\n"
+
+    result = run_cli("serve", ref_path, "-j", "city,city_ref", "-a", "code", "-t", "80", input=requests)
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    single, batch, error = [json.loads(line) for line in result.stdout.splitlines()]
+    assert single["id"] == 1 and single["status"] == "match"
+    assert single["match"]["code"] == "RM"
+    assert [r["status"] for r in batch] == ["match", "ambiguous", "no_match"]
+    assert sorted(c["code"] for c in batch[1]["candidates"]) == ["BA", "BA2"]
+    assert "error" in error
+    report = json.loads(result.stderr.splitlines()[-1])
+    assert report["requests"] == 3 and report["records"] == 4
+    assert report["p50_ms"] <= report["p99_ms"]
+
+
+def test_serve_recovers_from_failed_request(tmp_path, monkeypatch):
+    """Verify a request that fails halfway through blocking leaves no table behind for the next one."""
+    from tometo_tomato import tometo_tomato as module
+
+    ref_path = tmp_path / "ref.csv"
+    write_csv(ref_path, "city_ref,code", ["Roma,RM", "Milano,MI", "Bari,BA"])
+    args = module.parse_args(
+        [str(ref_path), "-j", "city,city_ref", "-a", "code", "-t", "80", "--block", "ngram:2", "--block", "phonetic:italian"],
+        mode="serve",
+    )
+    con, plan = module.prepare_server(args)
+
+    def failing(*_args, **_kwargs):
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as patch:
+        patch.setattr(module, "build_phonetic_candidates", failing)
+        with pytest.raises(KeyboardInterrupt):
+            module.match_records(con, args, plan, [{"city": "Rooma"}])
+    assert module.match_records(con, args, plan, [{"city": "Rooma"}])[0]["match"]["code"] == "RM"
+
+
+def test_batch_mode(tmp_path):
+    """Verify `batch` matches every input against one reference, like separate runs, and summarizes them."""
+    ref_path = tmp_path / "ref.csv"
+    write_csv(ref_path, "city_ref,code", ["Roma,RM", "Milano,MI", "Torino,TO"])
+    (tmp_path / "in").mkdir()
+    write_csv(tmp_path / "in" / "north.csv", "city", ["Mlano", "Torino", "Xyz"])
+    write_csv(tmp_path / "in" / "south.csv", "city", ["Rma", "Roma"])
+
+    result = run_cli(
+        "batch", str(ref_path), str(tmp_path / "in" / "*.csv"),
+        "-j", "city,city_ref", "-a", "code", "-t", "70",
+        "-o", str(tmp_path / "out_{stem}.csv"),
+    )
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+
+    for stem in ("north", "south"):
+        single = tmp_path / f"single_{stem}.csv"
+        run_cli(
+            tmp_path / "in" / f"{stem}.csv", ref_path,
+            "-j", "city,city_ref", "-a", "code", "-t", "70", "-o", single,
+            check=True,
+        )
+        assert (tmp_path / f"out_{stem}.csv").read_text() == single.read_text()
+
+    summary = result.stdout.splitlines()
+    assert summary[0].split()[:2] == ["file", "rows"]
+    north = next(line for line in summary if "north.csv" in line).split()
+    assert north[1:5] == ["3", "2", "0", "1"]
+
+
+def test_profile_report(tmp_path):
+    """Verify --profile writes stage timings, row counts and the scoring query profile as JSON."""
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    write_csv(input_path, "city", ["Roma", "Mlano", "Mlano", "Xyz"])
+    write_csv(ref_path, "city_ref", ["Roma", "Milano", "Torino"])
+    profile_path = tmp_path / "profile.json"
+
+    base_args = [
+        input_path, ref_path,
+        "-j", "city,city_ref", "-t", "80",
+        "-o", tmp_path / "output.csv",
+        "--profile", profile_path,
+    ]
+    result = run_cli(*base_args, "--block", "ngram:2")
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+
+    report = json.loads(profile_path.read_text())
+    stages = {stage["stage"]: stage for stage in report["stages"]}
+    assert {"read_headers", "candidates", "scoring", "write_clean"} <= set(stages)
+    assert all(stage["seconds"] >= 0 and stage["runs"] == 1 for stage in stages.values())
+    rows = report["rows"]
+    assert rows["input_rows"] == 4
+    assert rows["distinct_input_rows"] == 3
+    assert rows["reference_rows"] == 3
+    assert rows["candidate_pairs"] == rows["candidate_pairs[ngram:2]"] > 0
+    assert rows["matched_rows"] == 2
+    assert report["scoring_query"]["children"]
+
+    # The direct block_key join of --block-prefix counts its pairs too
+    write_csv(ref_path, "city_ref", ["Roma", "Milano", "Mantova", "Torino"])
+    result = run_cli(*base_args, "--block-prefix", "1", "-f")
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    report = json.loads(profile_path.read_text())
+    # "Roma" is resolved by the exact pre-pass; "Mlano" meets two "M" rows, "Xyz" none
+    assert report["rows"]["candidate_pairs"] == report["rows"]["candidate_pairs[prefix:1]"] == 2
+    assert report["block_pairs"] == {"2-3": 1}
+
+
+def test_estimate_mode(tmp_path):
+    """Verify --estimate counts the pairs to score without matching, and enforces --max-pairs."""
+    input_path = tmp_path / "input.csv"
+    ref_path = tmp_path / "ref.csv"
+    output_path = tmp_path / "output.csv"
+    write_csv(input_path, "city", ["Roma", "Mlano", "Mlano", "Xyz", "Torno"])
+    write_csv(ref_path, "city_ref", ["Roma", "Milano", "Torino", "Tor"])
+    base_args = [input_path, ref_path, "-j", "city,city_ref", "-o", output_path, "--estimate"]
+
+    result = run_cli(*base_args, "--max-pairs", "100")
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    report = json.loads(result.stdout)
+    assert report["distinct_keys"] == 4
+    # "Roma" is resolved by the exact pre-pass
+    assert report["keys_to_score"] == 3
+    assert report["candidate_pairs"] == 12
+    assert 0 <= report["pairs_to_score"] <= 12
+    assert report["within_budget"] is True
+    assert report["projected_seconds"] >= report["planning_seconds"]
+    assert report["block_pairs"] == {}
+    assert not output_path.exists()
+
+    # Prefix blocks: M (1 key x 1 row), T (1 key x 2 rows), X has no block
+    result = run_cli(*base_args, "--block-prefix", "1", "-t", "50")
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    report = json.loads(result.stdout)
+    assert report["candidate_pairs"] == 3
+    assert report["largest_blocks"][0] == {"block_key": "t", "input_keys": 1, "reference_rows": 2, "pairs": 2}
+    assert report["block_pairs"] == {"1": 1, "2-3": 1}
+
+    # With a candidate table the blocks are the candidates of each input key
+    result = run_cli(*base_args, "--block", "window:1", "-t", "50")
+    assert result.returncode == 0, f"Script failed: {result.stderr}"
+    report = json.loads(result.stdout)
+    assert report["block_pairs"] == {"1": 3}
+
+    result = run_cli(*base_args, "-t", "50", "--max-pairs", "1")
+    assert result.returncode == 1
+    assert json.loads(result.stdout)["within_budget"] is False
+    assert "Budget exceeded" in result.stderr
+
+    result = run_cli(*base_args[:-1], "--max-pairs", "1")
+    assert result.returncode == 1
+    assert "require --estimate" in result.stderr
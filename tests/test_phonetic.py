@@ -0,0 +1,25 @@
+from tometo_tomato.phonetic import italian, metaphone, soundex
+
+
+def test_soundex():
+    assert soundex("Robert") == "R163"
+    assert soundex("Rupert") == "R163"
+    assert soundex("Ashcraft") == "A261"
+    assert soundex("Tymczak") == "T522"
+    assert soundex("") == ""
+
+
+def test_metaphone():
+    assert metaphone("Thompson") == "0MPSN"
+    assert metaphone("Knight") == "NT"
+    assert metaphone("Smith") == metaphone("Smyth")
+
+
+def test_italian_groups_phonetic_misspellings():
+    assert italian("Calascibetta") == italian("Calascibeta")
+    assert italian("Sciacca") == italian("Siacca")
+    assert italian("Acquaviva") == italian("Aquaviva")
+    assert italian("Giugliano") == italian("Giuliano")
+    assert italian("Cecina") != italian("Chieti")
+    # Accents are ignored
+    assert italian("Agliè") == italian("aglie")
@@ -35,3 +35,24 @@ def test_read_header_quoted_with_comma(tmp_path):
     write_file(p, '"Name";"Address, Line";Age\n"Bob";"Somewhere, 12";30\n')
     hdr = tt.read_header(str(p))
     assert hdr == ['Name', 'Address, Line', 'Age']
+
+
+def test_sniffed_dialect_is_cached(tmp_path):
+    p = tmp_path / 'semi.csv'
+    write_file(p, 'col1;col2\n"a;b";2\n')
+    cache_dir = tmp_path / 'cache'
+    assert tt.read_header(str(p), str(cache_dir)) == ['col1', 'col2']
+    cached = list(cache_dir.glob('csv_*.json'))
+    assert len(cached) == 1
+
+    # The staged read uses the sniffed dialect, quoted delimiters included
+    from tometo_tomato.tometo_tomato import csv_reader_sql, sniff_csv_dialect
+    con = duckdb.connect()
+    rows = con.execute(f"SELECT * FROM {csv_reader_sql(str(p), sniff_csv_dialect(str(p)))}").fetchall()
+    assert rows == [('a;b', '2')]
+
+    # A changed file gets a new cache entry
+    write_file(p, 'col1;col2;col3\n1;2;3\n')
+    os.utime(p, ns=(0, 0))
+    assert tt.read_header(str(p), str(cache_dir)) == ['col1', 'col2', 'col3']
+    assert len(list(cache_dir.glob('csv_*.json'))) == 2